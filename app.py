@@ -7,34 +7,56 @@ Created on Thu Jun 30 18:43:24 2022
 
 import dash
 from dash import dcc, html, no_update
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 
 from waitress import serve
 
 import pandas as pd
 import datetime
 
-from config import HOST, PORT, BASE_ENV
-from util import create_index_if_not_exist, get_init_params
-from util import get_db_connection
+from config import HOST, PORT, BASE_ENV, DB_TYPE, CHANGES_DATA_COLUMNS
+from util import create_table, get_init_params
+from util import ConnectionPool, get_data_version as load_data_version
 from util import get_shareholding_delta_for_transaction_finder
 from util import get_shareholding_time_series_for_top_participants
-from ui_components import get_trend_analysis_tab, get_transaction_finder_tab
+from ui_components import get_trend_analysis_tab, get_transaction_finder_tab, get_market_screener_tab
+from query_cache import QueryCache
+from table_query import get_page
+from trend_figure import build_trend_figure_data
+from counterparty import get_counterparty_pairs
+from screener import screen_market
+from metrics import instrument, register_metrics
 
-conn = get_db_connection()
+# Each callback checks out its own connection, so concurrent users query in parallel
+pool = ConnectionPool()
 
-create_index_if_not_exist(conn)
+# Indexes are created by maintenance.py, not at startup
+with pool.connection() as conn:
+    # StockMetadata may not exist yet in a DB scraped before it
+    create_table(conn)
+    stock_map_list, min_date, max_date = get_init_params(conn)
 
-stock_map_list, min_date, max_date = get_init_params(conn)
+def get_data_version():
+    with pool.connection() as conn:
+        return load_data_version(conn)
+
+query_cache = QueryCache(version_func=get_data_version)
+
+def run_query(query_func, *args):
+    with pool.connection() as conn:
+        return query_func(*args, conn)
 
 app = dash.Dash(__name__)
+# Latency histograms at /metrics (metrics.py)
+register_metrics(app.server)
 app.config.suppress_callback_exceptions = True # Dynamic layout will trigger unnecessary warnings
 app.layout = html.Div([
     dcc.Store(id='transaction-finder-store'),
     dcc.Store(id='transaction-finder-selected-participant'),
     dcc.Tabs(id="tabs", value='trend-analysis', children=[
         dcc.Tab(label='Trend Analysis', value='trend-analysis'),        
-        dcc.Tab(label='Transaction Finder', value='transaction-finder')  
+        dcc.Tab(label='Transaction Finder', value='transaction-finder'),
+        dcc.Tab(label='Market Screener', value='market-screener'),
     ]),
     html.Div(id='tabs-content')
 ])
@@ -48,51 +70,55 @@ def render_content(tab):
         return get_trend_analysis_tab(stock_map_list, min_date, max_date)
     elif tab == 'transaction-finder':
         return get_transaction_finder_tab(stock_map_list, min_date, max_date)
+    elif tab == 'market-screener':
+        return get_market_screener_tab(min_date, max_date)
+
+def get_trend_data(selected_stock_code, start_date_string, end_date_string):
+    # Shared by the figure and the paged table, so the query runs once per selection
+    return query_cache.get_or_compute(
+        ('trend', selected_stock_code, start_date_string, end_date_string, DB_TYPE),
+        lambda: run_query(
+            get_shareholding_time_series_for_top_participants,
+            selected_stock_code, start_date_string, end_date_string
+        )
+    )
 
 @app.callback(
     Output('trend-plot', 'figure'),
-    Output('dt-trend-analysis', 'data'),
+    Output('dt-trend-analysis', 'page_current'),
     Input('trend-analysis-select-stock', 'value'),
     Input('trend-analysis-select-date-range', 'start_date'),
     Input('trend-analysis-select-date-range', 'end_date'),     
 )
+@instrument('callback', 'start_date', 'end_date')
 def on_stock_code_selected(selected_stock_code, start_date, end_date):
-    start_date_object = datetime.date.fromisoformat(start_date)
-    start_date_string = start_date_object.strftime('%Y-%m-%d')
-        
-    end_date_object = datetime.date.fromisoformat(end_date)
-    end_date_string = end_date_object.strftime('%Y-%m-%d')
-    
-    date_range = pd.bdate_range(
-        start=start_date_object,
-        end=end_date_object
-    )
+    start_date_string = datetime.date.fromisoformat(start_date).strftime('%Y-%m-%d')
+    end_date_string = datetime.date.fromisoformat(end_date).strftime('%Y-%m-%d')
     
-    df_trend_top = get_shareholding_time_series_for_top_participants(
-        selected_stock_code, start_date_string, end_date_string, conn
-    )
-    df_trend_top['DataDate'] = pd.to_datetime(df_trend_top['DataDate'])
-    top_participants = (
-        df_trend_top[
-            df_trend_top['DataDate'] == df_trend_top['DataDate'].max()
-        ][['ParticipantID', 'ParticipantName']].values.tolist()
-    )
-    df_trend_top_groupby_obj = df_trend_top.groupby('ParticipantID')[['DataDate', 'FracOfShares']]
-    
-    data_for_graph = []
-    for participant_id, participant_name in top_participants:
-        df_participant = (
-            df_trend_top_groupby_obj.get_group(participant_id)
-            .set_index('DataDate').reindex(date_range).fillna(0)
-        )
-        data_for_graph.append({
-            'name': participant_name,
-            'mode': 'lines+markets',
-            'x': date_range,
-            'y': df_participant['FracOfShares'].values.tolist(),
-        })
-
-    return dict(data=data_for_graph), df_trend_top.to_dict('records')
+    df_trend_top = get_trend_data(selected_stock_code, start_date_string, end_date_string)
+    data_for_graph = build_trend_figure_data(df_trend_top)
+
+    # Back to the first page of the new selection
+    return dict(data=data_for_graph), 0
+
+@app.callback(
+    Output('dt-trend-analysis', 'data'),
+    Output('dt-trend-analysis', 'page_count'),
+    Input('dt-trend-analysis', 'page_current'),
+    Input('dt-trend-analysis', 'page_size'),
+    Input('dt-trend-analysis', 'sort_by'),
+    Input('dt-trend-analysis', 'filter_query'),
+    State('trend-analysis-select-stock', 'value'),
+    State('trend-analysis-select-date-range', 'start_date'),
+    State('trend-analysis-select-date-range', 'end_date'),
+)
+@instrument('callback', 'start_date', 'end_date')
+def on_trend_table_page_requested(page_current, page_size, sort_by, filter_query,
+                                  selected_stock_code, start_date, end_date):
+    start_date_string = datetime.date.fromisoformat(start_date).strftime('%Y-%m-%d')
+    end_date_string = datetime.date.fromisoformat(end_date).strftime('%Y-%m-%d')
+    df_trend_top = get_trend_data(selected_stock_code, start_date_string, end_date_string)
+    return get_page(df_trend_top, filter_query, sort_by, page_current, page_size)
         
 @app.callback(
     Output('transaction-finder-store', 'data'),
@@ -100,6 +126,7 @@ def on_stock_code_selected(selected_stock_code, start_date, end_date):
     Input('transaction-finder-select-date-range', 'start_date'),
     Input('transaction-finder-select-date-range', 'end_date'),     
 )
+@instrument('callback', 'start_date', 'end_date')
 def on_transaction_finder_filter_selected(selected_stock_code, start_date, end_date):
     start_date_object = datetime.date.fromisoformat(start_date)
     start_date_string = start_date_object.strftime('%Y-%m-%d')
@@ -107,8 +134,12 @@ def on_transaction_finder_filter_selected(selected_stock_code, start_date, end_d
     end_date_object = datetime.date.fromisoformat(end_date)
     end_date_string = end_date_object.strftime('%Y-%m-%d')
     
-    df_shareholding_delta = get_shareholding_delta_for_transaction_finder(
-        selected_stock_code, start_date_string, end_date_string, conn
+    df_shareholding_delta = query_cache.get_or_compute(
+        ('delta', selected_stock_code, start_date_string, end_date_string, DB_TYPE),
+        lambda: run_query(
+            get_shareholding_delta_for_transaction_finder,
+            selected_stock_code, start_date_string, end_date_string
+        )
     )
     
     return df_shareholding_delta.to_dict('records')
@@ -116,9 +147,11 @@ def on_transaction_finder_filter_selected(selected_stock_code, start_date, end_d
 @app.callback(
     Output('dt-top-changes-in-shareholding', 'data'),
     Output('dt-bottom-changes-in-shareholding', 'data'),
+    Output('dt-counterparty-pairs', 'data'),
     Input('transaction-finder-store', 'data'),
     Input('transaction-finder-input-threshold', 'value'),
 )
+@instrument('callback')
 def on_transaction_finder_data_changed(data, threshold):
     
     top_changes = list(
@@ -135,7 +168,9 @@ def on_transaction_finder_data_changed(data, threshold):
             reverse=False # Asc
         )
     )
-    return top_changes, bottom_changes
+    # Counterparties of every participant listed above, so selecting one is a lookup
+    df_pairs = get_counterparty_pairs(pd.DataFrame(data, columns=CHANGES_DATA_COLUMNS), threshold)
+    return top_changes, bottom_changes, df_pairs.to_dict('records')
 
 @app.callback(
     Output("dt-top-changes-in-shareholding", "selected_rows"),
@@ -147,6 +182,7 @@ def on_transaction_finder_data_changed(data, threshold):
     Input('dt-bottom-changes-in-shareholding', 'data'),
     prevent_initial_call=True
 )
+@instrument('callback')
 def on_change_row_selected(top_selected_rows, bottom_selected_rows, top_change_data, bot_change_data):
     ctx = dash.callback_context
     trigger_id, trigger_props = ctx.triggered[0]["prop_id"].split(".")[0], ctx.triggered[0]["prop_id"].split(".")[1]
@@ -168,46 +204,48 @@ def on_change_row_selected(top_selected_rows, bottom_selected_rows, top_change_d
 
 @app.callback(
     Output("dt-possible-exchanged-participants", "data"),
-    Input('transaction-finder-store', 'data'),
+    Input('dt-counterparty-pairs', 'data'),
     Input("transaction-finder-selected-participant", "data"),
     prevent_initial_call=True
 )
-def on_change_selected_participant(shareholding_data, selected_participant):
+@instrument('callback')
+def on_change_selected_participant(pairs_data, selected_participant):
     # Empty table if no participant is selected
     if selected_participant is None:
         return []
     
-    participant_change = selected_participant['ChangeInPercentShares']
-    is_buyer = participant_change > 0
-    
-    # Get whole list of possible buyers/sellers (in opposite direction)
-    shareholding_data = list(
-        sorted(
-            filter(
-                lambda d: d['ChangeInPercentShares'] < 0 if is_buyer else d['ChangeInPercentShares'] > 0,
-                shareholding_data
-            ),
-            key=lambda d: d['ChangeInPercentShares'],
-            reverse=not is_buyer # Asc if participant is a buyer
-        )
+    # Heuristic (counterparty.py) already applied to every listed participant
+    # Keyed on the name too: participants without a CCASS ID all have ParticipantID 'None'
+    selected_key = (selected_participant['ParticipantID'], selected_participant['ParticipantName'])
+    return [
+        {
+            'ParticipantID': pair['CounterpartyID'],
+            'ParticipantName': pair['CounterpartyName'],
+            'ChangeInPercentShares': pair['CounterpartyChangeInPercentShares'],
+        }
+        for pair in pairs_data
+        if (pair['ParticipantID'], pair['ParticipantName']) == selected_key
+    ]
+
+@app.callback(
+    Output('dt-market-screener', 'data'),
+    Input('market-screener-select-date-range', 'start_date'),
+    Input('market-screener-select-date-range', 'end_date'),
+    Input('market-screener-input-threshold', 'value'),
+)
+@instrument('callback', 'start_date', 'end_date')
+def on_market_screener_filter_selected(start_date, end_date, threshold):
+    if threshold is None:
+        return no_update
+    start_date_string = datetime.date.fromisoformat(start_date).strftime('%Y-%m-%d')
+    end_date_string = datetime.date.fromisoformat(end_date).strftime('%Y-%m-%d')
+
+    # Partitions check out their own pooled connections (screener.py)
+    df_screener = query_cache.get_or_compute(
+        ('screener', start_date_string, end_date_string, threshold, DB_TYPE),
+        lambda: screen_market(start_date_string, end_date_string, threshold, pool)
     )
-    
-    # Heuristic to get those the participant has possibly exchanged with
-    results = []
-    running_changes = 0
-    for other_participant in shareholding_data:
-        # For bigger buyer / sellers (who buys/sells more than 50% of the change of selected participant):
-        #   Include all of them
-        if abs(other_participant['ChangeInPercentShares']) >= 0.5 * abs(participant_change):
-            results.append(other_participant)
-            continue
-        # For smaller buyer / sellers:
-        #   Accumulate until the changes of them sum up to the change of selected participant
-        if (running_changes <= abs(participant_change)):
-            results.append(other_participant)
-            running_changes += abs(other_participant['ChangeInPercentShares'])
-    
-    return results
+    return df_screener.to_dict('records')
     
     
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio scraping pipeline
+
+An alternative to the thread-per-date model in scraper.py:
+    fetch (aiohttp, rate limited and bounded) -> parse (thread pool) -> write (single DB thread)
+
+Each stage is connected by a bounded asyncio.Queue so a slow stage slows down the ones before it.
+The write stage hands batches to the DBWriter thread, which owns the DB connection.
+
+Run:
+    python async_scraper.py
+"""
+
+import asyncio
+import datetime
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import pandas as pd
+
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME
+from config import STOCK_CODE_LIST_URL, MAIN_URL
+from config import (
+    HTTP_TIMEOUT, ASYNC_MAX_CONCURRENCY, ASYNC_REQUESTS_PER_SECOND,
+    ASYNC_MAX_RETRIES, CCASS_TABLE_COLUMNS, SCRAPE_PROGRESS_COLUMNS
+)
+from batch_buffer import ColumnarBuffer
+from db_writer import DBWriter
+from http_scraper import parse_form_fields
+from parsers import parse_stock_code_list_html, parse_shareholding_html
+from scheduler import plan_scrape, prune_expired_data, print_plan
+from util import get_db_connection, create_table, load_scrape_progress, load_stock_map_by_date, update_stock_metadata
+from util import store_market_holiday
+
+
+class TokenBucket:
+    """Global rate limit shared by all fetches: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int = None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncCCASSPipeline:
+
+    def __init__(self, main_url: str = MAIN_URL, stock_code_list_url: str = STOCK_CODE_LIST_URL,
+                 max_concurrency: int = ASYNC_MAX_CONCURRENCY,
+                 requests_per_second: float = ASYNC_REQUESTS_PER_SECOND):
+        self.main_url = main_url
+        self.stock_code_list_url = stock_code_list_url
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.parse_executor = ThreadPoolExecutor()
+        self.writer = None
+        self.session = None
+        self.form_fields = {}
+        # (DataDate, StockCode) -> AttemptCount from the progress journal
+        self.attempt_counts = {}
+        self.stats = {'fetched': 0, 'retries': 0, 'failed': 0, 'rows': 0}
+
+    async def call_db(self, func):
+        # func(connection) on the writer thread, reads and small writes alike
+        return await asyncio.get_running_loop().run_in_executor(None, self.writer.call, func)
+
+    async def write_db(self, df: pd.DataFrame, table_name: str):
+        # submit blocks while the writer queue is full
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.submit, df, table_name)
+
+    async def request(self, method: str, url: str, **kwargs) -> str:
+        # Jittered exponential backoff on errors
+        for attempt in range(ASYNC_MAX_RETRIES + 1):
+            await self.rate_limiter.acquire()
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, **kwargs) as response:
+                        response.raise_for_status()
+                        return await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == ASYNC_MAX_RETRIES:
+                    raise
+                self.stats['retries'] += 1
+                await asyncio.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt)))
+
+    async def get_stock_codes_to_scrape(self, date: datetime.date) -> list:
+        date_str = date.strftime('%Y-%m-%d')
+        df_stock_map = await self.call_db(lambda conn: load_stock_map_by_date(date_str, conn))
+        if df_stock_map.empty:
+            page_source = await self.request('GET', self.stock_code_list_url + date.strftime('%Y%m%d'))
+            df_stock_map = parse_stock_code_list_html(page_source, date)
+            if df_stock_map.empty:
+                # The list page loaded without stocks: a holiday once seen so again later (load_market_holidays)
+                print(f"No stocks listed on {date_str}, recording it as a possible holiday")
+                await self.call_db(lambda conn: store_market_holiday(date_str, conn))
+                return []
+            print(f"Loading {len(df_stock_map)} rows into {STOCK_MAP_TABLE_NAME}")
+            await self.write_db(df_stock_map, STOCK_MAP_TABLE_NAME)
+        df_progress = await self.call_db(lambda conn: load_scrape_progress(date_str, conn))
+        scraped_stock_codes = set()
+        for stock_code, status, attempt_count in df_progress[['StockCode', 'Status', 'AttemptCount']].values.tolist():
+            self.attempt_counts[(date_str, stock_code)] = attempt_count
+            if status in ('DONE', 'EMPTY'):
+                scraped_stock_codes.add(stock_code)
+        return [
+            stock_code for stock_code in df_stock_map['StockCode'].values.tolist()
+            if stock_code not in scraped_stock_codes
+        ]
+
+    async def fetch_one_page(self, date: datetime.date, stock_code: str, parse_queue: asyncio.Queue):
+        form_data = {
+            **self.form_fields,
+            '__EVENTTARGET': 'btnSearch',
+            '__EVENTARGUMENT': '',
+            'txtShareholdingDate': date.strftime('%Y/%m/%d'),
+            'txtStockCode': stock_code,
+        }
+        start_time = time.perf_counter()
+        try:
+            page_source = await self.request('POST', self.main_url, data=form_data)
+        except Exception as e:
+            self.stats['failed'] += 1
+            print(f"fetch error for {date.strftime('%Y-%m-%d')}, {stock_code}: {e}")
+            page_source = None
+        else:
+            self.stats['fetched'] += 1
+        await parse_queue.put((date, stock_code, page_source, time.perf_counter() - start_time))
+
+    def make_progress_record(self, date: datetime.date, stock_code: str, status: str,
+                             row_count: int, elapsed: float) -> tuple:
+        date_str = date.strftime('%Y-%m-%d')
+        attempt_count = self.attempt_counts.get((date_str, stock_code), 0) + 1
+        self.attempt_counts[(date_str, stock_code)] = attempt_count
+        return (
+            date_str, stock_code, status, row_count, attempt_count,
+            round(elapsed * 1000, 1), datetime.datetime.now()
+        )
+
+    async def fetch_stage(self, dates: list, parse_queue: asyncio.Queue):
+        pending = set()
+        for date in dates:
+            for stock_code in await self.get_stock_codes_to_scrape(date):
+                # Bound the number of in-flight tasks rather than creating one per page upfront
+                if len(pending) >= self.max_concurrency * 2:
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.add(asyncio.create_task(self.fetch_one_page(date, stock_code, parse_queue)))
+            print(f"Queued all pages for {date.strftime('%Y-%m-%d')}")
+        if pending:
+            await asyncio.wait(pending)
+
+    async def parse_stage(self, parse_queue: asyncio.Queue, write_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await parse_queue.get()
+            if item is None:
+                break
+            date, stock_code, page_source, elapsed = item
+            if page_source is None:
+                await write_queue.put((None, self.make_progress_record(date, stock_code, 'FAILED', 0, elapsed)))
+                continue
+            try:
+                df = await loop.run_in_executor(
+                    self.parse_executor, parse_shareholding_html, page_source, date, stock_code
+                )
+            except Exception as e:
+                # A malformed page must not stop the stage, the fetches would block on the full queue
+                self.stats['failed'] += 1
+                print(f"parse error for {date.strftime('%Y-%m-%d')}, {stock_code}: {e}")
+                await write_queue.put((None, self.make_progress_record(date, stock_code, 'FAILED', 0, elapsed)))
+                continue
+            status = 'EMPTY' if df.empty else 'DONE'
+            await write_queue.put((df, self.make_progress_record(date, stock_code, status, len(df), elapsed)))
+
+    async def write_stage(self, write_queue: asyncio.Queue):
+        buffer = ColumnarBuffer(CCASS_TABLE_COLUMNS)
+        progress_records = []
+        while True:
+            item = await write_queue.get()
+            if item is not None:
+                df, progress_record = item
+                if df is not None:
+                    buffer.append(df)
+                progress_records.append(progress_record)
+            if item is None or buffer.is_full():
+                # Progress is recorded after the rows, so a crash in between only causes a re-scrape
+                if len(buffer):
+                    print(f"Loading {len(buffer)} rows into db")
+                    await self.write_db(buffer.take(), CCASS_TABLE_NAME)
+                if progress_records:
+                    df_progress = pd.DataFrame(progress_records, columns=SCRAPE_PROGRESS_COLUMNS)
+                    await self.write_db(df_progress, SCRAPE_PROGRESS_TABLE_NAME)
+                    progress_records = []
+            if item is None:
+                break
+        self.stats['rows'] = buffer.rows_flushed
+        self.stats['flushes'] = buffer.flush_count
+
+    async def run(self, dates: list):
+        start_time = time.perf_counter()
+
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        with DBWriter() as writer:
+            self.writer = writer
+            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+                self.session = session
+                self.form_fields = parse_form_fields(await self.request('GET', self.main_url))
+
+                parse_queue = asyncio.Queue(maxsize=self.max_concurrency * 2)
+                write_queue = asyncio.Queue(maxsize=self.max_concurrency * 2)
+                parse_task = asyncio.create_task(self.parse_stage(parse_queue, write_queue))
+                write_task = asyncio.create_task(self.write_stage(write_queue))
+
+                try:
+                    await self.fetch_stage(dates, parse_queue)
+                    await parse_queue.put(None)
+                    await parse_task
+                    await write_queue.put(None)
+                    await write_task
+                finally:
+                    # Not left running if a stage failed
+                    for task in (parse_task, write_task):
+                        task.cancel()
+                    await asyncio.gather(parse_task, write_task, return_exceptions=True)
+
+            for date in dates:
+                date_str = date.strftime('%Y-%m-%d')
+                await self.call_db(lambda conn: update_stock_metadata(date_str, conn))
+
+        self.parse_executor.shutdown()
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"Finished: {self.stats['fetched']} pages, {self.stats['rows']} rows, "
+            f"{self.stats['retries']} retries, {self.stats['failed']} failed in {elapsed:.1f}s"
+        )
+        return self.stats
+
+
+def get_plan_dates() -> list:
+    # Dates with missing stock days, newest first; the pipeline skips the stock days already scraped
+    conn = get_db_connection()
+    try:
+        create_table(conn)
+        prune_expired_data(conn)
+        plan = plan_scrape(conn)
+    finally:
+        conn.close()
+    print_plan(plan)
+    return [date for date, _ in plan]
+
+def main():
+    asyncio.run(AsyncCCASSPipeline().run(get_plan_dates()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar buffer for parsed rows before they are written to the DB
+
+Rows are appended to one list per column (no DataFrame copy per page).
+The buffer is due for a flush when it reaches a row count, an estimated byte size or an age limit.
+"""
+
+import time
+
+import pandas as pd
+
+from config import BUFFER_MAX_ROWS, BUFFER_MAX_BYTES, BUFFER_MAX_SECONDS
+
+
+class ColumnarBuffer:
+
+    def __init__(self, columns: list, max_rows: int = BUFFER_MAX_ROWS,
+                 max_bytes: int = BUFFER_MAX_BYTES, max_seconds: float = BUFFER_MAX_SECONDS):
+        self.columns = columns
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_count = 0
+        self.rows_flushed = 0
+        self.reset()
+
+    def reset(self):
+        self.data = {col: [] for col in self.columns}
+        self.row_count = 0
+        self.byte_count = 0
+        self.started_at = time.monotonic()
+
+    def __len__(self):
+        return self.row_count
+
+    def append(self, df: pd.DataFrame):
+        if df.empty:
+            return
+        for col in self.columns:
+            values = df[col].tolist()
+            self.data[col].extend(values)
+            # Rough size: string length or 8 bytes for numbers
+            if values and isinstance(values[0], str):
+                self.byte_count += sum(map(len, values))
+            else:
+                self.byte_count += 8 * len(values)
+        self.row_count += len(df)
+
+    def is_full(self) -> bool:
+        return (
+            self.row_count >= self.max_rows
+            or self.byte_count >= self.max_bytes
+            or (self.row_count > 0 and time.monotonic() - self.started_at >= self.max_seconds)
+        )
+
+    def take(self) -> pd.DataFrame:
+        # Drain the buffer into one DataFrame for writing
+        df = pd.DataFrame(self.data, columns=self.columns)
+        self.flush_count += 1
+        self.rows_flushed += self.row_count
+        self.reset()
+        return df
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the shareholding table parsers (pages per second)
+
+Fixtures are saved search result pages named <yyyymmdd>_<stock code>.html,
+e.g. recorded by the HTTP engine with SAVE_PAGE_SOURCE_DIR set.
+Synthetic pages in the same layout are generated if no fixture is found.
+
+Run:
+    python bench_parser.py [fixture_dir] [--repeat N]
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import random
+import time
+
+import pandas as pd
+
+from parsers import parse_shareholding_html, parse_shareholding_html_bs4
+
+
+def generate_synthetic_page(number_of_participants: int, rng: random.Random) -> str:
+    rows = []
+    for i in range(number_of_participants):
+        shareholding = rng.randint(1000, 500_000_000)
+        rows.append(f"""
+            <tr>
+                <td class="col-participant-id"><div class="mobile-list-heading">Participant ID:</div><div class="mobile-list-body">{'C%05d' % i if i else ''}</div></td>
+                <td class="col-participant-name"><div class="mobile-list-heading">Name of CCASS Participant:</div><div class="mobile-list-body">PARTICIPANT {i} SECURITIES LIMITED</div></td>
+                <td class="col-address"><div class="mobile-list-heading">Address:</div><div class="mobile-list-body">{i} QUEEN'S ROAD CENTRAL, HONG KONG</div></td>
+                <td class="col-shareholding text-right"><div class="mobile-list-heading">Shareholding:</div><div class="mobile-list-body">{shareholding:,}</div></td>
+                <td class="col-shareholding-percent text-right"><div class="mobile-list-heading">% of the total number of Issued Shares:</div><div class="mobile-list-body">{rng.uniform(0, 20):.2f}%</div></td>
+            </tr>""")
+    return f"""
+        <html><body>
+        <div class="search-details-table-container table-mobile-list-container">
+            <table class="table table-scroll table-sort table-mobile-list">
+                <thead><tr><th>Participant ID</th><th>Name of CCASS Participant</th><th>Address</th><th>Shareholding</th><th>%</th></tr></thead>
+                <tbody>{''.join(rows)}</tbody>
+            </table>
+        </div>
+        </body></html>
+    """
+
+def load_fixtures(fixture_dir: str) -> list:
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, '*.html'))):
+        date_str, stock_code = os.path.splitext(os.path.basename(path))[0].split('_')
+        with open(path, encoding='utf-8') as f:
+            fixtures.append((datetime.datetime.strptime(date_str, '%Y%m%d').date(), stock_code, f.read()))
+    return fixtures
+
+def benchmark(parser, fixtures: list, repeat: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for date, stock_code, page_source in fixtures:
+            parser(page_source, date, stock_code)
+    return len(fixtures) * repeat / (time.perf_counter() - start_time)
+
+def check_same_output(fixtures: list):
+    for date, stock_code, page_source in fixtures:
+        df_fast = parse_shareholding_html(page_source, date, stock_code).reset_index(drop=True)
+        df_bs4 = parse_shareholding_html_bs4(page_source, date, stock_code).reset_index(drop=True)
+        pd.testing.assert_frame_equal(df_fast, df_bs4, check_dtype=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fixture_dir', nargs='?', default='fixtures')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    fixtures = load_fixtures(args.fixture_dir)
+    if not fixtures:
+        print(f"No fixture found in {args.fixture_dir}, using synthetic pages")
+        rng = random.Random(0)
+        fixtures = [
+            (datetime.date(2022, 6, 28), '%05d' % i, generate_synthetic_page(rng.randint(20, 600), rng))
+            for i in range(1, 101)
+        ]
+    
+    check_same_output(fixtures)
+    
+    results = {
+        'bs4': benchmark(parse_shareholding_html_bs4, fixtures, args.repeat),
+        'lxml': benchmark(parse_shareholding_html, fixtures, args.repeat),
+    }
+    for name, pages_per_second in results.items():
+        print(f"{name:>5}: {pages_per_second:8.1f} pages/s")
+    print(f"Speed up: {results['lxml'] / results['bs4']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the query layer on synthetic CCASS data
+
+1. Generates a synthetic DB of a BENCHMARK_SCALES shape (once, reused afterwards):
+   participant weights follow a power law, so a few custodians hold shares of most stocks,
+   and the number of holders per stock is Pareto distributed, so a few stocks have most rows.
+   Holdings follow a random walk with occasional jumps and are dropped under
+   SHAREHOLDING_THRESHOLD_TO_SCRAPE, like the scraper does.
+2. Times get_init_params, and the trend / transaction finder queries for the largest, median and
+   smallest stock over BENCHMARK_RANGE_DAYS wide date ranges.
+3. Writes p50 / p95 per case to a JSON file, to be compared between commits with --compare.
+
+SQLITE and PARQUET run offline on files under BENCHMARK_DATA_DIR. QUEST uses QUEST_DB_CONN_STR,
+so point it at a dedicated instance; its data is only generated with --generate.
+The modes of the query layer (SQLITE_SCHEMA, QUERY_ENGINE, DELTA_SOURCE) are taken from the env.
+
+Run:
+    python benchmark.py [--backend SQLITE] [--scale small] [--repeat 10] [--generate] [--output results.json]
+    python benchmark.py --compare base.json new.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import change_table
+from columnar_engine import columnar_engine, export_columnar
+from config import (
+    DB_TYPE, QUEST_DB_CONN_STR, SQLITE_SCHEMA, QUERY_ENGINE, DELTA_SOURCE,
+    CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, CCASS_TABLE_COLUMNS, SHAREHOLDING_THRESHOLD_TO_SCRAPE,
+    BENCHMARK_DATA_DIR, BENCHMARK_SCALES, BENCHMARK_END_DATE, BENCHMARK_SEED, BENCHMARK_RANGE_DAYS, BENCHMARK_REPEAT,
+)
+from maintenance import rebuild_stock_metadata
+from parquet_store import ParquetStore
+from util import configure_sqlite_connection, create_table, create_index_if_not_exist, store_df_to_db
+from util import get_init_params, get_latest_data_date, load_stock_map_by_date, load_shareholding_snapshots
+from util import get_shareholding_time_series_for_top_participants, get_shareholding_delta_for_transaction_finder
+
+# Holders per stock of the benchmark stocks, by holders on the last date
+STOCK_SIZES = ['largest', 'median', 'smallest']
+
+
+def get_data_path(backend: str, scale: str) -> str:
+    if backend == 'SQLITE':
+        return os.path.join(BENCHMARK_DATA_DIR, f'ccass_{scale}.db')
+    elif backend == 'PARQUET':
+        return os.path.join(BENCHMARK_DATA_DIR, f'parquet_{scale}')
+    return None
+
+def get_benchmark_connection(backend: str, scale: str):
+    if backend == 'SQLITE':
+        conn = sqlite3.connect(get_data_path(backend, scale), check_same_thread=False)
+        configure_sqlite_connection(conn)
+        return conn
+    elif backend == 'PARQUET':
+        return ParquetStore(get_data_path(backend, scale))
+    else:
+        return psycopg2.connect(QUEST_DB_CONN_STR, connect_timeout=0)
+
+def generate_synthetic_data(conn, stocks: int, dates: int, participants: int, rows: int,
+    seed: int = BENCHMARK_SEED, end_date_str: str = BENCHMARK_END_DATE):
+    start_time = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    date_strs = pd.bdate_range(end=end_date_str, periods=dates).strftime('%Y-%m-%d')
+    stock_codes = np.array([f'{code:05d}' for code in np.sort(rng.choice(np.arange(1, 10000), stocks, replace=False))])
+    issued_shares = rng.uniform(1e8, 1e10, stocks)
+    # Participant 0 is the biggest custodian
+    participant_ids = np.array([f'C{i:05d}' for i in range(participants)])
+    participant_names = np.array([f'BENCHMARK PARTICIPANT {i}' for i in range(participants)])
+    participant_addresses = np.array([f'ADDRESS {i}' for i in range(participants)])
+    participant_weights = 1 / np.arange(1, participants + 1) ** 1.1
+    participant_weights /= participant_weights.sum()
+
+    # Holders per stock scaled to the row count, at most 300 holders >= 0.1% like the real data
+    holders = rng.pareto(1.5, stocks) + 1
+    holders = np.clip(np.round(holders / holders.mean() * rows / (stocks * dates)), 3, min(participants, 300)).astype(int)
+
+    pair_stock, pair_participant, pair_frac = [], [], []
+    for i, n in enumerate(holders):
+        ids = np.sort(rng.choice(participants, n, replace=False, p=participant_weights))
+        # Bigger custodians hold more, the total in CCASS is 50-95%
+        floor = rng.uniform(0.1, 0.3, n)
+        total = rng.uniform(50, 95)
+        frac = floor + np.sort(rng.dirichlet(np.full(n, 0.3)))[::-1] * max(total - floor.sum(), 0)
+        pair_stock.append(np.full(n, i))
+        pair_participant.append(ids)
+        pair_frac.append(frac)
+    pair_stock = np.concatenate(pair_stock)
+    pair_participant = np.concatenate(pair_participant)
+    log_frac = np.log(np.concatenate(pair_frac))
+
+    row_count = 0
+    for i, date_str in enumerate(date_strs):
+        if i:
+            # Daily drift, plus a transaction now and then
+            log_frac += rng.normal(0, 0.01, len(log_frac))
+            jumps = rng.random(len(log_frac)) < 0.002
+            log_frac[jumps] += rng.normal(0, 0.7, jumps.sum())
+        frac = np.round(np.exp(log_frac), 2)
+        keep = frac > SHAREHOLDING_THRESHOLD_TO_SCRAPE
+        stock_idx, participant_idx = pair_stock[keep], pair_participant[keep]
+        df = pd.DataFrame({
+            'DataDate': date_str,
+            'StockCode': stock_codes[stock_idx],
+            'ParticipantID': participant_ids[participant_idx],
+            'ParticipantName': participant_names[participant_idx],
+            'ParticipantAddress': participant_addresses[participant_idx],
+            'Shareholding': (frac[keep] / 100 * issued_shares[stock_idx]).astype(np.int64),
+            'FracOfShares': frac[keep],
+        })
+        store_df_to_db(df[CCASS_TABLE_COLUMNS], conn, CCASS_TABLE_NAME)
+        store_df_to_db(pd.DataFrame({
+            'DataDate': date_str,
+            'StockCode': stock_codes,
+            'StockName': [f'BENCHMARK STOCK {code}' for code in stock_codes],
+        }), conn, STOCK_MAP_TABLE_NAME)
+        row_count += len(df)
+        if (i + 1) % 20 == 0 or i + 1 == len(date_strs):
+            print(f"Generated {i + 1}/{len(date_strs)} dates, {row_count} rows in {time.perf_counter() - start_time:.1f}s")
+    conn.commit()
+
+def prepare_data(backend: str, scale: str, generate: bool):
+    path = get_data_path(backend, scale)
+    if path is not None:
+        os.makedirs(BENCHMARK_DATA_DIR, exist_ok=True)
+        generate = generate or not os.path.exists(path)
+        if generate and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif generate and os.path.exists(path):
+            os.remove(path)
+
+    conn = get_benchmark_connection(backend, scale)
+    create_table(conn)
+    if generate:
+        generate_synthetic_data(conn, **BENCHMARK_SCALES[scale])
+        create_index_if_not_exist(conn)
+        rebuild_stock_metadata(conn)
+        if isinstance(conn, sqlite3.Connection) and DELTA_SOURCE == 'CHANGE_TABLE':
+            change_table.rebuild_change_table(conn)
+
+    if QUERY_ENGINE == 'COLUMNAR' and not isinstance(conn, ParquetStore):
+        columnar_engine.data_dir = os.path.join(BENCHMARK_DATA_DIR, f'columnar_{backend.lower()}_{scale}')
+        if generate or not os.path.exists(os.path.join(columnar_engine.data_dir, 'CURRENT')):
+            os.makedirs(columnar_engine.data_dir, exist_ok=True)
+            export_columnar(conn, columnar_engine.data_dir)
+        columnar_engine.reload()
+    return conn
+
+def select_stocks(conn, date_str: str) -> dict:
+    # Largest, median and smallest stock by holders on date_str
+    stock_codes = load_stock_map_by_date(date_str, conn)['StockCode'].tolist()
+    df = load_shareholding_snapshots([date_str], stock_codes, conn)
+    holders = df['StockCode'].value_counts()
+    holders = holders.iloc[np.lexsort((holders.index.values, -holders.values))]
+    positions = [0, len(holders) // 2, len(holders) - 1]
+    return {size: (holders.index[i], int(holders.iloc[i])) for size, i in zip(STOCK_SIZES, positions)}
+
+def time_query(query_func, repeat: int) -> tuple:
+    # One untimed run first, so all runs see a warm cache
+    result = query_func()
+    durations_ms = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        query_func()
+        durations_ms.append((time.perf_counter() - start_time) * 1000)
+    return durations_ms, result
+
+def summarize(durations_ms: list) -> dict:
+    return {
+        'runs': len(durations_ms),
+        'p50_ms': round(float(np.percentile(durations_ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(durations_ms, 95)), 3),
+        'min_ms': round(float(np.min(durations_ms)), 3),
+        'max_ms': round(float(np.max(durations_ms)), 3),
+    }
+
+def run_benchmark(conn, repeat: int = BENCHMARK_REPEAT, range_days: list = BENCHMARK_RANGE_DAYS) -> list:
+    last_date_str = pd.Timestamp(get_latest_data_date(conn)).strftime('%Y-%m-%d')
+    stocks = select_stocks(conn, last_date_str)
+    results = []
+
+    durations_ms, (stock_map_list, _, _) = time_query(lambda: get_init_params(conn), repeat)
+    results.append({'query': 'get_init_params', 'stock': None, 'range_days': None, 'rows': len(stock_map_list), **summarize(durations_ms)})
+    print(f"get_init_params: p50 {results[-1]['p50_ms']}ms, p95 {results[-1]['p95_ms']}ms")
+
+    queries = [get_shareholding_time_series_for_top_participants, get_shareholding_delta_for_transaction_finder]
+    for size, (stock_code, holders) in stocks.items():
+        for days in range_days:
+            start_date_str = pd.bdate_range(end=last_date_str, periods=days)[0].strftime('%Y-%m-%d')
+            for query_func in queries:
+                durations_ms, df = time_query(lambda: query_func(stock_code, start_date_str, last_date_str, conn), repeat)
+                results.append({
+                    'query': query_func.__name__,
+                    'stock': size,
+                    'stock_code': stock_code,
+                    'holders': holders,
+                    'range_days': days,
+                    'start_date': start_date_str,
+                    'end_date': last_date_str,
+                    'rows': len(df),
+                    **summarize(durations_ms),
+                })
+                print(
+                    f"{query_func.__name__} {size} stock {stock_code} ({holders} holders), {days} days: "
+                    f"p50 {results[-1]['p50_ms']}ms, p95 {results[-1]['p95_ms']}ms"
+                )
+    return results
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(base_path: str, new_path: str) -> pd.DataFrame:
+    frames = []
+    for path in (base_path, new_path):
+        with open(path) as f:
+            df = pd.DataFrame(json.load(f)['results'])
+        frames.append(df.set_index(['query', 'stock', 'range_days'])[['p50_ms', 'p95_ms']])
+    df = frames[0].join(frames[1], lsuffix='_base', rsuffix='_new', how='outer')
+    df['p50_ratio'] = (df['p50_ms_new'] / df['p50_ms_base']).round(2)
+    df['p95_ratio'] = (df['p95_ms_new'] / df['p95_ms_base']).round(2)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['SQLITE', 'QUEST', 'PARQUET'], default=DB_TYPE or 'SQLITE')
+    parser.add_argument('--scale', choices=list(BENCHMARK_SCALES), default='small')
+    parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT)
+    parser.add_argument('--generate', action='store_true', help='(re)generate the synthetic data')
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare_results(*args.compare).to_string())
+        return
+
+    commit = get_git_commit()
+    conn = prepare_data(args.backend, args.scale, args.generate)
+    try:
+        results = run_benchmark(conn, args.repeat)
+    finally:
+        conn.close()
+
+    output_path = args.output or os.path.join(
+        BENCHMARK_DATA_DIR, f"results_{args.backend.lower()}_{args.scale}_{commit or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump({
+            'meta': {
+                'backend': args.backend,
+                'sqlite_schema': SQLITE_SCHEMA,
+                'query_engine': QUERY_ENGINE,
+                'delta_source': DELTA_SOURCE,
+                'scale': args.scale,
+                **BENCHMARK_SCALES[args.scale],
+                'seed': BENCHMARK_SEED,
+                'repeat': args.repeat,
+                'commit': commit,
+                'python': platform.python_version(),
+                'recorded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            },
+            'results': results,
+        }, f, indent=2)
+    print(f"Results written to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
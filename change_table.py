@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Holdings change checkpoints for the transaction finder (DELTA_SOURCE=CHANGE_TABLE, SQLite only)
+
+    CCASSChange(StockCode, ParticipantID, ParticipantKey, DataDate, ParticipantName, FracOfShares, ChangeInFracOfShares)
+        WITHOUT ROWID, clustered on (StockCode, ParticipantID, ParticipantKey, DataDate)
+
+ParticipantKey is the name of participants without a CCASS ID (ParticipantID 'None'), so each has
+its own checkpoints, and '' for the others.
+
+A row is stored only on the days a participant's holding changes (entering / leaving CCASS included,
+with FracOfShares = 0 when leaving). FracOfShares is the cumulative change, i.e. the holding
+after that day, so the holding on any date is the latest checkpoint on or before it: one index
+seek per participant, whatever the size of the date range.
+
+The DB writer updates the checkpoints of each stock day when it finishes loading. A day only
+affects its own checkpoints and those of the next loaded day of the stock, so days can be loaded
+in any order.
+
+Rebuild from scratch:
+    python change_table.py --rebuild
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import CCASS_TABLE_NAME, CCASS_CHANGE_TABLE_NAME
+from parsers import get_participant_keys
+import queries
+from queries import read_query, execute_query
+
+CHANGE_TABLE_COLUMNS = [
+    'StockCode', 'ParticipantID', 'ParticipantKey', 'DataDate', 'ParticipantName', 'FracOfShares', 'ChangeInFracOfShares'
+]
+
+
+def create_change_table(connection):
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({CCASS_CHANGE_TABLE_NAME})")]
+    if columns and 'ParticipantKey' not in columns:
+        # Created before participants without a CCASS ID were told apart
+        print(f"{CCASS_CHANGE_TABLE_NAME} has no ParticipantKey, rebuilding it")
+        rebuild_change_table(connection)
+        return
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS
+        {CCASS_CHANGE_TABLE_NAME}(
+          StockCode text,
+          ParticipantID text,
+          ParticipantKey text,
+          DataDate text,
+          ParticipantName text,
+          FracOfShares real,
+          ChangeInFracOfShares real,
+          PRIMARY KEY (StockCode, ParticipantID, ParticipantKey, DataDate)
+        ) WITHOUT ROWID
+    """)
+    connection.commit()
+
+def get_checkpoints(df: pd.DataFrame, stock_code: str) -> pd.DataFrame:
+    # df: the holdings of one stock on consecutive loaded days, the first day compared against nothing
+    if df.empty:
+        return pd.DataFrame(columns=CHANGE_TABLE_COLUMNS)
+    df = get_participant_keys(df)
+    frac = df.pivot_table(
+        index='DataDate', columns=['ParticipantID', 'ParticipantKey'], values='FracOfShares', aggfunc='last'
+    ).fillna(0)
+    change = frac.diff()
+    change.iloc[0] = frac.iloc[0]
+    date_idx, participant_idx = np.nonzero(np.abs(change.values) > 1e-9)
+    participants = frac.columns[participant_idx]
+    participant_names = (
+        df.drop_duplicates(['ParticipantID', 'ParticipantKey'], keep='last')
+        .set_index(['ParticipantID', 'ParticipantKey'])['ParticipantName']
+    )
+    return pd.DataFrame({
+        'StockCode': stock_code,
+        'ParticipantID': participants.get_level_values('ParticipantID'),
+        'ParticipantKey': participants.get_level_values('ParticipantKey'),
+        'DataDate': frac.index.values[date_idx],
+        'ParticipantName': participant_names.reindex(participants).values,
+        'FracOfShares': frac.values[date_idx, participant_idx],
+        'ChangeInFracOfShares': change.values[date_idx, participant_idx].round(4),
+    })
+
+def read_holdings(connection, stock_code: str, date_strs: list = None) -> pd.DataFrame:
+    if date_strs is None:
+        return read_query(queries.HOLDINGS, connection, stock_code=stock_code)
+    return read_query(queries.HOLDINGS_ON_DATES, connection, stock_code=stock_code, dates=date_strs)
+
+def get_adjacent_data_dates(connection, stock_code: str, date_str: str) -> tuple:
+    # Previous and next loaded days of the stock (None if there is none)
+    return execute_query(queries.ADJACENT_DATA_DATES, connection, stock_code=stock_code, date=date_str).fetchone()
+
+def store_checkpoints(connection, df: pd.DataFrame):
+    connection.executemany(f"""
+        INSERT OR REPLACE INTO {CCASS_CHANGE_TABLE_NAME} ({','.join(CHANGE_TABLE_COLUMNS)})
+        VALUES ({','.join(['?']*len(CHANGE_TABLE_COLUMNS))})
+    """, zip(*(df[col].tolist() for col in CHANGE_TABLE_COLUMNS)))
+
+def update_change_table(connection, df_progress: pd.DataFrame):
+    # df_progress: progress journal records of the stock days just loaded
+    df_progress = df_progress[df_progress['Status'] == 'DONE']
+    with connection:
+        for date_str, stock_code in df_progress[['DataDate', 'StockCode']].drop_duplicates().values.tolist():
+            prev_date_str, next_date_str = get_adjacent_data_dates(connection, stock_code, date_str)
+            affected_date_strs = [d for d in (date_str, next_date_str) if d is not None]
+            df = read_holdings(
+                connection, stock_code, [d for d in (prev_date_str, *affected_date_strs) if d is not None]
+            )
+            df_checkpoints = get_checkpoints(df, stock_code)
+            for d in affected_date_strs:
+                execute_query(queries.DELETE_CHECKPOINTS_ON_DATE, connection, stock_code=stock_code, date=d)
+            store_checkpoints(connection, df_checkpoints[df_checkpoints['DataDate'].isin(affected_date_strs)])
+
+def prune_change_table(connection, cutoff_date_str: str):
+    # After the days before cutoff_date_str are deleted from CCASS: the first day left of each stock
+    # becomes its first checkpoint, compared against nothing
+    stock_codes = read_query(
+        queries.STOCKS_WITH_CHECKPOINTS_BEFORE, connection, cutoff_date=cutoff_date_str
+    )['StockCode'].values.tolist()
+    with connection:
+        for stock_code in stock_codes:
+            execute_query(
+                queries.DELETE_CHECKPOINTS_BEFORE, connection, stock_code=stock_code, cutoff_date=cutoff_date_str
+            )
+            first_date_str = execute_query(
+                queries.FIRST_DATA_DATE_OF_STOCK, connection, stock_code=stock_code
+            ).fetchone()[0]
+            if first_date_str is None:
+                continue
+            execute_query(queries.DELETE_CHECKPOINTS_ON_DATE, connection, stock_code=stock_code, date=first_date_str)
+            df = read_holdings(connection, stock_code, [first_date_str])
+            store_checkpoints(connection, get_checkpoints(df, stock_code))
+    print(f"Pruned the checkpoints of {len(stock_codes)} stocks before {cutoff_date_str}")
+
+def rebuild_change_table(connection):
+    start_time = time.perf_counter()
+    with connection:
+        connection.execute(f"DROP TABLE IF EXISTS {CCASS_CHANGE_TABLE_NAME}")
+    create_change_table(connection)
+    stock_codes = pd.read_sql_query(
+        f"select distinct StockCode from {CCASS_TABLE_NAME} order by StockCode", connection
+    )['StockCode'].values.tolist()
+    row_count = 0
+    with connection:
+        for i, stock_code in enumerate(stock_codes):
+            df_checkpoints = get_checkpoints(read_holdings(connection, stock_code), stock_code)
+            store_checkpoints(connection, df_checkpoints)
+            row_count += len(df_checkpoints)
+            if (i + 1) % 100 == 0:
+                print(f"Rebuilt {i + 1} out of {len(stock_codes)} stocks")
+    connection.execute("ANALYZE")
+    print(f"Rebuilt {row_count} checkpoints of {len(stock_codes)} stocks in {time.perf_counter() - start_time:.1f}s")
+
+def get_snapshot_date(connection, date_str: str) -> str:
+    return execute_query(queries.SNAPSHOT_DATE, connection, date=date_str).fetchone()[0]
+
+def get_shareholding_delta_for_transaction_finder(stock_code: str, start_date_str: str,
+    end_date_str: str, connection) -> pd.DataFrame:
+    # Same snapshot dates as the SQL query: the latest stock list on or before each date
+    return read_query(
+        queries.CHECKPOINT_SHAREHOLDING_DELTA, connection,
+        stock_code=stock_code, start_date=start_date_str, end_date=end_date_str,
+        start_snapshot_date=get_snapshot_date(connection, start_date_str) or '',
+        end_snapshot_date=get_snapshot_date(connection, end_date_str) or '',
+    )
+
+
+def main():
+    from util import get_db_connection
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', action='store_true')
+    args = parser.parse_args()
+
+    connection = get_db_connection()
+    try:
+        if args.rebuild:
+            rebuild_change_table(connection)
+        else:
+            create_change_table(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
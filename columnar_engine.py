@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory columnar query engine backed by memory-mapped NumPy arrays (QUERY_ENGINE=COLUMNAR)
+
+CCASS is exported into one .npy file per column, sorted by (StockCode, DataDate),
+with a per-stock offset index. Queries binary search the stock and the date range and
+use vectorized ops instead of SQL. Data stays in the OS page cache rather than in Python objects.
+The dates of the stock lists (StockMap) are exported too, so the snapshot of a date is the latest
+stock list date on or before it for every stock, like in the SQL queries.
+
+Each export goes to a new version directory and CURRENT is switched afterwards,
+so a running app picks up the new export within COLUMNAR_RELOAD_CHECK_SECONDS.
+
+Export (e.g. after the daily scrape):
+    python columnar_engine.py [--dir columnar]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, COLUMNAR_DATA_DIR, COLUMNAR_RELOAD_CHECK_SECONDS, TREND_TOP_PARTICIPANTS
+
+EXPORT_CHUNK_SIZE = 500_000
+
+
+def date_str_to_int(date_str) -> np.ndarray:
+    return np.asarray(pd.Series(date_str).str.replace('-', '', regex=False).astype(np.int32))
+
+def date_int_to_str(date_int: np.ndarray) -> np.ndarray:
+    return np.asarray(
+        pd.to_datetime(np.asarray(date_int).astype(str), format='%Y%m%d').strftime('%Y-%m-%d'),
+        dtype=object
+    )
+
+def export_columnar(conn, data_dir: str = COLUMNAR_DATA_DIR) -> str:
+    start_time = time.perf_counter()
+    version = time.strftime('%Y%m%d%H%M%S')
+    version_dir = os.path.join(data_dir, version)
+    os.makedirs(version_dir)
+
+    row_count = int(pd.read_sql_query(f"select count(*) from {CCASS_TABLE_NAME}", conn).iloc[0, 0])
+    columns = {
+        'data_date': np.int32,
+        'participant': np.int32,
+        'shareholding': np.int64,
+        'frac_of_shares': np.float64,
+    }
+    arrays = {
+        name: np.lib.format.open_memmap(os.path.join(version_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=(row_count,))
+        for name, dtype in columns.items()
+    }
+
+    stock_codes, stock_starts = [], []
+    participant_index = {}
+    position = 0
+    chunks = pd.read_sql_query(f"""
+        select StockCode, DataDate, ParticipantID, ParticipantName, Shareholding, FracOfShares
+        from {CCASS_TABLE_NAME}
+        order by StockCode, DataDate
+    """, conn, chunksize=EXPORT_CHUNK_SIZE)
+    for df in chunks:
+        n = len(df)
+        # Stock boundaries within the chunk
+        codes = df['StockCode'].values
+        is_new_stock = np.ones(n, dtype=bool)
+        is_new_stock[1:] = codes[1:] != codes[:-1]
+        for i in np.flatnonzero(is_new_stock):
+            if not stock_codes or stock_codes[-1] != codes[i]:
+                stock_codes.append(codes[i])
+                stock_starts.append(position + i)
+
+        participant_keys = list(zip(df['ParticipantID'].values, df['ParticipantName'].values))
+        arrays['participant'][position:position + n] = [
+            participant_index.setdefault(key, len(participant_index)) for key in participant_keys
+        ]
+        arrays['data_date'][position:position + n] = date_str_to_int(pd.to_datetime(df['DataDate']).dt.strftime('%Y-%m-%d'))
+        arrays['shareholding'][position:position + n] = df['Shareholding'].values
+        arrays['frac_of_shares'][position:position + n] = df['FracOfShares'].values
+        position += n
+
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(version_dir, 'stock_codes.npy'), np.array(stock_codes, dtype=str))
+    np.save(os.path.join(version_dir, 'stock_offsets.npy'), np.array([*stock_starts, position], dtype=np.int64))
+    participants = list(participant_index)
+    np.save(os.path.join(version_dir, 'participant_ids.npy'), np.array([p[0] for p in participants], dtype=str))
+    np.save(os.path.join(version_dir, 'participant_names.npy'), np.array([p[1] for p in participants], dtype=str))
+    snapshot_dates = pd.read_sql_query(f"select distinct DataDate from {STOCK_MAP_TABLE_NAME}", conn)['DataDate']
+    np.save(
+        os.path.join(version_dir, 'snapshot_dates.npy'),
+        np.unique(date_str_to_int(pd.to_datetime(snapshot_dates).dt.strftime('%Y-%m-%d')))
+    )
+    with open(os.path.join(version_dir, 'manifest.json'), 'w') as f:
+        json.dump({'rows': position, 'stocks': len(stock_codes), 'participants': len(participants)}, f)
+
+    # Switch to the new version, then remove the old ones (may fail on Windows while mapped)
+    with open(os.path.join(data_dir, 'CURRENT.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(data_dir, 'CURRENT.tmp'), os.path.join(data_dir, 'CURRENT'))
+    for name in os.listdir(data_dir):
+        if name not in (version, 'CURRENT') and os.path.isdir(os.path.join(data_dir, name)):
+            shutil.rmtree(os.path.join(data_dir, name), ignore_errors=True)
+
+    print(f"Exported {position} rows of {len(stock_codes)} stocks in {time.perf_counter() - start_time:.1f}s")
+    return version_dir
+
+
+class ColumnarSnapshot:
+    # The arrays of one export version, never modified after loading
+
+    def __init__(self, version_dir: str, version: str):
+        self.version = version
+        self.data_date = np.load(os.path.join(version_dir, 'data_date.npy'), mmap_mode='r')
+        self.participant = np.load(os.path.join(version_dir, 'participant.npy'), mmap_mode='r')
+        self.shareholding = np.load(os.path.join(version_dir, 'shareholding.npy'), mmap_mode='r')
+        self.frac_of_shares = np.load(os.path.join(version_dir, 'frac_of_shares.npy'), mmap_mode='r')
+        self.stock_codes = np.load(os.path.join(version_dir, 'stock_codes.npy'))
+        self.stock_offsets = np.load(os.path.join(version_dir, 'stock_offsets.npy'))
+        self.participant_ids = np.load(os.path.join(version_dir, 'participant_ids.npy'))
+        self.participant_names = np.load(os.path.join(version_dir, 'participant_names.npy'))
+        snapshot_dates_path = os.path.join(version_dir, 'snapshot_dates.npy')
+        if os.path.exists(snapshot_dates_path):
+            self.snapshot_dates = np.load(snapshot_dates_path)
+        else:
+            # Exported before the stock list dates were, the dates with data stand in for them
+            self.snapshot_dates = np.unique(self.data_date)
+
+    def get_stock_range(self, stock_code: str) -> tuple:
+        i = np.searchsorted(self.stock_codes, stock_code)
+        if i == len(self.stock_codes) or self.stock_codes[i] != stock_code:
+            return 0, 0
+        return int(self.stock_offsets[i]), int(self.stock_offsets[i + 1])
+
+    def get_date_range(self, start: int, end: int, start_date: int, end_date: int) -> tuple:
+        # Rows of [start_date, end_date] within the rows of a stock (sorted by date)
+        dates = self.data_date[start:end]
+        return (
+            start + int(np.searchsorted(dates, start_date, 'left')),
+            start + int(np.searchsorted(dates, end_date, 'right'))
+        )
+
+    def get_snapshot(self, start: int, end: int, date: int) -> tuple:
+        # Rows on the latest stock list date <= date, none if the stock has no data on it
+        i = int(np.searchsorted(self.snapshot_dates, date, 'right'))
+        if i == 0:
+            return start, start
+        return self.get_date_range(start, end, self.snapshot_dates[i - 1], self.snapshot_dates[i - 1])
+
+
+class ColumnarEngine:
+    # Queries read self.data once and use that snapshot throughout, a reload only replaces the reference
+
+    def __init__(self, data_dir: str = COLUMNAR_DATA_DIR):
+        self.data_dir = data_dir
+        self.data = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def reload(self):
+        with self.lock:
+            self.checked_at = time.monotonic()
+            with open(os.path.join(self.data_dir, 'CURRENT')) as f:
+                version = f.read().strip()
+            if self.data is None or version != self.data.version:
+                self.data = ColumnarSnapshot(os.path.join(self.data_dir, version), version)
+
+    def get_data(self) -> ColumnarSnapshot:
+        # CURRENT is checked every COLUMNAR_RELOAD_CHECK_SECONDS rather than on every query
+        if self.data is None or time.monotonic() - self.checked_at >= COLUMNAR_RELOAD_CHECK_SECONDS:
+            self.reload()
+        return self.data
+
+    def get_shareholding_time_series_for_top_participants(self, stock_code: str, start_date_str: str,
+        end_date_str: str) -> pd.DataFrame:
+        data = self.get_data()
+        start_date, end_date = date_str_to_int([start_date_str, end_date_str])
+        stock_start, stock_end = data.get_stock_range(stock_code)
+
+        # Top N (ties included, like rank() <= N) as of the end date
+        snapshot_start, snapshot_end = data.get_snapshot(stock_start, stock_end, end_date)
+        snapshot_shareholding = data.shareholding[snapshot_start:snapshot_end]
+        if len(snapshot_shareholding) > TREND_TOP_PARTICIPANTS:
+            threshold = np.partition(snapshot_shareholding, -TREND_TOP_PARTICIPANTS)[-TREND_TOP_PARTICIPANTS]
+            top_participants = data.participant[snapshot_start:snapshot_end][snapshot_shareholding >= threshold]
+        else:
+            top_participants = data.participant[snapshot_start:snapshot_end]
+
+        range_start, range_end = data.get_date_range(stock_start, stock_end, start_date, end_date)
+        participant = data.participant[range_start:range_end]
+        mask = np.isin(participant, top_participants)
+        data_date = data.data_date[range_start:range_end][mask]
+        participant = participant[mask]
+        frac_of_shares = data.frac_of_shares[range_start:range_end][mask]
+
+        order = np.lexsort((-frac_of_shares, data_date))
+        return pd.DataFrame({
+            'DataDate': date_int_to_str(data_date[order]),
+            'ParticipantID': data.participant_ids[participant[order]],
+            'ParticipantName': data.participant_names[participant[order]],
+            'FracOfShares': frac_of_shares[order],
+        })
+
+    def get_shareholding_delta_for_transaction_finder(self, stock_code: str, start_date_str: str,
+        end_date_str: str) -> pd.DataFrame:
+        data = self.get_data()
+        start_date, end_date = date_str_to_int([start_date_str, end_date_str])
+        stock_start, stock_end = data.get_stock_range(stock_code)
+
+        snapshots = []
+        for date, suffix in ((start_date, 'start'), (end_date, 'end')):
+            snapshot_start, snapshot_end = data.get_snapshot(stock_start, stock_end, date)
+            snapshots.append(pd.DataFrame({
+                'participant': data.participant[snapshot_start:snapshot_end],
+                f'{suffix}DataDate': data.data_date[snapshot_start:snapshot_end],
+                f'{suffix}FracOfShare': data.frac_of_shares[snapshot_start:snapshot_end],
+            }).drop_duplicates('participant'))
+        df = snapshots[0].merge(snapshots[1], on='participant', how='outer')
+        df['startDataDate'] = date_int_to_str(df['startDataDate'].fillna(start_date).astype(np.int32))
+        df['endDataDate'] = date_int_to_str(df['endDataDate'].fillna(end_date).astype(np.int32))
+        df[['startFracOfShare', 'endFracOfShare']] = df[['startFracOfShare', 'endFracOfShare']].fillna(0)
+        df['ChangeInPercentShares'] = (df['endFracOfShare'] - df['startFracOfShare']).round(2)
+        df['ParticipantID'] = data.participant_ids[df['participant'].values]
+        df['ParticipantName'] = data.participant_names[df['participant'].values]
+        return (
+            df[[
+                'ParticipantID', 'ParticipantName', 'startDataDate', 'startFracOfShare',
+                'endDataDate', 'endFracOfShare', 'ChangeInPercentShares'
+            ]]
+            .sort_values('ChangeInPercentShares', ascending=False)
+            .reset_index(drop=True)
+        )
+
+
+columnar_engine = ColumnarEngine()
+
+
+def main():
+    from util import get_db_connection
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=COLUMNAR_DATA_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    conn = get_db_connection()
+    try:
+        export_columnar(conn, args.dir)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
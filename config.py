@@ -5,8 +5,6 @@ Created on Tue Jun 28 09:07:00 2022
 @author: ling
 """
 
-import datetime
-import pandas as pd
 import glob
 import os
 from dotenv import load_dotenv
@@ -15,22 +13,113 @@ from dotenv import load_dotenv
 load_dotenv()
 # DEV / PROD
 BASE_ENV = os.getenv("BASE_ENV")
-# QUEST / SQLITE
+# QUEST / SQLITE / PARQUET
 DB_TYPE = os.getenv("DB")
+# LEGACY / NORMALIZED (SQLite only, see sqlite_normalized.py)
+SQLITE_SCHEMA = os.getenv("SQLITE_SCHEMA", "LEGACY")
+# SQL / COLUMNAR (memory-mapped export of CCASS, see columnar_engine.py)
+QUERY_ENGINE = os.getenv("QUERY_ENGINE", "SQL")
+# SNAPSHOT / CHANGE_TABLE (SQLite only, transaction finder from CCASSChange, see change_table.py)
+DELTA_SOURCE = os.getenv("DELTA_SOURCE", "SNAPSHOT")
+# ON / OFF (latency histograms at /metrics, see metrics.py)
+METRICS_ENABLED = os.getenv("METRICS", "ON") == "ON"
+# SELENIUM / HTTP
+SCRAPER_ENGINE = os.getenv("SCRAPER_ENGINE", "SELENIUM")
 
-# Chrome
-try:
-    CHROME_DRIVER_PATH = glob.glob('chromedriver*.exe')[0]
-except:
-    raise Exception ("Chromedriver not found!")
+# Chrome (only needed by the SELENIUM engine)
+CHROME_DRIVER_PATH = next(iter(glob.glob('chromedriver*.exe')), None)
 
 HEADLESS = True
 
+# HTTP engine
+HTTP_TIMEOUT = 30
+HTTP_POOL_SIZE = 10
+HTTP_MAX_RETRIES = 3
+# Directory to record the search result pages to (None = do not record)
+SAVE_PAGE_SOURCE_DIR = os.getenv("SAVE_PAGE_SOURCE_DIR")
+
+# asyncio pipeline (async_scraper.py)
+ASYNC_MAX_CONCURRENCY = 50
+ASYNC_REQUESTS_PER_SECOND = 20
+ASYNC_MAX_RETRIES = 5
+
+# Scrape profiling (scrape_profiler.py), one JSON report per date run
+SCRAPE_REPORT_DIR = 'scrape_reports'
+# Fraction of pages run under cProfile (0 = none)
+SCRAPE_PROFILE_SAMPLE_RATE = float(os.getenv("SCRAPE_PROFILE_SAMPLE_RATE", 0))
+SCRAPE_PROFILE_TOP_FUNCTIONS = 30
+
+# Write buffer (batch_buffer.py), flushed when any limit is reached
+BUFFER_MAX_ROWS = 5000
+BUFFER_MAX_BYTES = 16 * 1024 * 1024
+BUFFER_MAX_SECONDS = 60
+
+# DB writer thread (db_writer.py)
+DB_WRITER_QUEUE_SIZE = 100
+DB_WRITER_MAX_BATCHES_PER_ROUND = 50
+
 # DB
 QUEST_DB_CONN_STR = "dbname='qdb' user='admin' host='127.0.0.1' port='8812' password='quest'"
+# ILP: line protocol over TCP / BATCH: multi-row inserts / ROW: one insert per row
+QUEST_INGEST_MODE = os.getenv("QUEST_INGEST_MODE", "BATCH")
+QUEST_ILP_HOST = '127.0.0.1'
+QUEST_ILP_PORT = 9009
+# Target size of one ILP send / one batched insert statement
+QUEST_ILP_BATCH_BYTES = 1024 * 1024
+QUEST_BATCH_STATEMENT_BYTES = 256 * 1024
+# Wait for QuestDB to confirm it has consumed the ILP lines on close
+QUEST_ILP_CLOSE_TIMEOUT_SECONDS = 60
 SQLITE_DB_NAME = 'ccass.db'
+# Parquet backend (parquet_store.py), one partition directory per DataDate
+PARQUET_DATA_DIR = 'parquet'
+PARQUET_COMPRESSION = 'zstd'
+# Files are sorted by StockCode, so smaller row groups let the StockCode statistics skip more
+PARQUET_ROW_GROUP_SIZE = 4096
+# A read overlapping a compaction is retried (parquet_store.py)
+PARQUET_READ_ATTEMPTS = 5
+SQLITE_CACHE_SIZE_MB = 64
+SQLITE_MMAP_SIZE_MB = 256
+# Compiled statements kept per SQLite connection (queries.py renders each query to the same text)
+SQLITE_STATEMENT_CACHE_SIZE = 256
+# Drop the SQLite indexes during a scrape run and rebuild them at the end (for bulk backfills)
+SQLITE_DEFER_INDEX_CREATION = False
+# Connection pool of the web app
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 30
+# Idle connections older than this are checked with "select 1" before reuse
+DB_POOL_HEALTH_CHECK_SECONDS = 30
 CCASS_TABLE_NAME = 'CCASS'
 STOCK_MAP_TABLE_NAME = 'StockMap'
+SCRAPE_PROGRESS_TABLE_NAME = 'ScrapeProgress'
+# Stock list and date bounds for the web app, updated by the scraper after each day
+STOCK_METADATA_TABLE_NAME = 'StockMetadata'
+# Learned HKEX holidays, skipped by the scheduler
+MARKET_HOLIDAY_TABLE_NAME = 'MarketHoliday'
+# Normalized SQLite schema
+CCASS_FACT_TABLE_NAME = 'CCASSFact'
+STOCK_TABLE_NAME = 'Stock'
+PARTICIPANT_TABLE_NAME = 'Participant'
+# Holdings change checkpoints (change_table.py)
+CCASS_CHANGE_TABLE_NAME = 'CCASSChange'
+STOCK_METADATA_COLUMNS = ['StockCode', 'StockName', 'NameDataDate', 'MinDataDate', 'MaxDataDate', 'RecordedAt']
+SCRAPE_PROGRESS_COLUMNS = ['DataDate', 'StockCode', 'Status', 'RowCount', 'AttemptCount', 'ElapsedMs', 'RecordedAt']
+# Columns written as ILP symbols / designated timestamps (QuestDB)
+QUEST_SYMBOL_COLUMNS = {
+    CCASS_TABLE_NAME: ['StockCode', 'ParticipantID'],
+    STOCK_MAP_TABLE_NAME: ['StockCode'],
+    SCRAPE_PROGRESS_TABLE_NAME: ['StockCode', 'Status'],
+    STOCK_METADATA_TABLE_NAME: ['StockCode'],
+}
+QUEST_DESIGNATED_TIMESTAMP_COLUMNS = {
+    CCASS_TABLE_NAME: 'DataDate',
+    STOCK_MAP_TABLE_NAME: 'DataDate',
+    SCRAPE_PROGRESS_TABLE_NAME: 'RecordedAt',
+    STOCK_METADATA_TABLE_NAME: 'RecordedAt',
+    MARKET_HOLIDAY_TABLE_NAME: 'RecordedAt',
+}
+CCASS_TABLE_COLUMNS = [
+    'DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'
+]
 
 
 # Scraping Config
@@ -41,10 +130,49 @@ MAIN_URL = "https://www.hkexnews.hk/sdw/search/searchsdw.aspx"
 # Data
 SHAREHOLDING_THRESHOLD_TO_SCRAPE = 0.1
 NUMBER_OF_STOCKS_SCRAPED = 2000
-DATE_RANGE_LIST = pd.bdate_range(
-    start=datetime.date.today() - datetime.timedelta(days=365),
-    end=datetime.date.today() - datetime.timedelta(days=1)
-).to_list()
+# Number of sessions / drivers sharing the stock list of one date (1 = date level threading)
+NUMBER_OF_SHARDS_PER_DATE = 1
+# Rolling window of data kept in the DB, older dates are pruned (scheduler.py)
+RETENTION_DAYS = 365
+# A date with this many empty pages and none with data is learned as a holiday
+HOLIDAY_MIN_EMPTY_PAGES = 50
+# A date seen without stocks is only learned as a holiday when seen again this much later
+# (one empty or degraded page is not enough)
+HOLIDAY_RECHECK_HOURS = 1
+
+# Columnar query engine
+COLUMNAR_DATA_DIR = 'columnar'
+# A new export is picked up within this interval
+COLUMNAR_RELOAD_CHECK_SECONDS = 60
+
+# Market screener (screener.py)
+# Stock partitions read in parallel, e.g. the number of cores of the DB host
+SCREENER_PARTITIONS = 6
+SCREENER_MAX_ROWS = 500
+
+# Benchmark (benchmark.py)
+BENCHMARK_DATA_DIR = 'benchmark'
+# Synthetic data shapes, production = one year of the full scrape
+BENCHMARK_SCALES = {
+    'small': dict(stocks=50, dates=60, participants=300, rows=100_000),
+    'medium': dict(stocks=500, dates=250, participants=800, rows=2_000_000),
+    'production': dict(stocks=2000, dates=250, participants=1500, rows=16_670_000),
+}
+# Fixed so that runs of different commits see the same data
+BENCHMARK_END_DATE = '2022-06-30'
+BENCHMARK_SEED = 0
+# Date range widths (business days) ending at the last date
+BENCHMARK_RANGE_DAYS = [5, 21, 63, 250]
+BENCHMARK_REPEAT = 10
+
+# Query result cache (query_cache.py)
+QUERY_CACHE_MAX_MB = 128
+# Directory for results evicted from memory (None = no spill)
+QUERY_CACHE_SPILL_DIR = os.getenv("QUERY_CACHE_SPILL_DIR")
+QUERY_CACHE_SPILL_MAX_MB = 1024
+QUERY_CACHE_VERSION_CHECK_SECONDS = 60
+# Print the hit rate every N lookups
+QUERY_CACHE_REPORT_EVERY = 100
 
 # Server config
 HOST = '0.0.0.0'
@@ -52,4 +180,17 @@ PORT = 8000
 
 # UI Config
 TREND_TAB_DATA_COLUMNS = ['DataDate', 'ParticipantID', 'ParticipantName', 'FracOfShares']
-CHANGES_DATA_COLUMNS = ['ParticipantID', 'ParticipantName', 'ChangeInPercentShares']
\ No newline at end of file
+TREND_TAB_PAGE_SIZE = 30
+# Participants plotted, by shareholding as of the end date
+TREND_TOP_PARTICIPANTS = 10
+# Traces longer than this are downsampled with LTTB (None = never)
+TREND_FIGURE_MAX_POINTS = 500
+CHANGES_DATA_COLUMNS = ['ParticipantID', 'ParticipantName', 'ChangeInPercentShares']
+SCREENER_DATA_COLUMNS = [
+    'Rank', 'StockCode', 'StockName', 'ParticipantID', 'ParticipantName',
+    'startFracOfShare', 'endFracOfShare', 'ChangeInPercentShares',
+]
+PAIRING_DATA_COLUMNS = [
+    'ParticipantID', 'ParticipantName', 'ChangeInPercentShares',
+    'CounterpartyID', 'CounterpartyName', 'CounterpartyChangeInPercentShares',
+]
\ No newline at end of file
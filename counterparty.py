@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Heuristic to find who a buyer / seller has possibly exchanged shares with
+
+The participants changing in the opposite direction are sorted by the size of their change. Then:
+    - the big ones (at least 50% of the change of the participant) are all included
+    - the smaller ones are included until their changes sum up to the change of the participant
+
+Since the big ones come first, the included participants are always a prefix of the sorted list,
+so its length is found with two binary searches on the sizes and their cumulative sums.
+This is done for every significant participant of a stock at once by get_counterparty_pairs.
+"""
+
+import numpy as np
+import pandas as pd
+
+from config import CHANGES_DATA_COLUMNS, PAIRING_DATA_COLUMNS
+from metrics import instrument
+
+SUM_TOLERANCE = 1e-9
+
+
+def sort_opposite_side(df_delta: pd.DataFrame, is_buyer: bool) -> pd.DataFrame:
+    # Sellers of a buyer / buyers of a seller, biggest change first (stable, like sorted())
+    changes = df_delta['ChangeInPercentShares'].values
+    df_side = df_delta[changes < 0] if is_buyer else df_delta[changes > 0]
+    return df_side.iloc[np.argsort(-np.abs(df_side['ChangeInPercentShares'].values), kind='stable')]
+
+def get_counterparty_counts(opposite_sizes: np.ndarray, participant_sizes: np.ndarray) -> np.ndarray:
+    # opposite_sizes: sorted descending; returns the length of the included prefix for each participant
+    prefix_sums = np.concatenate([[0], np.cumsum(opposite_sizes)])
+    # Changes summed before each position, i.e. the running sum when it is reached
+    running_sizes = prefix_sums[:-1]
+    big_counts = np.searchsorted(-opposite_sizes, -0.5 * participant_sizes, side='right')
+    # A smaller one is included while the running sum of the smaller ones is <= the change
+    # (with a tolerance, the changes are percentages rounded to 2 d.p.)
+    big_sums = prefix_sums[big_counts]
+    return np.maximum(
+        big_counts,
+        np.searchsorted(running_sizes, participant_sizes + big_sums + SUM_TOLERANCE, side='right')
+    )
+
+def find_counterparties(df_delta: pd.DataFrame, participant_change: float) -> pd.DataFrame:
+    df_opposite = sort_opposite_side(df_delta, participant_change > 0)
+    count = get_counterparty_counts(
+        np.abs(df_opposite['ChangeInPercentShares'].values),
+        np.array([abs(participant_change)])
+    )[0]
+    return df_opposite.iloc[:count]
+
+@instrument('transform')
+def get_counterparty_pairs(df_delta: pd.DataFrame, threshold: float) -> pd.DataFrame:
+    # Likely counterparties of every participant whose change is >= threshold (%) either way
+    df_delta = df_delta[CHANGES_DATA_COLUMNS]
+    pairs = []
+    for is_buyer in (True, False):
+        changes = df_delta['ChangeInPercentShares'].values
+        df_side = df_delta[changes >= threshold] if is_buyer else df_delta[changes <= -threshold]
+        df_opposite = sort_opposite_side(df_delta, is_buyer)
+        if df_side.empty or df_opposite.empty:
+            continue
+        df_side = df_side.iloc[np.argsort(-np.abs(df_side['ChangeInPercentShares'].values), kind='stable')]
+        counts = get_counterparty_counts(
+            np.abs(df_opposite['ChangeInPercentShares'].values),
+            np.abs(df_side['ChangeInPercentShares'].values)
+        )
+        # Participant i is paired with the first counts[i] of the opposite side
+        side_idx = np.repeat(np.arange(len(df_side)), counts)
+        opposite_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        df_pairs = df_side.iloc[side_idx].reset_index(drop=True)
+        df_counterparties = df_opposite.iloc[opposite_idx].reset_index(drop=True)
+        df_pairs['CounterpartyID'] = df_counterparties['ParticipantID']
+        df_pairs['CounterpartyName'] = df_counterparties['ParticipantName']
+        df_pairs['CounterpartyChangeInPercentShares'] = df_counterparties['ChangeInPercentShares']
+        pairs.append(df_pairs)
+    if not pairs:
+        return pd.DataFrame(columns=PAIRING_DATA_COLUMNS)
+    return pd.concat(pairs, ignore_index=True)[PAIRING_DATA_COLUMNS]
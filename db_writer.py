@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Single writer thread owning the DB connection for the scrapers
+
+Scrapers submit parsed batches to a bounded queue (a full queue blocks them, i.e. backpressure).
+The writer drains whatever is queued, groups it by table and writes each table once per round.
+Reads needed by the scrapers (e.g. progress journal) go through the same thread via call().
+
+The stock days of a failed CCASS write are journaled as FAILED rather than DONE when their
+progress records come in, so the next run scrapes them again.
+
+Any other error stops the writer: the calls waiting on it fail, and submit() and call() raise
+from then on, rather than the scrapers blocking on a thread that is gone.
+"""
+
+import threading
+import traceback
+import queue
+from concurrent.futures import Future
+
+import pandas as pd
+
+from config import CCASS_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME, DB_WRITER_QUEUE_SIZE, DB_WRITER_MAX_BATCHES_PER_ROUND
+from config import SQLITE_DEFER_INDEX_CREATION, DELTA_SOURCE
+from util import get_db_connection, create_table, store_df_to_db, store_scrape_progress
+from util import create_index_if_not_exist, drop_index_for_bulk_load
+from change_table import update_change_table
+
+
+class DBWriter(threading.Thread):
+
+    def __init__(self, queue_size: int = DB_WRITER_QUEUE_SIZE,
+                 max_batches_per_round: int = DB_WRITER_MAX_BATCHES_PER_ROUND,
+                 defer_index_creation: bool = SQLITE_DEFER_INDEX_CREATION):
+        super().__init__(name='db-writer', daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_batches_per_round = max_batches_per_round
+        # Bulk backfill: drop the SQLite indexes now and rebuild them once when closing
+        self.defer_index_creation = defer_index_creation
+        self.conn = None
+        self.ready = threading.Event()
+        self.error = None
+        self.rows_written = 0
+        self.rounds = 0
+        # (DataDate, StockCode) of CCASS rows that could not be written, until their progress is journaled
+        self.failed_stock_days = set()
+        self.write_errors = 0
+
+    def __enter__(self):
+        self.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, df: pd.DataFrame, table_name: str):
+        # Blocks when the writer falls behind
+        if self.error:
+            raise self.error
+        if not df.empty:
+            self.queue.put(('write', table_name, df))
+
+    def call(self, func):
+        # Run func(connection) on the writer thread and wait for the result
+        if self.error:
+            raise self.error
+        future = Future()
+        self.queue.put(('call', func, future))
+        return future.result()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        try:
+            self.conn = get_db_connection()
+            create_table(self.conn)
+            if self.defer_index_creation:
+                drop_index_for_bulk_load(self.conn)
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+        running = True
+        while running:
+            items = [self.queue.get()]
+            while len(items) < self.max_batches_per_round:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                running = self.process_round(items)
+            except Exception as e:
+                print("DB writer: stopped on an error")
+                traceback.print_exc()
+                self.error = e
+                self.fail_calls(items)
+                running = False
+                if None not in items:
+                    self.fail_until_closed()
+        try:
+            if self.defer_index_creation:
+                print("DB writer: rebuilding indexes")
+                create_index_if_not_exist(self.conn)
+        finally:
+            self.conn.close()
+        print(f"DB writer: wrote {self.rows_written} rows in {self.rounds} rounds, {self.write_errors} failed writes")
+
+    def process_round(self, items: list) -> bool:
+        # False once close() was called
+        running = True
+        batches = {}
+        for item in items:
+            if item is None:
+                running = False
+            elif item[0] == 'write':
+                _, table_name, df = item
+                batches.setdefault(table_name, []).append(df)
+            else:
+                # Pending writes go first so reads see them
+                self.write_batches(batches)
+                batches = {}
+                _, func, future = item
+                try:
+                    future.set_result(func(self.conn))
+                except Exception as e:
+                    future.set_exception(e)
+        self.write_batches(batches)
+        return running
+
+    def fail_calls(self, items: list):
+        for item in items:
+            if item is not None and item[0] == 'call' and not item[2].done():
+                item[2].set_exception(self.error)
+
+    def fail_until_closed(self):
+        # Keeps taking from the queue, so a scraper blocked on a full queue or in call() is released
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.fail_calls([item])
+
+    def write_batches(self, batches: dict):
+        if not batches:
+            return
+        # Progress journal last, so it never gets ahead of the rows it describes
+        for table_name in sorted(batches, key=lambda name: name == SCRAPE_PROGRESS_TABLE_NAME):
+            try:
+                df = pd.concat(batches[table_name], ignore_index=True)
+                if table_name == SCRAPE_PROGRESS_TABLE_NAME:
+                    df = self.mark_failed_stock_days(df)
+                    store_scrape_progress(df, self.conn)
+                    if DELTA_SOURCE == 'CHANGE_TABLE':
+                        # The stock days recorded as done are fully loaded by now
+                        update_change_table(self.conn, df)
+                else:
+                    store_df_to_db(df, self.conn, table_name)
+                    self.rows_written += len(df)
+            except Exception:
+                self.write_errors += 1
+                if table_name == CCASS_TABLE_NAME:
+                    for df_batch in batches[table_name]:
+                        self.failed_stock_days.update(zip(df_batch['DataDate'], df_batch['StockCode']))
+                # A failed StockMap write needs nothing more: a date without a stock list is scraped
+                # again from its list page, and its stock days already done are skipped
+                print(f"DB writer: failed to write {sum(map(len, batches[table_name]))} rows into {table_name}")
+                traceback.print_exc()
+        self.rounds += 1
+
+    def mark_failed_stock_days(self, df_progress: pd.DataFrame) -> pd.DataFrame:
+        # Progress of stock days whose rows were not written: FAILED, so they are retried
+        if not self.failed_stock_days:
+            return df_progress
+        keys = list(zip(df_progress['DataDate'], df_progress['StockCode']))
+        failed = pd.Series([key in self.failed_stock_days for key in keys], index=df_progress.index)
+        failed &= df_progress['Status'] == 'DONE'
+        if failed.any():
+            print(f"DB writer: journaling {failed.sum()} stock days as FAILED as their rows were not written")
+            df_progress = df_progress.copy()
+            df_progress.loc[failed, ['Status', 'RowCount']] = ['FAILED', 0]
+        self.failed_stock_days.difference_update(keys)
+        return df_progress
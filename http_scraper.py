@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Selenium-free scraping engine
+
+It replays the ASP.NET form post of searchsdw.aspx over a keep-alive
+requests.Session, so no browser is needed per thread.
+Select it with SCRAPER_ENGINE=HTTP in the .env file.
+
+The urls can be overridden (e.g. pointing to a local server serving recorded pages)
+"""
+
+import datetime
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from config import HTTP_TIMEOUT, HTTP_POOL_SIZE, HTTP_MAX_RETRIES, SAVE_PAGE_SOURCE_DIR
+from scraper import CCASSScraper
+
+
+def create_http_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET', 'POST'],
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
+    })
+    return session
+
+
+def parse_form_fields(page_source: str) -> dict:
+    # Only parse <input> tags, the rest of the page is not needed
+    soup = BeautifulSoup(page_source, 'lxml', parse_only=SoupStrainer('input'))
+    return {
+        tag['name']: tag.get('value', '')
+        for tag in soup.find_all('input')
+        if tag.get('name') and tag.get('type', 'text') != 'submit'
+    }
+
+
+class CCASSHttpScraper(CCASSScraper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self.form_fields = {}
+        self.page_source = ''
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.session:
+            self.session.close()
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+    def initialize_client(self):
+        if not self.session:
+            self.session = create_http_session()
+
+    def fetch_stock_code_list_page(self, url: str) -> str:
+        response = self.session.get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+    def open_search_page(self, date: datetime.date):
+        response = self.session.get(self.main_url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        # Hidden fields (__VIEWSTATE, __EVENTVALIDATION etc.) are posted back as is
+        self.form_fields = parse_form_fields(response.text)
+
+    def search_stock(self, date: datetime.date, stock_code: str):
+        form_data = {
+            **self.form_fields,
+            '__EVENTTARGET': 'btnSearch',
+            '__EVENTARGUMENT': '',
+            'txtShareholdingDate': date.strftime('%Y/%m/%d'),
+            'txtStockCode': stock_code,
+        }
+        response = self.session.post(self.main_url, data=form_data, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        self.page_source = response.text
+        if SAVE_PAGE_SOURCE_DIR:
+            # Recorded pages can be used as fixtures for bench_parser.py or a stub server
+            file_name = f"{date.strftime('%Y%m%d')}_{stock_code}.html"
+            with open(os.path.join(SAVE_PAGE_SOURCE_DIR, file_name), 'w', encoding='utf-8') as f:
+                f.write(self.page_source)
+
+    def wait_for_search_result(self):
+        # The response is complete once post() returns
+        pass
+
+    def get_page_source(self) -> str:
+        return self.page_source
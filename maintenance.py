@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Maintenance tasks kept out of the web app startup
+
+    --indexes   create the SQLite indexes and refresh the planner statistics
+    --metadata  rebuild StockMetadata from the data, e.g. for a DB scraped before it existed
+    --partition-quest  convert QuestDB CCASS / StockMap tables created before they were partitioned by
+                       DataDate, so that the retention window can drop partitions (scheduler.py)
+
+Run --indexes and --metadata:
+    python maintenance.py
+"""
+
+import argparse
+import time
+
+import pandas as pd
+import psycopg2
+
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, STOCK_METADATA_COLUMNS
+from parquet_store import ParquetStore
+from util import get_db_connection, create_table, create_index_if_not_exist
+from util import load_stocks_with_data_by_date, merge_stock_metadata, store_stock_metadata
+
+
+def rebuild_stock_metadata(conn):
+    start_time = time.perf_counter()
+    if isinstance(conn, ParquetStore):
+        date_strs = conn.get_partition_dates(STOCK_MAP_TABLE_NAME)
+    else:
+        date_strs = (
+            pd.to_datetime(pd.read_sql_query(f"select distinct DataDate from {STOCK_MAP_TABLE_NAME}", conn)['DataDate'])
+            .dt.strftime('%Y-%m-%d').tolist()
+        )
+    df_days = pd.concat(
+        [load_stocks_with_data_by_date(date_str, conn) for date_str in date_strs]
+        or [pd.DataFrame(columns=['DataDate', 'StockCode', 'StockName'])]
+    )
+    df_metadata = merge_stock_metadata(pd.DataFrame(columns=STOCK_METADATA_COLUMNS), df_days)
+    store_stock_metadata(df_metadata, conn, replace=True)
+    print(f"Rebuilt metadata of {len(df_metadata)} stocks over {len(date_strs)} dates in {time.perf_counter() - start_time:.1f}s")
+
+def partition_quest_tables(conn):
+    # Copies each table into one with DataDate as the designated timestamp, then swaps them
+    if not isinstance(conn, psycopg2.extensions.connection):
+        print("--partition-quest only applies to QuestDB")
+        return
+    for table_name, columns, index_columns in (
+        (
+            CCASS_TABLE_NAME,
+            'StockCode, ParticipantID, ParticipantName, ParticipantAddress, Shareholding, FracOfShares',
+            ['StockCode']
+        ),
+        (STOCK_MAP_TABLE_NAME, 'StockCode, StockName', []),
+    ):
+        start_time = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.execute(f"select designatedTimestamp, partitionBy from tables() where name = '{table_name}'")
+        designated_timestamp, partition_by = cursor.fetchone()
+        if designated_timestamp == 'DataDate' and partition_by == 'DAY':
+            print(f"{table_name} is partitioned by DataDate already")
+            cursor.close()
+            continue
+        indexes = ''.join(f", index({col})" for col in index_columns)
+        cursor.execute(f"""
+            CREATE TABLE {table_name}_partitioned AS (
+              select cast(DataDate as timestamp) DataDate, {columns} from {table_name} order by DataDate
+            ){indexes} timestamp(DataDate) PARTITION BY DAY
+        """)
+        cursor.execute(f"DROP TABLE {table_name}")
+        cursor.execute(f"RENAME TABLE {table_name}_partitioned TO {table_name}")
+        conn.commit()
+        cursor.close()
+        print(f"Partitioned {table_name} by DataDate in {time.perf_counter() - start_time:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--indexes', action='store_true')
+    parser.add_argument('--metadata', action='store_true')
+    parser.add_argument('--partition-quest', action='store_true')
+    args = parser.parse_args()
+    run_all = not (args.indexes or args.metadata or args.partition_quest)
+
+    conn = get_db_connection()
+    try:
+        if args.partition_quest:
+            partition_quest_tables(conn)
+        create_table(conn)
+        if args.indexes or run_all:
+            start_time = time.perf_counter()
+            create_index_if_not_exist(conn)
+            print(f"Created indexes in {time.perf_counter() - start_time:.1f}s")
+        if args.metadata or run_all:
+            rebuild_stock_metadata(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
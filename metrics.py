@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Latency, row count and payload size histograms, served in the Prometheus text format at /metrics
+
+    ccass_query_*      query functions of util.py (SQL and the pandas work inside them)
+    ccass_transform_*  reshaping of query results for the UI (figure, paging, pairing)
+    ccass_callback_*   Dash callbacks (query cache, queries and transforms)
+    ccass_request_*    Dash update requests, i.e. a callback plus the JSON serialization of its output
+
+Labels: name, backend and range (width of the date range, bucketed to keep the series few).
+An observation is a bisect and a few additions under a lock, so it is left on by default (METRICS=OFF to disable).
+"""
+
+import bisect
+import datetime
+import functools
+import inspect
+import threading
+import time
+
+import pandas as pd
+from flask import Response, g, request
+
+from config import METRICS_ENABLED, DB_TYPE, QUERY_ENGINE
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (10, 100, 1000, 10_000, 100_000, 1_000_000)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9)) # 1KB to 64MB
+# (max days, label) of the range label
+RANGE_WIDTHS = [(7, '1w'), (31, '1m'), (92, '3m'), (366, '1y')]
+LABEL_NAMES = ('name', 'backend', 'range')
+
+BACKEND = 'COLUMNAR' if QUERY_ENGINE == 'COLUMNAR' else (DB_TYPE or 'QUEST')
+DASH_UPDATE_PATH = '/_dash-update-component'
+
+
+class Histogram:
+
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> [count per bucket (not cumulative) ..., count above the last bucket, sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(counts) for labels, counts in self.series.items()}
+        for labels, counts in sorted(series.items()):
+            label_str = ','.join(f'{k}="{escape_label(v)}"' for k, v in zip(LABEL_NAMES, labels))
+            cumulative = 0
+            for bucket, count in zip((*self.buckets, '+Inf'), counts[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_str},le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_str}}} {counts[-1]}')
+            lines.append(f'{self.name}_count{{{label_str}}} {cumulative}')
+        return lines
+
+
+HISTOGRAMS = {}
+for kind in ('query', 'transform', 'callback'):
+    HISTOGRAMS[f'{kind}_seconds'] = Histogram(f'ccass_{kind}_seconds', f'Latency of {kind} functions', LATENCY_BUCKETS)
+    HISTOGRAMS[f'{kind}_rows'] = Histogram(f'ccass_{kind}_rows', f'Rows returned by {kind} functions', ROW_BUCKETS)
+HISTOGRAMS['request_seconds'] = Histogram('ccass_request_seconds', 'Latency of Dash update requests', LATENCY_BUCKETS)
+HISTOGRAMS['response_bytes'] = Histogram('ccass_response_bytes', 'Size of Dash update responses', SIZE_BUCKETS)
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def get_range_label(start_date, end_date) -> str:
+    if not start_date or not end_date:
+        return 'none'
+    try:
+        days = (
+            datetime.date.fromisoformat(str(end_date)[:10]) - datetime.date.fromisoformat(str(start_date)[:10])
+        ).days
+    except ValueError:
+        return 'none'
+    return next((label for max_days, label in RANGE_WIDTHS if days <= max_days), '>1y')
+
+def count_rows(result) -> int:
+    # DataFrames and DataTable records; the lists in a tuple of outputs are added up
+    if isinstance(result, (pd.DataFrame, list)):
+        return len(result)
+    if isinstance(result, tuple):
+        return sum(len(r) for r in result if isinstance(r, (pd.DataFrame, list)))
+    return 0
+
+def instrument(kind: str, start_arg: str = None, end_arg: str = None):
+    # start_arg / end_arg: names of the date arguments giving the range label
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        signature = inspect.signature(func)
+        latency = HISTOGRAMS[f'{kind}_seconds']
+        rows = HISTOGRAMS[f'{kind}_rows']
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            result = func(*args, **kwargs)
+            elapsed = time.perf_counter() - start_time
+            range_label = 'none'
+            if start_arg:
+                arguments = signature.bind_partial(*args, **kwargs).arguments
+                range_label = get_range_label(arguments.get(start_arg), arguments.get(end_arg))
+            labels = (func.__name__, BACKEND, range_label)
+            latency.observe(labels, elapsed)
+            rows.observe(labels, count_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+def get_request_labels(body: dict) -> tuple:
+    # Output of the callback and the date range among its inputs / states
+    dates = {
+        item.get('property'): item.get('value')
+        for item in [*body.get('inputs', []), *body.get('state', [])]
+        if isinstance(item, dict)
+    }
+    return body.get('output', ''), BACKEND, get_range_label(dates.get('start_date'), dates.get('end_date'))
+
+def render_metrics() -> str:
+    return '\n'.join(line for histogram in HISTOGRAMS.values() for line in histogram.render()) + '\n'
+
+def register_metrics(server):
+    # Times the Dash update requests of the Flask server and adds the /metrics route
+    if not METRICS_ENABLED:
+        return
+
+    @server.before_request
+    def start_request_timer():
+        g.metrics_start_time = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        if request.path.endswith(DASH_UPDATE_PATH) and 'metrics_start_time' in g:
+            labels = get_request_labels(request.get_json(silent=True) or {})
+            HISTOGRAMS['request_seconds'].observe(labels, time.perf_counter() - g.metrics_start_time)
+            HISTOGRAMS['response_bytes'].observe(labels, response.calculate_content_length() or 0)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
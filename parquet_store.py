@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+File based storage backend (DB=PARQUET)
+
+Each table is a directory of Parquet files with one hive partition per DataDate:
+    parquet/CCASS/DataDate=2022-07-04/part-<id>.parquet
+
+Files are zstd compressed, sorted by StockCode and written with row group statistics,
+so a query on one stock and a date range only opens the partitions of the range
+and only decodes the row groups (and columns) it needs.
+
+Every write appends a new file (written under a hidden name, then renamed, so readers
+never see a partial file). The partitions written by a store are compacted into one
+file when it is closed, i.e. at the end of a scrape run:
+    - the merged file is written to a hidden directory next to the partition
+    - the partition directory is swapped with it (two renames) and the old one removed
+    - a per-table generation number is odd during the swap; a read that started before or during
+      a swap sees the generation change (or its files vanish) and reads again
+A swap interrupted by a crash is rolled back by create_tables().
+"""
+
+import os
+import shutil
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from config import (
+    PARQUET_DATA_DIR, PARQUET_COMPRESSION, PARQUET_ROW_GROUP_SIZE, TREND_TOP_PARTICIPANTS,
+    PARQUET_READ_ATTEMPTS, CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME
+)
+
+# Schemas without the DataDate partition column
+TABLE_SCHEMAS = {
+    CCASS_TABLE_NAME: pa.schema([
+        ('StockCode', pa.string()),
+        ('ParticipantID', pa.string()),
+        ('ParticipantName', pa.string()),
+        ('ParticipantAddress', pa.string()),
+        ('Shareholding', pa.int64()),
+        ('FracOfShares', pa.float64()),
+    ]),
+    STOCK_MAP_TABLE_NAME: pa.schema([
+        ('StockCode', pa.string()),
+        ('StockName', pa.string()),
+    ]),
+    SCRAPE_PROGRESS_TABLE_NAME: pa.schema([
+        ('StockCode', pa.string()),
+        ('Status', pa.string()),
+        ('RowCount', pa.int64()),
+        ('AttemptCount', pa.int64()),
+        ('ElapsedMs', pa.float64()),
+        ('RecordedAt', pa.timestamp('us')),
+    ]),
+}
+SORT_COLUMNS = {
+    CCASS_TABLE_NAME: ['StockCode', 'ParticipantID'],
+    STOCK_MAP_TABLE_NAME: ['StockCode'],
+    SCRAPE_PROGRESS_TABLE_NAME: ['StockCode', 'RecordedAt'],
+}
+PARTITIONING = ds.partitioning(pa.schema([('DataDate', pa.string())]), flavor='hive')
+# Hidden from readers (pyarrow ignores names starting with '.' or '_')
+COMPACTED_SUFFIX = '.compacted'
+OLD_SUFFIX = '.old'
+GENERATION_FILE_NAME = '_compaction_generation'
+
+
+class ParquetStore:
+    """Stands in for the DB connection of the other backends"""
+
+    def __init__(self, data_dir: str = PARQUET_DATA_DIR):
+        self.data_dir = data_dir
+        # (table, DataDate) written by this store, compacted on close()
+        self.dirty_partitions = set()
+
+    def create_tables(self):
+        for table_name in TABLE_SCHEMAS:
+            os.makedirs(os.path.join(self.data_dir, table_name), exist_ok=True)
+            self.recover_partitions(table_name)
+
+    def recover_partitions(self, table_name: str):
+        # Roll back the partition swaps of a compaction interrupted by a crash
+        table_dir = os.path.join(self.data_dir, table_name)
+        for name in sorted(os.listdir(table_dir)):
+            path = os.path.join(table_dir, name)
+            if name.startswith('.DataDate=') and name.endswith(OLD_SUFFIX):
+                partition_dir = os.path.join(table_dir, name[1:-len(OLD_SUFFIX)])
+                if os.path.isdir(partition_dir):
+                    shutil.rmtree(path)
+                else:
+                    os.replace(path, partition_dir)
+            elif name.startswith('.DataDate=') and name.endswith(COMPACTED_SUFFIX):
+                shutil.rmtree(path)
+        generation = self.get_compaction_generation(table_name)
+        if generation % 2:
+            self.set_compaction_generation(table_name, generation + 1)
+
+    def get_compaction_generation(self, table_name: str) -> int:
+        try:
+            with open(os.path.join(self.data_dir, table_name, GENERATION_FILE_NAME)) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def set_compaction_generation(self, table_name: str, generation: int):
+        path = os.path.join(self.data_dir, table_name, GENERATION_FILE_NAME)
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(str(generation))
+        os.replace(f'{path}.tmp', path)
+
+    def get_partition_dir(self, table_name: str, date_str: str) -> str:
+        return os.path.join(self.data_dir, table_name, f'DataDate={date_str}')
+
+    def get_partition_dates(self, table_name: str) -> list:
+        # Partition names only, no file is opened
+        table_dir = os.path.join(self.data_dir, table_name)
+        if not os.path.isdir(table_dir):
+            return []
+        return sorted(name.split('=', 1)[1] for name in os.listdir(table_dir) if name.startswith('DataDate='))
+
+    def get_partition_files(self, table_name: str, date_str: str) -> list:
+        partition_dir = self.get_partition_dir(table_name, date_str)
+        return [
+            os.path.join(partition_dir, name) for name in sorted(os.listdir(partition_dir))
+            if not name.startswith(('.', '_'))
+        ]
+
+    def write_file(self, table: pa.Table, partition_dir: str) -> str:
+        os.makedirs(partition_dir, exist_ok=True)
+        name = f'part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet'
+        # Hidden while being written, pyarrow ignores files starting with '.'
+        tmp_path = os.path.join(partition_dir, f'.{name}')
+        pq.write_table(
+            table, tmp_path,
+            compression=PARQUET_COMPRESSION,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+            write_statistics=True
+        )
+        path = os.path.join(partition_dir, name)
+        os.replace(tmp_path, path)
+        return path
+
+    def append(self, df: pd.DataFrame, table_name: str):
+        schema = TABLE_SCHEMAS[table_name]
+        df = df.assign(DataDate=pd.to_datetime(df['DataDate']).dt.strftime('%Y-%m-%d'))
+        for date_str, df_date in df.groupby('DataDate'):
+            df_date = df_date.sort_values(SORT_COLUMNS[table_name])
+            table = pa.Table.from_pandas(df_date[schema.names], schema=schema, preserve_index=False)
+            self.write_file(table, self.get_partition_dir(table_name, date_str))
+            self.dirty_partitions.add((table_name, date_str))
+
+    def read(self, table_name: str, columns: list = None, filter=None) -> pd.DataFrame:
+        schema = TABLE_SCHEMAS[table_name].append(pa.field('DataDate', pa.string()))
+        columns = columns or schema.names
+        table_dir = os.path.join(self.data_dir, table_name)
+        if not os.path.isdir(table_dir):
+            return pd.DataFrame(columns=columns)
+        for attempt in range(PARQUET_READ_ATTEMPTS):
+            generation = self.get_compaction_generation(table_name)
+            try:
+                dataset = ds.dataset(table_dir, schema=schema, format='parquet', partitioning=PARTITIONING)
+                df = dataset.to_table(columns=columns, filter=filter).to_pandas()
+            except FileNotFoundError:
+                # The files listed were swapped out by a compaction
+                if attempt == PARQUET_READ_ATTEMPTS - 1:
+                    raise
+            else:
+                if generation % 2 == 0 and self.get_compaction_generation(table_name) == generation:
+                    return df
+            time.sleep(0.05 * 2 ** attempt)
+        raise RuntimeError(f"{table_name} kept being compacted during {PARQUET_READ_ATTEMPTS} reads")
+
+    def read_partition(self, table_name: str, date_str: str, columns: list = None) -> pd.DataFrame:
+        return self.read(table_name, columns=columns, filter=ds.field('DataDate') == date_str)
+
+    def read_file(self, table_name: str) -> pd.DataFrame:
+        # Small tables without partitions, stored as one file
+        path = os.path.join(self.data_dir, f'{table_name}.parquet')
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        return pq.read_table(path).to_pandas()
+
+    def replace_file(self, df: pd.DataFrame, table_name: str):
+        tmp_path = os.path.join(self.data_dir, f'.{table_name}.parquet')
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path, compression=PARQUET_COMPRESSION)
+        os.replace(tmp_path, os.path.join(self.data_dir, f'{table_name}.parquet'))
+
+    def drop_partitions_before(self, table_name: str, date_str: str) -> int:
+        date_strs = [d for d in self.get_partition_dates(table_name) if d < date_str]
+        for d in date_strs:
+            shutil.rmtree(self.get_partition_dir(table_name, d))
+            self.dirty_partitions.discard((table_name, d))
+        return len(date_strs)
+
+    def compact(self, table_name: str, date_str: str):
+        files = self.get_partition_files(table_name, date_str)
+        if len(files) <= 1:
+            return
+        df = pq.ParquetDataset(files).read().to_pandas()
+        df = df.sort_values(SORT_COLUMNS[table_name])
+        if table_name == SCRAPE_PROGRESS_TABLE_NAME:
+            # Only the latest record of each stock is ever read
+            df = df.drop_duplicates('StockCode', keep='last')
+        schema = TABLE_SCHEMAS[table_name]
+        table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+        partition_dir = self.get_partition_dir(table_name, date_str)
+        table_dir, name = os.path.split(partition_dir)
+        compacted_dir = os.path.join(table_dir, f'.{name}{COMPACTED_SUFFIX}')
+        old_dir = os.path.join(table_dir, f'.{name}{OLD_SUFFIX}')
+        shutil.rmtree(compacted_dir, ignore_errors=True)
+        self.write_file(table, compacted_dir)
+        generation = self.get_compaction_generation(table_name)
+        self.set_compaction_generation(table_name, generation + 1)
+        os.replace(partition_dir, old_dir)
+        os.replace(compacted_dir, partition_dir)
+        self.set_compaction_generation(table_name, generation + 2)
+        shutil.rmtree(old_dir)
+
+    def commit(self):
+        # Every append is durable once its file is renamed
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        for table_name, date_str in sorted(self.dirty_partitions):
+            self.compact(table_name, date_str)
+        self.dirty_partitions = set()
+
+
+def get_snapshot_date(store: ParquetStore, date_str: str) -> str:
+    # Latest date with a stock list on or before date_str, like max(DataDate) on StockMap
+    dates = [d for d in store.get_partition_dates(STOCK_MAP_TABLE_NAME) if d <= date_str]
+    return dates[-1] if dates else None
+
+def read_shareholding(store: ParquetStore, stock_code: str, start_date_str: str,
+    end_date_str: str, columns: list) -> pd.DataFrame:
+    return store.read(
+        CCASS_TABLE_NAME,
+        columns=columns,
+        filter=(
+            (ds.field('StockCode') == stock_code) &
+            (ds.field('DataDate') >= start_date_str) &
+            (ds.field('DataDate') <= end_date_str)
+        )
+    )
+
+def read_since(store: ParquetStore, table_name: str, start_date_str: str, columns: list) -> pd.DataFrame:
+    return store.read(table_name, columns=columns, filter=ds.field('DataDate') >= start_date_str)
+
+def read_shareholding_snapshots(store: ParquetStore, date_strs: list, stock_codes: list,
+    columns: list) -> pd.DataFrame:
+    return store.read(
+        CCASS_TABLE_NAME,
+        columns=columns,
+        filter=ds.field('DataDate').isin(date_strs) & ds.field('StockCode').isin(stock_codes)
+    )
+
+def get_shareholding_time_series_for_top_participants(store: ParquetStore, stock_code: str,
+    start_date_str: str, end_date_str: str, columns: list) -> pd.DataFrame:
+    snapshot_date = get_snapshot_date(store, end_date_str)
+    if snapshot_date is None:
+        return pd.DataFrame(columns=columns)
+    df_snapshot = read_shareholding(store, stock_code, snapshot_date, snapshot_date, ['ParticipantID', 'Shareholding'])
+    # Ties included, like rank() <= N
+    top_participants = df_snapshot.nlargest(TREND_TOP_PARTICIPANTS, 'Shareholding', keep='all')['ParticipantID']
+
+    df = read_shareholding(store, stock_code, start_date_str, end_date_str, columns)
+    df = df[df['ParticipantID'].isin(top_participants)]
+    return df.sort_values(['DataDate', 'FracOfShares'], ascending=[True, False]).reset_index(drop=True)
+
+def get_shareholding_delta_for_transaction_finder(store: ParquetStore, stock_code: str,
+    start_date_str: str, end_date_str: str) -> pd.DataFrame:
+    snapshots = []
+    for date_str, suffix in ((start_date_str, 'start'), (end_date_str, 'end')):
+        snapshot_date = get_snapshot_date(store, date_str)
+        columns = ['ParticipantID', 'ParticipantName', 'DataDate', 'FracOfShares']
+        if snapshot_date is None:
+            df = pd.DataFrame(columns=columns)
+        else:
+            df = read_shareholding(store, stock_code, snapshot_date, snapshot_date, columns)
+        snapshots.append(df.rename(columns={
+            'ParticipantName': f'{suffix}ParticipantName',
+            'DataDate': f'{suffix}DataDate',
+            'FracOfShares': f'{suffix}FracOfShare',
+        }))
+    df = snapshots[0].merge(snapshots[1], on='ParticipantID', how='outer')
+    df['ParticipantName'] = df['endParticipantName'].fillna(df['startParticipantName'])
+    df['startDataDate'] = df['startDataDate'].fillna(start_date_str)
+    df['endDataDate'] = df['endDataDate'].fillna(end_date_str)
+    df[['startFracOfShare', 'endFracOfShare']] = df[['startFracOfShare', 'endFracOfShare']].fillna(0)
+    df['ChangeInPercentShares'] = (df['endFracOfShare'] - df['startFracOfShare']).round(2)
+    return (
+        df[[
+            'ParticipantID', 'ParticipantName', 'startDataDate', 'startFracOfShare',
+            'endDataDate', 'endFracOfShare', 'ChangeInPercentShares'
+        ]]
+        .sort_values('ChangeInPercentShares', ascending=False)
+        .reset_index(drop=True)
+    )
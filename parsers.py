@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Parsers for the pages scraped from HKEX
+
+parse_shareholding_html uses compiled XPath over lxml and builds typed columns in one pass.
+parse_shareholding_html_bs4 is the original BeautifulSoup implementation, kept as a reference
+for bench_parser.py
+"""
+
+import datetime
+
+import pandas as pd
+import numpy as np
+from bs4 import BeautifulSoup
+from lxml import etree, html
+
+from config import SHAREHOLDING_THRESHOLD_TO_SCRAPE, NUMBER_OF_STOCKS_SCRAPED
+
+# Data rows only (header row has <th> instead of <td>)
+SHAREHOLDING_ROWS_XPATH = etree.XPath(
+    '//div[contains(@class, "search-details-table-container")]//tr[td]'
+)
+SHAREHOLDING_CELLS_XPATH = etree.XPath('td/div[@class="mobile-list-body"]')
+
+
+def parse_stock_code_list_html(page_source: str, date: datetime.date) -> pd.DataFrame:
+    soup = BeautifulSoup(page_source, 'lxml')
+
+    table = soup.find('table')
+    table_columns = [
+        'StockCode', 'StockName'    
+    ]
+    # Skipping header row (hence index starts from 1)
+    table_rows = table.find_all('tr')[1:NUMBER_OF_STOCKS_SCRAPED+2]
+    table_rows_data = []
+    for table_row in table_rows:
+        table_rows_data.append([td.get_text(strip=True) for td in table_row.find_all('td')])
+    df = pd.DataFrame(data=table_rows_data, columns=table_columns).dropna()
+    df['StockName'] = df['StockName'].str.replace("'", '')
+    df['DataDate'] = date.strftime('%Y-%m-%d')
+    df = df[['DataDate', *table_columns]]
+    return df
+
+def parse_shareholding_html_bs4(page_source: str, date: datetime.date, stock_code: str) -> pd.DataFrame:
+    soup = BeautifulSoup(page_source, 'lxml')
+
+    table = soup.find(attrs={'class':'search-details-table-container table-mobile-list-container'})
+    table_columns = [
+        'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'    
+    ]
+    if not table:
+        # print("Skipping as table not found")
+        return pd.DataFrame()
+    table_rows = table.find_all('tr')[1:]
+    table_rows_data = []
+    for table_row in table_rows:
+        table_rows_data.append([td.get_text(strip=True) for td in table_row.find_all('div', attrs={'class': 'mobile-list-body'})])
+    df = pd.DataFrame(data=table_rows_data, columns=table_columns[:len(table_rows_data[0])])
+    df['ParticipantID'] = np.where(df['ParticipantID']=='', 'None', df['ParticipantID'])
+    df['ParticipantName'] = df['ParticipantName'].str.replace("'", '')
+    df['ParticipantAddress'] = df['ParticipantAddress'].str.replace("'", '')
+    df['Shareholding'] = pd.to_numeric(df['Shareholding'].str.replace(',', ''))
+    if 'FracOfShares' in df.columns:
+        df['FracOfShares'] = pd.to_numeric(df['FracOfShares'].str.replace('%', ''))
+    else:
+        df['FracOfShares'] = df['Shareholding'] / df['Shareholding'].sum() * 100
+    # Only store those with % of shares > 0.1%
+    df = df[df['FracOfShares'] > SHAREHOLDING_THRESHOLD_TO_SCRAPE]
+    df['StockCode'] = stock_code
+    df['DataDate'] = date.strftime('%Y-%m-%d')
+    df = df[['DataDate', 'StockCode', *table_columns]]
+    return df
+
+def parse_shareholding_html(page_source: str, date: datetime.date, stock_code: str) -> pd.DataFrame:
+    if not page_source:
+        return pd.DataFrame()
+    root = html.fromstring(page_source)
+    
+    participant_ids, participant_names, participant_addresses = [], [], []
+    shareholdings, frac_of_shares = [], []
+    has_frac_of_shares = True
+    for table_row in SHAREHOLDING_ROWS_XPATH(root):
+        cells = [''.join(cell.itertext()).strip() for cell in SHAREHOLDING_CELLS_XPATH(table_row)]
+        if len(cells) < 4:
+            continue
+        participant_ids.append(cells[0] or 'None')
+        participant_names.append(cells[1].replace("'", ''))
+        participant_addresses.append(cells[2].replace("'", ''))
+        shareholdings.append(int(cells[3].replace(',', '')))
+        if len(cells) > 4:
+            frac_of_shares.append(float(cells[4].rstrip('%')))
+        else:
+            # Some pages do not show % of shares
+            has_frac_of_shares = False
+    
+    if not participant_ids:
+        return pd.DataFrame()
+    
+    shareholding_array = np.array(shareholdings, dtype=np.int64)
+    if has_frac_of_shares:
+        frac_of_shares_array = np.array(frac_of_shares, dtype=np.float64)
+    else:
+        frac_of_shares_array = shareholding_array / shareholding_array.sum() * 100
+    # Only store those with % of shares > 0.1%
+    mask = frac_of_shares_array > SHAREHOLDING_THRESHOLD_TO_SCRAPE
+    
+    df = pd.DataFrame({
+        'DataDate': date.strftime('%Y-%m-%d'),
+        'StockCode': stock_code,
+        'ParticipantID': np.array(participant_ids, dtype=object)[mask],
+        'ParticipantName': np.array(participant_names, dtype=object)[mask],
+        'ParticipantAddress': np.array(participant_addresses, dtype=object)[mask],
+        'Shareholding': shareholding_array[mask],
+        'FracOfShares': frac_of_shares_array[mask],
+    })
+    return df
+
+def get_participant_keys(df: pd.DataFrame) -> pd.DataFrame:
+    # Participants without a CCASS ID all have ParticipantID 'None', they are told apart by name
+    # (the others keep their ID across a change of name)
+    return df.assign(ParticipantKey=df['ParticipantName'].where(df['ParticipantID'] == 'None', ''))
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+Parameterized queries of the SQL backends, each defined once with named bind parameters
+
+    :name     a value, bound by the driver rather than formatted into the SQL
+    :name[]   a list, expanded to one parameter per item
+
+Table names and config constants are filled in when the module is loaded, so the SQL text of a
+query only varies with the dialect (and the lengths of its lists). A Query holds the SQLite text,
+with overrides for the normalized SQLite schema and QuestDB where they differ, and caches each
+rendering with the placeholders of the driver (sqlite3 :name, psycopg2 %(name)s).
+
+As the text of a query is always the same, sqlite3 reuses the compiled statement from the
+statement cache of the connection (SQLITE_STATEMENT_CACHE_SIZE) instead of parsing and planning
+it again on every request. psycopg2 binds on the client: QuestDB gets the values as escaped literals.
+"""
+
+import re
+import sqlite3
+
+import pandas as pd
+import psycopg2
+
+from config import (
+    SQLITE_SCHEMA, CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME, CCASS_FACT_TABLE_NAME,
+    STOCK_TABLE_NAME, PARTICIPANT_TABLE_NAME, CCASS_CHANGE_TABLE_NAME, STOCK_METADATA_TABLE_NAME,
+    TREND_TAB_DATA_COLUMNS, TREND_TOP_PARTICIPANTS
+)
+from sqlite_normalized import DATE_TO_TEXT_SQL
+
+PARAM_PATTERN = re.compile(r'(?<!:):([A-Za-z_]\w*)(\[\])?')
+
+
+class Query:
+
+    def __init__(self, sql: str, normalized: str = None, quest: str = None):
+        self.dialect_sql = {'sqlite': sql, 'normalized': normalized or sql, 'quest': quest or sql}
+        # (dialect, list lengths) -> SQL with the placeholders of the driver
+        self.rendered = {}
+
+    def render(self, dialect: str, list_lengths: tuple = ()) -> str:
+        key = (dialect, list_lengths)
+        if key not in self.rendered:
+            self.rendered[key] = render_sql(self.dialect_sql[dialect], dialect, dict(list_lengths))
+        return self.rendered[key]
+
+
+def get_dialect(connection) -> str:
+    if isinstance(connection, psycopg2.extensions.connection):
+        return 'quest'
+    if isinstance(connection, sqlite3.Connection) and SQLITE_SCHEMA == 'NORMALIZED':
+        return 'normalized'
+    return 'sqlite'
+
+def render_sql(sql: str, dialect: str, list_lengths: dict) -> str:
+    if dialect == 'quest':
+        # psycopg2 formats the SQL with the parameters
+        sql = sql.replace('%', '%%')
+        placeholder = '%({})s'
+    else:
+        placeholder = ':{}'
+
+    def replace(match):
+        name, is_list = match.groups()
+        if not is_list:
+            return placeholder.format(name)
+        # null: an empty list matches nothing
+        return ', '.join(placeholder.format(f'{name}_{i}') for i in range(list_lengths[name])) or 'null'
+    return PARAM_PATTERN.sub(replace, sql)
+
+def bind(query: Query, connection, params: dict) -> tuple:
+    # SQL and parameters for the driver, lists flattened to one parameter per item
+    list_lengths = tuple(sorted(
+        (name, len(value)) for name, value in params.items() if isinstance(value, (list, tuple))
+    ))
+    values = {}
+    for name, value in params.items():
+        if isinstance(value, (list, tuple)):
+            values.update((f'{name}_{i}', item) for i, item in enumerate(value))
+        else:
+            values[name] = value
+    return query.render(get_dialect(connection), list_lengths), values
+
+def read_query(query: Query, connection, **params) -> pd.DataFrame:
+    sql, values = bind(query, connection, params)
+    return pd.read_sql_query(sql, connection, params=values)
+
+def execute_query(query: Query, connection, **params):
+    # Returns the cursor
+    sql, values = bind(query, connection, params)
+    if isinstance(connection, sqlite3.Connection):
+        return connection.execute(sql, values)
+    cursor = connection.cursor()
+    cursor.execute(sql, values)
+    return cursor
+
+
+# Scraper
+STOCK_MAP_BY_DATE = Query(f"select StockCode, StockName from {STOCK_MAP_TABLE_NAME} where DataDate = :date")
+STOCK_CODES_WITH_DATA_BY_DATE = Query(f"select distinct StockCode from {CCASS_TABLE_NAME} where DataDate = :date")
+SCRAPE_PROGRESS_BY_DATE = Query(
+    f"""
+        select StockCode, Status, AttemptCount from {SCRAPE_PROGRESS_TABLE_NAME}
+        where DataDate = :date
+    """,
+    quest=f"""
+        select StockCode, Status, AttemptCount from {SCRAPE_PROGRESS_TABLE_NAME}
+        where DataDate = :date
+        latest on RecordedAt partition by StockCode
+    """
+)
+
+# Scheduler
+STOCK_DAYS_SINCE = Query(f"select DataDate, StockCode from {STOCK_MAP_TABLE_NAME} where DataDate >= :start_date")
+STOCK_DAYS_WITH_DATA_SINCE = Query(
+    f"select distinct DataDate, StockCode from {CCASS_TABLE_NAME} where DataDate >= :start_date"
+)
+SCRAPE_STATUS_SINCE = Query(
+    f"""
+        select DataDate, StockCode, Status, RecordedAt from {SCRAPE_PROGRESS_TABLE_NAME}
+        where DataDate >= :start_date
+    """,
+    quest=f"""
+        select DataDate, StockCode, Status, RecordedAt from {SCRAPE_PROGRESS_TABLE_NAME}
+        where DataDate >= :start_date
+        latest on RecordedAt partition by DataDate, StockCode
+    """
+)
+# Retention, by table
+DELETE_BEFORE = {
+    CCASS_TABLE_NAME: Query(
+        f"DELETE FROM {CCASS_TABLE_NAME} where DataDate < :cutoff_date",
+        normalized=f"DELETE FROM {CCASS_FACT_TABLE_NAME} where DataDate < :cutoff_date_int"
+    ),
+    **{
+        table_name: Query(f"DELETE FROM {table_name} where DataDate < :cutoff_date")
+        for table_name in (STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME)
+    },
+}
+DROP_PARTITIONS_BEFORE = {
+    table_name: Query(f"ALTER TABLE {table_name} DROP PARTITION WHERE {timestamp_column} < :cutoff_date")
+    for table_name, timestamp_column in (
+        (CCASS_TABLE_NAME, 'DataDate'),
+        (STOCK_MAP_TABLE_NAME, 'DataDate'),
+        (SCRAPE_PROGRESS_TABLE_NAME, 'RecordedAt'),
+    )
+}
+
+# Web app
+DATA_VERSION = Query(f"select max(RecordedAt) as RecordedAt from {STOCK_METADATA_TABLE_NAME}")
+
+# Screener
+SNAPSHOT_DATE = Query(
+    f"select max(DataDate) as DataDate from {STOCK_MAP_TABLE_NAME} where DataDate <= :date"
+)
+SHAREHOLDING_SNAPSHOTS = Query(f"""
+    select DataDate, StockCode, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
+    where DataDate in (:dates[]) and StockCode in (:stock_codes[])
+""")
+
+# Transaction finder
+SHAREHOLDING_DELTA = Query(
+    f"""
+        with
+    	end_date_shareholding as (
+    		select datadate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
+    		WHERE StockCode = :stock_code
+    		and DataDate = (select max(DataDate) from {STOCK_MAP_TABLE_NAME} where DataDate <= :end_date)
+    	),
+    	start_date_shareholding as (
+    		select datadate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
+    		WHERE StockCode = :stock_code
+    		and DataDate = (select max(DataDate) from {STOCK_MAP_TABLE_NAME} where DataDate <= :start_date)
+    	),
+    	joint_shareholding as (
+    		select
+    			a.ParticipantID,
+                a.ParticipantName,
+    			ifnull(b.DataDate, :start_date)  as startDataDate,
+    			ifnull(b.FracOfShares, 0) as startFracOfShare,
+    			a.DataDate as endDataDate,
+    			a.FracOfShares as endFracOfShare
+    		from end_date_shareholding a
+    		left outer join start_date_shareholding b
+    		on a.ParticipantID = b.ParticipantID
+    		UNION
+    		select
+    			a.ParticipantID,
+                a.ParticipantName,
+    			a.DataDate as startDataDate,
+    			a.FracOfShares as startFracOfShare,
+    			ifnull(b.DataDate, :end_date) as endDataDate,
+    			ifnull(b.FracOfShares,0) as endFracOfShare
+    		from start_date_shareholding a
+    		left outer join end_date_shareholding b
+    		on a.ParticipantID = b.ParticipantID
+    	),
+    	final_table as (
+    		select
+    			joint_shareholding.*,
+    			round((endFracOfShare - startFracOfShare), 2) as ChangeInPercentShares
+    		from joint_shareholding
+    	)
+
+        select * from final_table
+        order by ChangeInPercentShares desc
+    """,
+    normalized=f"""
+        with
+        selectedStock as (
+            select StockKey from {STOCK_TABLE_NAME} where StockCode = :stock_code
+        ),
+        end_date_shareholding as (
+            select f.DataDate, p.ParticipantID, p.ParticipantName, f.FracOfShares from {CCASS_FACT_TABLE_NAME} f
+            inner join {PARTICIPANT_TABLE_NAME} p on f.ParticipantKey = p.ParticipantKey
+            where f.StockKey = (select StockKey from selectedStock)
+            and f.DataDate = (
+                select cast(replace(max(DataDate), '-', '') as integer) from {STOCK_MAP_TABLE_NAME}
+                where DataDate <= :end_date
+            )
+        ),
+        start_date_shareholding as (
+            select f.DataDate, p.ParticipantID, p.ParticipantName, f.FracOfShares from {CCASS_FACT_TABLE_NAME} f
+            inner join {PARTICIPANT_TABLE_NAME} p on f.ParticipantKey = p.ParticipantKey
+            where f.StockKey = (select StockKey from selectedStock)
+            and f.DataDate = (
+                select cast(replace(max(DataDate), '-', '') as integer) from {STOCK_MAP_TABLE_NAME}
+                where DataDate <= :start_date
+            )
+        ),
+        -- Joined on ParticipantID like the legacy query, a renamed participant has a new ParticipantKey
+        joint_shareholding as (
+            select
+                a.ParticipantID,
+                a.ParticipantName,
+                ifnull(b.DataDate, :start_date_int) as startDataDate,
+                ifnull(b.FracOfShares, 0) as startFracOfShare,
+                a.DataDate as endDataDate,
+                a.FracOfShares as endFracOfShare
+            from end_date_shareholding a
+            left outer join start_date_shareholding b
+            on a.ParticipantID = b.ParticipantID
+            UNION
+            select
+                a.ParticipantID,
+                a.ParticipantName,
+                a.DataDate as startDataDate,
+                a.FracOfShares as startFracOfShare,
+                ifnull(b.DataDate, :end_date_int) as endDataDate,
+                ifnull(b.FracOfShares, 0) as endFracOfShare
+            from start_date_shareholding a
+            left outer join end_date_shareholding b
+            on a.ParticipantID = b.ParticipantID
+        )
+        select
+            j.ParticipantID,
+            j.ParticipantName,
+            {DATE_TO_TEXT_SQL.format(col='j.startDataDate')} as startDataDate,
+            j.startFracOfShare,
+            {DATE_TO_TEXT_SQL.format(col='j.endDataDate')} as endDataDate,
+            j.endFracOfShare,
+            round((j.endFracOfShare - j.startFracOfShare), 2) as ChangeInPercentShares
+        from joint_shareholding j
+        order by ChangeInPercentShares desc
+    """,
+    quest=f"""
+        with dataDateRange as (
+          select min(datadate) as MinDataDate, max(datadate) as MaxDataDate from {STOCK_MAP_TABLE_NAME}
+          where stockCode = :stock_code
+          and datadate between :start_date and :end_date
+        ), dataInDateRange as (
+          select datadate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
+          WHERE StockCode = :stock_code
+          and datadate between :start_date and :end_date
+        ),
+        end_date_shareholding as (
+          select dataInDateRange.* from
+          dataInDateRange inner join dataDateRange
+          on dataInDateRange.DataDate = dataDateRange.MaxDataDate
+        ),
+        start_date_shareholding as (
+          select dataInDateRange.* from
+          dataInDateRange inner join dataDateRange
+          on dataInDateRange.DataDate = dataDateRange.MinDataDate
+        ),
+    	joint_shareholding as (
+    		select
+    			a.ParticipantID,
+                a.ParticipantName,
+    			coalesce(b.FracOfShares, 0) as startFracOfShare,
+    			a.FracOfShares as endFracOfShare
+    		from end_date_shareholding a
+    		left outer join start_date_shareholding b
+    		on a.ParticipantID = b.ParticipantID
+    		UNION
+    		select
+    			a.ParticipantID,
+                a.ParticipantName,
+    			a.FracOfShares as startFracOfShare,
+    			coalesce(b.FracOfShares, 0) as endFracOfShare
+    		from start_date_shareholding a
+    		left outer join end_date_shareholding b
+    		on a.ParticipantID = b.ParticipantID
+    	),
+    	final_table as (
+    		select
+    			joint_shareholding.*,
+    			round((endFracOfShare - startFracOfShare), 2) as ChangeInPercentShares
+    		from joint_shareholding
+    	)
+
+        select * from final_table
+        order by ChangeInPercentShares desc
+    """
+)
+
+# Trend
+SHAREHOLDING_TIME_SERIES_FOR_TOP_PARTICIPANTS = Query(
+    f"""
+        with topParticipant as (
+        	select ParticipantID from (
+        		select ParticipantID, rank() over (order by Shareholding DESC) as rk from (
+        			select ParticipantID, Shareholding from {CCASS_TABLE_NAME}
+        			where
+        				stockcode = :stock_code and
+        				datadate = (select max(DataDate) from {STOCK_MAP_TABLE_NAME} where DataDate <= :end_date)
+        		)
+        	) WHERE rk <= {TREND_TOP_PARTICIPANTS}
+        )
+        Select {','.join(TREND_TAB_DATA_COLUMNS)} from {CCASS_TABLE_NAME}
+        where
+            StockCode = :stock_code and
+            DataDate between :start_date and :end_date and
+            ParticipantID in topParticipant
+        order by
+            DataDate, FracOfShares desc
+    """,
+    normalized=f"""
+        with selectedStock as (
+            select StockKey from {STOCK_TABLE_NAME} where StockCode = :stock_code
+        ),
+        -- By ParticipantID like the legacy query, a renamed participant has a new ParticipantKey
+        topParticipant as (
+            select ParticipantID from (
+                select p.ParticipantID, rank() over (order by f.Shareholding DESC) as rk
+                from {CCASS_FACT_TABLE_NAME} f
+                inner join {PARTICIPANT_TABLE_NAME} p on f.ParticipantKey = p.ParticipantKey
+                where
+                    f.StockKey = (select StockKey from selectedStock) and
+                    f.DataDate = (
+                        select cast(replace(max(DataDate), '-', '') as integer) from {STOCK_MAP_TABLE_NAME}
+                        where DataDate <= :end_date
+                    )
+            ) WHERE rk <= {TREND_TOP_PARTICIPANTS}
+        )
+        Select
+            {DATE_TO_TEXT_SQL.format(col='f.DataDate')} as DataDate,
+            p.ParticipantID,
+            p.ParticipantName,
+            f.FracOfShares
+        from {CCASS_FACT_TABLE_NAME} f
+        inner join {PARTICIPANT_TABLE_NAME} p on f.ParticipantKey = p.ParticipantKey
+        where
+            f.StockKey = (select StockKey from selectedStock) and
+            f.DataDate between :start_date_int and :end_date_int and
+            p.ParticipantID in topParticipant
+        order by
+            f.DataDate, f.FracOfShares desc
+    """,
+    quest=f"""
+        with maxDataDate as (
+          select max(datadate) as DataDate from {CCASS_TABLE_NAME}
+          where stockCode = :stock_code
+          and datadate <= :end_date
+        ),
+        topParticipant as (
+          select {CCASS_TABLE_NAME}.* from {CCASS_TABLE_NAME}
+          inner join maxDataDate
+          on {CCASS_TABLE_NAME}.DataDate = maxDataDate.DataDate
+          where
+            stockcode = :stock_code
+          order by Shareholding desc
+          limit {TREND_TOP_PARTICIPANTS}
+        )
+        select a.* from (
+          select {','.join(TREND_TAB_DATA_COLUMNS)} from {CCASS_TABLE_NAME}
+          where
+          stockCode = :stock_code AND
+          datadate BETWEEN :start_date and :end_date
+        ) a inner JOIN topParticipant
+        on a.ParticipantID = topParticipant.ParticipantID
+        order by DataDate, FracOfShares Desc
+    """
+)
+
+# Holdings change checkpoints (change_table.py, SQLite only)
+HOLDINGS = Query(f"""
+    select DataDate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
+    where StockCode = :stock_code
+    order by DataDate
+""")
+HOLDINGS_ON_DATES = Query(f"""
+    select DataDate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
+    where StockCode = :stock_code and DataDate in (:dates[])
+    order by DataDate
+""")
+ADJACENT_DATA_DATES = Query(f"""
+    select
+      (select max(DataDate) from {CCASS_TABLE_NAME} where StockCode = :stock_code and DataDate < :date),
+      (select min(DataDate) from {CCASS_TABLE_NAME} where StockCode = :stock_code and DataDate > :date)
+""")
+FIRST_DATA_DATE_OF_STOCK = Query(f"select min(DataDate) from {CCASS_TABLE_NAME} where StockCode = :stock_code")
+DELETE_CHECKPOINTS_ON_DATE = Query(
+    f"DELETE FROM {CCASS_CHANGE_TABLE_NAME} where StockCode = :stock_code and DataDate = :date"
+)
+DELETE_CHECKPOINTS_BEFORE = Query(
+    f"DELETE FROM {CCASS_CHANGE_TABLE_NAME} where StockCode = :stock_code and DataDate < :cutoff_date"
+)
+STOCKS_WITH_CHECKPOINTS_BEFORE = Query(
+    f"select distinct StockCode from {CCASS_CHANGE_TABLE_NAME} where DataDate < :cutoff_date"
+)
+# The holding on a date is the latest checkpoint on or before it
+LATEST_CHECKPOINT = f"""
+    from {CCASS_CHANGE_TABLE_NAME} c
+    where
+        c.StockCode = :stock_code and c.ParticipantID = p.ParticipantID and c.ParticipantKey = p.ParticipantKey
+        and c.DataDate <= {{date}}
+    order by c.DataDate desc limit 1
+"""
+CHECKPOINT_SHAREHOLDING_DELTA = Query(f"""
+    with participant as (
+        select distinct ParticipantID, ParticipantKey from {CCASS_CHANGE_TABLE_NAME}
+        where StockCode = :stock_code
+    ),
+    holding as (
+        select
+            p.ParticipantID,
+            (select ParticipantName {LATEST_CHECKPOINT.format(date=':start_snapshot_date')}) as startParticipantName,
+            (select FracOfShares {LATEST_CHECKPOINT.format(date=':start_snapshot_date')}) as startFracOfShare,
+            (select ParticipantName {LATEST_CHECKPOINT.format(date=':end_snapshot_date')}) as endParticipantName,
+            (select FracOfShares {LATEST_CHECKPOINT.format(date=':end_snapshot_date')}) as endFracOfShare
+        from participant p
+    )
+    select
+        ParticipantID,
+        coalesce(endParticipantName, startParticipantName) as ParticipantName,
+        case when startFracOfShare > 0 then :start_snapshot_date else :start_date end as startDataDate,
+        ifnull(startFracOfShare, 0) as startFracOfShare,
+        case when endFracOfShare > 0 then :end_snapshot_date else :end_date end as endDataDate,
+        ifnull(endFracOfShare, 0) as endFracOfShare,
+        round(ifnull(endFracOfShare, 0) - ifnull(startFracOfShare, 0), 2) as ChangeInPercentShares
+    from holding
+    where startFracOfShare > 0 or endFracOfShare > 0
+    order by ChangeInPercentShares desc
+""")
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Result cache for the dashboard queries
+
+LRU bounded by the memory size of the cached DataFrames, with optional spill of evicted
+results to disk (pickle). Keys are e.g. (query, stock code, start date, end date, backend).
+
+All entries are dropped when the data version changes, i.e. the scraper finishes loading a day
+(StockMetadata is updated), so partial results of a day being scraped are not kept.
+The version is checked at most once every QUERY_CACHE_VERSION_CHECK_SECONDS. A result computed
+while the version changed is returned but not cached.
+"""
+
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from config import (
+    QUERY_CACHE_MAX_MB, QUERY_CACHE_SPILL_DIR, QUERY_CACHE_SPILL_MAX_MB,
+    QUERY_CACHE_VERSION_CHECK_SECONDS, QUERY_CACHE_REPORT_EVERY
+)
+
+
+class QueryCache:
+
+    def __init__(self, version_func, max_mb: float = QUERY_CACHE_MAX_MB,
+                 spill_dir: str = QUERY_CACHE_SPILL_DIR, spill_max_mb: float = QUERY_CACHE_SPILL_MAX_MB,
+                 version_check_seconds: float = QUERY_CACHE_VERSION_CHECK_SECONDS):
+        # version_func() returns something that changes when new data is loaded
+        self.version_func = version_func
+        self.max_bytes = max_mb * 1024 * 1024
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_mb * 1024 * 1024
+        self.version_check_seconds = version_check_seconds
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.version = None
+        self.version_checked_at = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def get_or_compute(self, key: tuple, compute_func) -> pd.DataFrame:
+        self.check_version()
+        with self.lock:
+            version = self.version
+            df = None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                df = self.entries[key][0]
+        if df is not None:
+            return df.copy()
+        df = self.load_spilled(key)
+        if df is not None:
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            with self.lock:
+                self.misses += 1
+            df = compute_func()
+        self.put(key, df, version)
+        if (self.hits + self.disk_hits + self.misses) % QUERY_CACHE_REPORT_EVERY == 0:
+            print(f"Query cache: {self.stats()}")
+        # Callers are free to modify the result
+        return df.copy()
+
+    def put(self, key: tuple, df: pd.DataFrame, version):
+        # version: the data version when df was computed
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            if version != self.version:
+                return
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (df, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                evicted_key, (evicted_df, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                evicted.append((evicted_key, evicted_df))
+        for evicted_key, evicted_df in evicted:
+            self.spill(evicted_key, evicted_df, version)
+
+    def check_version(self):
+        now = time.monotonic()
+        if now - self.version_checked_at < self.version_check_seconds:
+            return
+        self.version_checked_at = now
+        version = self.version_func()
+        if version != self.version:
+            if self.version is not None:
+                print(f"Query cache: data version changed from {self.version} to {version}, clearing")
+            self.clear(version)
+
+    def clear(self, version=None):
+        with self.lock:
+            # Under the same lock as the put() check, so no result of the old version is put after this
+            self.version = version
+            self.entries.clear()
+            self.total_bytes = 0
+        if self.spill_dir:
+            for file_name in os.listdir(self.spill_dir):
+                if file_name.endswith('.pkl'):
+                    os.remove(os.path.join(self.spill_dir, file_name))
+
+    def get_spill_path(self, key: tuple) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl')
+
+    def spill(self, key: tuple, df: pd.DataFrame, version):
+        if not self.spill_dir or version != self.version:
+            return
+        with open(self.get_spill_path(key), 'wb') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Keep the spill directory bounded, oldest files go first
+        paths = sorted(
+            (os.path.join(self.spill_dir, file_name) for file_name in os.listdir(self.spill_dir)),
+            key=os.path.getmtime
+        )
+        total_size = sum(os.path.getsize(path) for path in paths)
+        for path in paths:
+            if total_size <= self.spill_max_bytes:
+                break
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+
+    def load_spilled(self, key: tuple):
+        if not self.spill_dir:
+            return None
+        path = self.get_spill_path(key)
+        try:
+            with open(path, 'rb') as f:
+                df = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        os.remove(path)
+        return df
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'size_mb': round(self.total_bytes / 1024 / 1024, 1),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0,
+            }
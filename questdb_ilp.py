@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk ingestion into QuestDB
+
+ILP: rows are rendered to InfluxDB line protocol with vectorized string ops
+and streamed over a TCP socket (port 9009).
+BATCH: multi-row INSERT statements over the PG wire protocol, for setups without the ILP port.
+
+Batch sizes are derived from the average rendered row size.
+ILP over TCP has no acknowledgement, so ILPSender:
+    - keeps every batch sent on the connection until delivery is confirmed
+    - on a connection error, reconnects and resends all of them (at-least-once: the server may
+      have consumed some already, so rows can be written twice)
+    - on close(), half-closes the socket and waits (up to QUEST_ILP_CLOSE_TIMEOUT_SECONDS) for the
+      server to close its side, i.e. the server has consumed every line sent
+A sender is opened per DataFrame, so the kept batches are about the size of the rendered DataFrame.
+"""
+
+import socket
+import time
+
+import numpy as np
+import pandas as pd
+import psycopg2.extras
+
+from config import (
+    QUEST_ILP_HOST, QUEST_ILP_PORT, QUEST_ILP_BATCH_BYTES, QUEST_ILP_CLOSE_TIMEOUT_SECONDS, QUEST_BATCH_STATEMENT_BYTES,
+    QUEST_SYMBOL_COLUMNS, QUEST_DESIGNATED_TIMESTAMP_COLUMNS
+)
+
+
+def escape_symbol(s: pd.Series) -> pd.Series:
+    # Newlines become spaces before the spaces are escaped
+    return (
+        s.astype(str)
+        .str.replace('\n', ' ', regex=False)
+        .str.replace('\\', '\\\\', regex=False)
+        .str.replace(',', '\\,', regex=False)
+        .str.replace('=', '\\=', regex=False)
+        .str.replace(' ', '\\ ', regex=False)
+    )
+
+def escape_string(s: pd.Series) -> pd.Series:
+    return (
+        s.astype(str)
+        .str.replace('\\', '\\\\', regex=False)
+        .str.replace('"', '\\"', regex=False)
+        .str.replace('\n', ' ', regex=False)
+    )
+
+def to_epoch_micros(s: pd.Series) -> pd.Series:
+    micros = pd.to_datetime(s).values.astype('datetime64[us]').astype(np.int64)
+    return pd.Series(micros, index=s.index).astype(str)
+
+def dataframe_to_ilp_lines(df: pd.DataFrame, table_name: str) -> pd.Series:
+    symbol_columns = [col for col in QUEST_SYMBOL_COLUMNS.get(table_name, []) if col in df.columns]
+    timestamp_column = QUEST_DESIGNATED_TIMESTAMP_COLUMNS.get(table_name)
+
+    lines = pd.Series(table_name, index=df.index)
+    for col in symbol_columns:
+        lines = lines + f',{col}=' + escape_symbol(df[col])
+
+    fields = []
+    for col in df.columns:
+        if col in symbol_columns or col == timestamp_column:
+            continue
+        s = df[col]
+        if 'date' in col.lower():
+            fields.append(f'{col}=' + to_epoch_micros(s) + 't')
+        elif pd.api.types.is_bool_dtype(s):
+            fields.append(f'{col}=' + pd.Series(np.where(s, 't', 'f'), index=df.index))
+        elif pd.api.types.is_integer_dtype(s):
+            fields.append(f'{col}=' + s.astype(str) + 'i')
+        elif pd.api.types.is_float_dtype(s):
+            fields.append(f'{col}=' + s.astype(str))
+        else:
+            fields.append(f'{col}="' + escape_string(s) + '"')
+    lines = lines + ' ' + fields[0].str.cat(fields[1:], sep=',')
+
+    if timestamp_column:
+        # Designated timestamp in nanoseconds
+        lines = lines + ' ' + to_epoch_micros(df[timestamp_column]) + '000'
+    return lines + '\n'
+
+def get_batch_size(average_row_bytes: float, target_bytes: int) -> int:
+    return max(1, int(target_bytes / max(average_row_bytes, 1)))
+
+
+class ILPSender:
+
+    def __init__(self, host: str = QUEST_ILP_HOST, port: int = QUEST_ILP_PORT,
+                 batch_bytes: int = QUEST_ILP_BATCH_BYTES, max_retries: int = 3,
+                 close_timeout: float = QUEST_ILP_CLOSE_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.batch_bytes = batch_bytes
+        self.max_retries = max_retries
+        self.close_timeout = close_timeout
+        self.sock = None
+        # Batches sent but not confirmed yet
+        self.pending = []
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def resend_pending(self):
+        # Batches handed to the broken connection may not have reached the server, so all are resent
+        for attempt in range(self.max_retries):
+            time.sleep(0.5 * 2 ** attempt)
+            self.sock.close()
+            try:
+                self.connect()
+                for payload in self.pending:
+                    self.sock.sendall(payload)
+                return
+            except OSError:
+                if attempt == self.max_retries - 1:
+                    raise
+
+    def send_batch(self, payload: bytes):
+        self.pending.append(payload)
+        try:
+            self.sock.sendall(payload)
+        except OSError:
+            if not self.max_retries:
+                raise
+            self.resend_pending()
+
+    def send_dataframe(self, df: pd.DataFrame, table_name: str):
+        if df.empty:
+            return
+        lines = dataframe_to_ilp_lines(df, table_name)
+        batch_size = get_batch_size(lines.str.len().mean(), self.batch_bytes)
+        for start in range(0, len(lines), batch_size):
+            self.send_batch(''.join(lines.values[start:start + batch_size]).encode('utf-8'))
+
+    def wait_for_server_close(self):
+        # The server closes its side once it has read everything
+        self.sock.settimeout(self.close_timeout)
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            while self.sock.recv(4096):
+                pass
+        except socket.timeout:
+            raise TimeoutError(
+                f"QuestDB did not confirm the ILP lines within {self.close_timeout}s"
+            ) from None
+
+    def close(self):
+        if not self.sock:
+            return
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.wait_for_server_close()
+                    break
+                except TimeoutError:
+                    raise
+                except OSError:
+                    if attempt == self.max_retries:
+                        raise
+                    self.resend_pending()
+            self.pending = []
+        finally:
+            self.sock.close()
+            self.sock = None
+
+
+def store_df_to_quest_db_ilp(df: pd.DataFrame, table_name: str):
+    with ILPSender() as sender:
+        sender.send_dataframe(df, table_name)
+
+def store_df_to_quest_db_batch(df: pd.DataFrame, connection, table_name: str):
+    date_columns = [col for col in df.columns if 'date' in col.lower()]
+    df = df.assign(**{col: pd.to_datetime(df[col]).dt.date for col in date_columns})
+    # Series.tolist gives python scalars, which psycopg2 can adapt
+    rows = list(zip(*(df[col].tolist() for col in df.columns)))
+    if not rows:
+        return
+    average_row_bytes = len(repr(rows[:100])) / min(len(rows), 100)
+    cursor = connection.cursor()
+    psycopg2.extras.execute_values(
+        cursor,
+        f"INSERT INTO {table_name} VALUES %s",
+        rows,
+        page_size=get_batch_size(average_row_bytes, QUEST_BATCH_STATEMENT_BYTES)
+    )
+    connection.commit()
+    cursor.close()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Gap-aware scrape plan over the rolling retention window
+
+The window is the business days of the last RETENTION_DAYS up to yesterday (T+1 data). The stock
+days missing in it are worked out from the DB: the stock list of each date (StockMap) less the
+stock days journaled as DONE or EMPTY (ScrapeProgress), or with data but no journal record
+(scraped before the journal existed), so FAILED ones are retried and a rerun only fetches what is
+missing. The plan is newest first, so the daily T+1 update runs before the
+older gaps are filled.
+
+HKEX holidays are learned rather than configured: a date whose stock list page has no stocks, or
+with HOLIDAY_MIN_EMPTY_PAGES empty pages and none with data, is recorded in MarketHoliday as seen
+without stocks. One empty or degraded page is not enough: the date is only skipped once it has been
+seen so again at least HOLIDAY_RECHECK_HOURS later. Until then it stays in the plan (its stock list,
+or its empty pages, are scraped again).
+
+Dates before the window are pruned (partition drops on QuestDB and Parquet, deletes on SQLite).
+
+Run:
+    python scheduler.py [--prune]
+"""
+
+import argparse
+import datetime
+
+import pandas as pd
+
+from config import RETENTION_DAYS, HOLIDAY_MIN_EMPTY_PAGES, HOLIDAY_RECHECK_HOURS
+from util import get_db_connection, create_table, get_first_data_date
+from util import load_stock_days, load_scrape_status, prune_data_before
+from util import load_market_holidays, load_market_holiday_observations, store_market_holiday
+
+
+def get_window_dates(today: datetime.date = None, retention_days: int = RETENTION_DAYS) -> list:
+    today = today or datetime.date.today()
+    return [
+        d.date() for d in pd.bdate_range(
+            start=today - datetime.timedelta(days=retention_days),
+            end=today - datetime.timedelta(days=1)
+        )
+    ]
+
+def learn_holidays(df_status: pd.DataFrame, connection, now: datetime.datetime = None) -> tuple:
+    # (holidays, dates whose empty pages are due to be scraped again)
+    now = now or datetime.datetime.now()
+    # Dates with only empty pages, enough of them not to be a few stocks without data
+    status_counts = df_status.groupby(['DataDate', 'Status']).size().unstack(fill_value=0)
+    status_counts = status_counts.reindex(columns=['DONE', 'EMPTY'], fill_value=0)
+    empty_dates = set(
+        status_counts.index[(status_counts['DONE'] == 0) & (status_counts['EMPTY'] >= HOLIDAY_MIN_EMPTY_PAGES)]
+    )
+    # Seen without stocks when the last of its pages was scraped
+    empty_recorded_at = df_status[df_status['Status'] == 'EMPTY'].groupby('DataDate')['RecordedAt'].max()
+    df_observations = load_market_holiday_observations(connection)
+    observations = set(zip(df_observations['DataDate'], df_observations['RecordedAt']))
+    for date_str in sorted(empty_dates):
+        if (date_str, empty_recorded_at[date_str]) not in observations:
+            print(f"Only empty pages on {date_str}, recording it as a possible holiday")
+            store_market_holiday(date_str, connection, empty_recorded_at[date_str].to_pydatetime())
+
+    holidays = load_market_holidays(connection)
+    last_seen = load_market_holiday_observations(connection).groupby('DataDate')['RecordedAt'].max()
+    recheck_dates = {
+        date_str for date_str in empty_dates - holidays
+        if now - last_seen[date_str] >= pd.Timedelta(hours=HOLIDAY_RECHECK_HOURS)
+    }
+    return holidays, recheck_dates
+
+def plan_scrape(connection, today: datetime.date = None) -> list:
+    # [(date, stock codes to scrape, or None for the whole day)], newest first
+    window_dates = get_window_dates(today)
+    start_date_str = window_dates[0].strftime('%Y-%m-%d')
+    df_status = load_scrape_status(start_date_str, connection)
+    holidays, recheck_dates = learn_holidays(df_status, connection)
+
+    df_stock_days = load_stock_days(start_date_str, connection)
+    df_scraped = df_status[df_status['Status'].isin(['DONE', 'EMPTY']) & ~df_status['DataDate'].isin(recheck_dates)]
+    scraped = set(zip(df_scraped['DataDate'], df_scraped['StockCode']))
+    stock_codes_by_date = df_stock_days.groupby('DataDate')['StockCode'].apply(list).to_dict()
+
+    plan = []
+    for date in reversed(window_dates):
+        date_str = date.strftime('%Y-%m-%d')
+        if date_str in holidays:
+            continue
+        if date_str not in stock_codes_by_date:
+            plan.append((date, None))
+            continue
+        missing = [code for code in stock_codes_by_date[date_str] if (date_str, code) not in scraped]
+        if missing:
+            plan.append((date, missing))
+    return plan
+
+def prune_expired_data(connection, today: datetime.date = None):
+    cutoff_date_str = get_window_dates(today)[0].strftime('%Y-%m-%d')
+    first_date_str = get_first_data_date(connection)
+    if first_date_str is not None and first_date_str < cutoff_date_str:
+        prune_data_before(cutoff_date_str, connection)
+
+def print_plan(plan: list):
+    whole_days = sum(stock_codes is None for _, stock_codes in plan)
+    stock_days = sum(len(stock_codes) for _, stock_codes in plan if stock_codes is not None)
+    print(f"Scrape plan: {whole_days} whole days and {stock_days} missing stock days of {len(plan) - whole_days} days")
+    for date, stock_codes in plan[:10]:
+        print(f"    {date.strftime('%Y-%m-%d')}: {'all stocks' if stock_codes is None else f'{len(stock_codes)} stocks'}")
+    if len(plan) > 10:
+        print(f"    ... {len(plan) - 10} more days")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prune', action='store_true')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        create_table(conn)
+        if args.prune:
+            prune_expired_data(conn)
+        print_plan(plan_scrape(conn))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
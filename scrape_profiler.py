@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timings of the scraper threads (scraper.py)
+
+Each scraper thread has its own ScrapeProfiler, so no locking is needed while scraping.
+The stages of a page are:
+    navigation      search for the stock (fill in the form and submit / post it)
+    wait_for_table  wait for the result page to be loaded
+    page_source     transfer of the page source from the browser
+    parse           parse_shareholding_html
+    write           append to the buffer, and flushes to the DB writer queue
+    page            the whole page, including retries of the search page on failure
+
+At the end of a date run the profilers of its threads are merged into a report with per-stage
+percentiles, pages per minute, empty page rate and retries, which is printed and written to
+SCRAPE_REPORT_DIR as JSON.
+
+SCRAPE_PROFILE_SAMPLE_RATE of the pages also run under cProfile. The stats are dumped next to the
+report (python -m pstats <file>.prof) and the top functions are included in it.
+"""
+
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+from config import SCRAPER_ENGINE, SCRAPE_REPORT_DIR, SCRAPE_PROFILE_SAMPLE_RATE, SCRAPE_PROFILE_TOP_FUNCTIONS
+
+STAGES = ['navigation', 'wait_for_table', 'page_source', 'parse', 'write', 'page']
+PERCENTILES = [50, 90, 95, 99]
+# Only one cProfile can be active at a time (it is process wide from Python 3.12)
+CPROFILE_LOCK = threading.Lock()
+
+
+class ScrapeProfiler:
+
+    def __init__(self, thread_idx: int, sample_rate: float = SCRAPE_PROFILE_SAMPLE_RATE):
+        self.thread_idx = thread_idx
+        self.sample_rate = sample_rate
+        self.random = random.Random(thread_idx)
+        self.timings = {stage: [] for stage in STAGES}
+        self.status_counts = Counter()
+        self.retries = 0
+        self.sampled_pages = 0
+        self.cprofile_stats = None
+        self.started_at = None
+        self.seconds = 0
+
+    def start(self):
+        self.started_at = time.perf_counter()
+
+    def stop(self):
+        self.seconds += time.perf_counter() - self.started_at
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name].append(time.perf_counter() - start_time)
+
+    @contextmanager
+    def page(self):
+        # The page stage, run under cProfile if sampled
+        profile = None
+        if self.sample_rate and self.random.random() < self.sample_rate and CPROFILE_LOCK.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler (e.g. a debugger) is active
+                CPROFILE_LOCK.release()
+                profile = None
+        try:
+            with self.stage('page'):
+                yield
+        finally:
+            if profile:
+                profile.disable()
+                CPROFILE_LOCK.release()
+                self.sampled_pages += 1
+                if self.cprofile_stats is None:
+                    self.cprofile_stats = pstats.Stats(profile)
+                else:
+                    self.cprofile_stats.add(profile)
+
+    def record_page(self, status: str, attempt_count: int):
+        self.status_counts[status] += 1
+        # Failed before, in this run or a previous one
+        if attempt_count > 1:
+            self.retries += 1
+
+
+def summarize_timings(timings: list) -> dict:
+    if not timings:
+        return {'count': 0}
+    timings_ms = np.array(timings) * 1000
+    return {
+        'count': len(timings),
+        'total_seconds': round(float(timings_ms.sum()) / 1000, 3),
+        'mean_ms': round(float(timings_ms.mean()), 3),
+        **{f'p{p}_ms': round(float(v), 3) for p, v in zip(PERCENTILES, np.percentile(timings_ms, PERCENTILES))},
+        'max_ms': round(float(timings_ms.max()), 3),
+    }
+
+def get_pages_per_minute(pages: int, seconds: float) -> float:
+    return round(pages / seconds * 60, 1) if seconds else 0
+
+def build_scrape_report(date_str: str, profilers: list, seconds: float = None) -> dict:
+    # seconds: wall time of the date run (threads run in parallel), the longest thread by default
+    if seconds is None:
+        seconds = max((profiler.seconds for profiler in profilers), default=0)
+    status_counts = sum((profiler.status_counts for profiler in profilers), Counter())
+    pages = sum(status_counts.values())
+    return {
+        'date': date_str,
+        'engine': SCRAPER_ENGINE,
+        'recorded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'threads': len(profilers),
+        'seconds': round(seconds, 1),
+        'pages': pages,
+        'pages_per_minute': get_pages_per_minute(pages, seconds),
+        'status_counts': dict(status_counts),
+        'empty_rate': round(status_counts['EMPTY'] / pages, 4) if pages else 0,
+        'failed_rate': round(status_counts['FAILED'] / pages, 4) if pages else 0,
+        'retries': sum(profiler.retries for profiler in profilers),
+        'stages': {
+            stage: summarize_timings([t for profiler in profilers for t in profiler.timings[stage]])
+            for stage in STAGES
+        },
+        'per_thread': [
+            {
+                'thread': profiler.thread_idx,
+                'pages': sum(profiler.status_counts.values()),
+                'seconds': round(profiler.seconds, 1),
+                'pages_per_minute': get_pages_per_minute(sum(profiler.status_counts.values()), profiler.seconds),
+                'stage_seconds': {stage: round(sum(profiler.timings[stage]), 3) for stage in STAGES},
+            }
+            for profiler in profilers
+        ],
+    }
+
+def get_top_functions(stats: pstats.Stats, n: int = SCRAPE_PROFILE_TOP_FUNCTIONS) -> list:
+    # By cumulative time
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:n]
+    return [
+        {
+            'function': f'{file_name}:{line}({function_name})',
+            'calls': calls,
+            'tottime': round(tottime, 4),
+            'cumtime': round(cumtime, 4),
+        }
+        for (file_name, line, function_name), (_, calls, tottime, cumtime, _) in rows
+    ]
+
+def write_scrape_report(report: dict, profilers: list, report_dir: str = SCRAPE_REPORT_DIR) -> str:
+    os.makedirs(report_dir, exist_ok=True)
+    path = os.path.join(report_dir, f"{report['date']}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}")
+    stats = [profiler.cprofile_stats for profiler in profilers if profiler.cprofile_stats is not None]
+    if stats:
+        stats[0].add(*stats[1:])
+        stats[0].dump_stats(f'{path}.prof')
+        report['cprofile'] = {
+            'sampled_pages': sum(profiler.sampled_pages for profiler in profilers),
+            'file': f'{path}.prof',
+            'top_functions': get_top_functions(stats[0]),
+        }
+    with open(f'{path}.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    return f'{path}.json'
+
+def print_scrape_report(report: dict):
+    print(
+        f"{report['date']}: {report['pages']} pages in {report['seconds']}s with {report['threads']} threads, "
+        f"{report['pages_per_minute']} pages/min, {report['empty_rate']:.1%} empty, "
+        f"{report['failed_rate']:.1%} failed, {report['retries']} retries"
+    )
+    for stage, summary in report['stages'].items():
+        if summary['count']:
+            print(
+                f"    {stage}: p50 {summary['p50_ms']}ms, p95 {summary['p95_ms']}ms, "
+                f"p99 {summary['p99_ms']}ms, total {summary['total_seconds']}s"
+            )
+
+def report_scrape_run(date: datetime.date, profilers: list, seconds: float = None) -> dict:
+    report = build_scrape_report(date.strftime('%Y-%m-%d'), profilers, seconds)
+    print_scrape_report(report)
+    print(f"Scrape report written to {write_scrape_report(report, profilers)}")
+    return report
@@ -6,11 +6,11 @@ Created on Mon Jun 27 21:32:39 2022
 """
 
 import pandas as pd
-import numpy as np
 import datetime
+import time
 
 from concurrent.futures import ThreadPoolExecutor
-import threading
+import queue
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
@@ -20,51 +20,55 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.remote.command import Command
 
-from bs4 import BeautifulSoup
-
-from config import HEADLESS, CHROME_DRIVER_PATH
-from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME
+from config import HEADLESS, CHROME_DRIVER_PATH, SCRAPER_ENGINE
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, CCASS_TABLE_COLUMNS
+from config import SCRAPE_PROGRESS_TABLE_NAME, SCRAPE_PROGRESS_COLUMNS
 from config import STOCK_CODE_LIST_URL, MAIN_URL
-from config import DATE_RANGE_LIST, SHAREHOLDING_THRESHOLD_TO_SCRAPE, NUMBER_OF_STOCKS_SCRAPED
-
-from util import get_db_connection, create_table, store_df_to_db
+from config import NUMBER_OF_SHARDS_PER_DATE
 
-db_lock = threading.Lock()
+from batch_buffer import ColumnarBuffer
+from parsers import parse_stock_code_list_html, parse_shareholding_html
+from db_writer import DBWriter
+from scrape_profiler import ScrapeProfiler, report_scrape_run
+from scheduler import plan_scrape, prune_expired_data, print_plan
+from util import load_scrape_progress, load_stock_map_by_date, update_stock_metadata, store_market_holiday
 
 
-def acquire_lock(func):
-    def inner_func(*args, **kwargs):
-        with db_lock:
-            func(*args, **kwargs)
-    return inner_func
-
 class CCASSScraper:
     
-    def __init__(self, threadIdx : int = 0):
+    def __init__(self, threadIdx : int, writer: DBWriter, main_url: str = MAIN_URL,
+                 stock_code_list_url: str = STOCK_CODE_LIST_URL):
         self.threadIdx = threadIdx
-        self.scraped_CCASS_date_stockCode = set()
+        # All DB reads / writes go through the writer thread
+        self.writer = writer
+        self.main_url = main_url
+        self.stock_code_list_url = stock_code_list_url
+        # Stock code -> (Status, AttemptCount) from the progress journal, for scraped_progress_date
+        self.scraped_progress = {}
+        self.scraped_progress_date = None
+        self.progress_records = []
         self.scraped_stock_map = pd.DataFrame()
         self.driver = None
+        self.buffer = ColumnarBuffer(CCASS_TABLE_COLUMNS)
+        # Stage timings of the pages scraped by this thread
+        self.profiler = ScrapeProfiler(threadIdx)
         
     
     def __enter__(self):
-        self.conn = get_db_connection()
-        if self.threadIdx == 0:
-            self.create_table()
-        self.initialize_chrome_driver()
+        self.initialize_client()
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.driver:
             self.driver.quit()
-        if self.conn:
-            self.conn.close()
-        
-    @acquire_lock
-    def create_table(self):
-        create_table(self.conn)
+    
+    def initialize_client(self):
+        self.initialize_chrome_driver()
         
     def initialize_chrome_driver(self):
+        if not CHROME_DRIVER_PATH:
+            raise Exception ("Chromedriver not found!")
+
         if HEADLESS:
             options = Options()
             options.add_argument('--headless')
@@ -77,6 +81,12 @@ class CCASSScraper:
     def get_stock_code_list(self, date: datetime.date)-> pd.DataFrame:
         if not self.check_if_stock_map_scraped(date):
             self.scraped_stock_map = self.scrape_stock_code_list(date)
+            if self.scraped_stock_map.empty:
+                # The list page loaded without stocks: a holiday once seen so again later (load_market_holidays)
+                date_str = date.strftime('%Y-%m-%d')
+                print(f"{self.threadIdx}: No stocks listed on {date_str}, recording it as a possible holiday")
+                self.writer.call(lambda conn: store_market_holiday(date_str, conn))
+                return self.scraped_stock_map
             print(f"Loading {len(self.scraped_stock_map)} rows into {STOCK_MAP_TABLE_NAME}")
             self.store_df_to_db(self.scraped_stock_map, STOCK_MAP_TABLE_NAME)
         return self.scraped_stock_map
@@ -84,54 +94,51 @@ class CCASSScraper:
     def scrape_stock_code_list(self, date: datetime.date) -> pd.DataFrame:
         print(f"{self.threadIdx}: Scraping stock code list")
         url = (
-            STOCK_CODE_LIST_URL + date.strftime('%Y%m%d')
+            self.stock_code_list_url + date.strftime('%Y%m%d')
         )
+        page_source = self.fetch_stock_code_list_page(url)
+        return self.parse_stock_code_list(page_source, date)
+    
+    def fetch_stock_code_list_page(self, url: str) -> str:
         self.driver.get(url)
         
-        table = WebDriverWait(self.driver, 10).until(
+        WebDriverWait(self.driver, 10).until(
             EC.visibility_of_element_located((
                 By.TAG_NAME,
                 'table'
             ))
         )
-        
-        soup = BeautifulSoup(self.driver.page_source, 'lxml')
-        
-        table = soup.find('table')
-        table_columns = [
-            'StockCode', 'StockName'    
-        ]
-        # Skipping header row (hence index starts from 1)
-        table_rows = table.find_all('tr')[1:NUMBER_OF_STOCKS_SCRAPED+2]
-        table_rows_data = []
-        for table_row in table_rows:
-            table_rows_data.append([td.get_text(strip=True) for td in table_row.find_all('td')])
-        df = pd.DataFrame(data=table_rows_data, columns=table_columns).dropna()
-        df['StockName'] = df['StockName'].str.replace("'", '')
-        df['DataDate'] = date.strftime('%Y-%m-%d')
-        df = df[['DataDate', *table_columns]]
-        return df
+        return self.driver.page_source
     
-    @acquire_lock
-    def load_existing_date_stockCode(self, date_str: str):
-        self.scraped_CCASS_date_stockCode = set(
-            pd.read_sql_query(f"Select Distinct StockCode from {CCASS_TABLE_NAME} where DataDate = '{date_str}'", self.conn)
-            .set_index('StockCode').index.tolist()
-        )
+    def parse_stock_code_list(self, page_source: str, date: datetime.date) -> pd.DataFrame:
+        return parse_stock_code_list_html(page_source, date)
+    
+    def load_scrape_progress(self, date_str: str):
+        df_progress = self.writer.call(lambda conn: load_scrape_progress(date_str, conn))
+        self.scraped_progress = {
+            stock_code: (status, attempt_count)
+            for stock_code, status, attempt_count in df_progress[['StockCode', 'Status', 'AttemptCount']].values.tolist()
+        }
+        self.scraped_progress_date = date_str
     
-    @acquire_lock
     def load_existing_stock_map_by_date(self, date_str: str):
-        self.scraped_stock_map = (
-            pd.read_sql_query(
-                f"Select StockCode, StockName from {STOCK_MAP_TABLE_NAME} where DataDate = '{date_str}'",
-                self.conn
-            )
-        )
+        self.scraped_stock_map = self.writer.call(lambda conn: load_stock_map_by_date(date_str, conn))
         
     def check_if_CCASS_scraped(self, date: datetime.date, stock_code: str) -> bool:
-        if not self.scraped_CCASS_date_stockCode:
-            self.load_existing_date_stockCode(date.strftime('%Y-%m-%d'))
-        return stock_code in self.scraped_CCASS_date_stockCode
+        # Pages stored or known to be empty are skipped, failed ones are retried
+        if self.scraped_progress_date != date.strftime('%Y-%m-%d'):
+            self.load_scrape_progress(date.strftime('%Y-%m-%d'))
+        status, _ = self.scraped_progress.get(stock_code, (None, 0))
+        return status in ('DONE', 'EMPTY')
+    
+    def record_progress(self, date: datetime.date, stock_code: str, status: str, row_count: int, elapsed: float):
+        _, attempt_count = self.scraped_progress.get(stock_code, (None, 0))
+        self.scraped_progress[stock_code] = (status, attempt_count + 1)
+        self.profiler.record_page(status, attempt_count + 1)
+        self.progress_records.append((
+            date.strftime('%Y-%m-%d'), stock_code, status, row_count, attempt_count + 1,
+            round(elapsed * 1000, 1), datetime.datetime.now()
+        ))
     
     def check_if_stock_map_scraped(self, date: datetime.date) -> bool:
         if self.scraped_stock_map.empty:
@@ -154,8 +161,9 @@ class CCASSScraper:
             EC.presence_of_element_located((By.ID, 'txtStockCode'))
         )
         # Seems in-browser JS is more stable than sendkeys under multi-thread
+        # The code is passed as an argument rather than formatted into the script
         self.driver.execute_script(
-            f"document.getElementById('txtStockCode').value = '{stock_code}'"
+            "document.getElementById('txtStockCode').value = arguments[0]", stock_code
         )
     
     def click_search_btn(self):
@@ -163,107 +171,219 @@ class CCASSScraper:
             EC.presence_of_element_located((By.ID, 'btnSearch'))
         )
         search_button.click()
+    
+    def open_search_page(self, date: datetime.date):
+        self.driver.get(self.main_url)
+        self.select_date_in_browser(date)
+    
+    def search_stock(self, date: datetime.date, stock_code: str):
+        self.input_stock_code(stock_code)
+        self.click_search_btn()
+    
+    def wait_for_search_result(self):
+        WebDriverWait(self.driver, 10).until(
+            lambda driver: driver.execute_script('return document.readyState') == 'complete'
+        )
+    
+    def get_page_source(self) -> str:
+        return self.driver.page_source
         
 
-    def parse_shareholding_table(self, date: datetime.date, stock_code: str) -> pd.DataFrame:
-        soup = BeautifulSoup(self.driver.page_source, 'lxml')
-        
-        table = soup.find(attrs={'class':'search-details-table-container table-mobile-list-container'})
-        table_columns = [
-            'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'    
-        ]
-        if not table:
-            # print("Skipping as table not found")
-            return pd.DataFrame()
-        table_rows = table.find_all('tr')[1:]
-        table_rows_data = []
-        for table_row in table_rows:
-            table_rows_data.append([td.get_text(strip=True) for td in table_row.find_all('div', attrs={'class': 'mobile-list-body'})])
-        df = pd.DataFrame(data=table_rows_data, columns=table_columns[:len(table_rows_data[0])])
-        df['ParticipantID'] = np.where(df['ParticipantID']=='', 'None', df['ParticipantID'])
-        df['ParticipantName'] = df['ParticipantName'].str.replace("'", '')
-        df['ParticipantAddress'] = df['ParticipantAddress'].str.replace("'", '')
-        df['Shareholding'] = pd.to_numeric(df['Shareholding'].str.replace(',', ''))
-        if 'FracOfShares' in df.columns:
-            df['FracOfShares'] = pd.to_numeric(df['FracOfShares'].str.replace('%', ''))
-        else:
-            df['FracOfShares'] = df['Shareholding'] / df['Shareholding'].sum() * 100
-        # Only store those with % of shares > 0.1%
-        df = df[df['FracOfShares'] > SHAREHOLDING_THRESHOLD_TO_SCRAPE]
-        df['StockCode'] = stock_code
-        df['DataDate'] = date.strftime('%Y-%m-%d')
-        df = df[['DataDate', 'StockCode', *table_columns]]
-        return df
+    def parse_shareholding_table(self, page_source: str, date: datetime.date, stock_code: str) -> pd.DataFrame:
+        return parse_shareholding_html(page_source, date, stock_code)
     
-    @acquire_lock
     def store_df_to_db(self, df_new_data: pd.DataFrame, table_name: str):
-        try:
-            store_df_to_db(df_new_data, self.conn, table_name)
-        except Exception as e:
-            print(f'write error: {e}')
+        self.writer.submit(df_new_data, table_name)
         
     def scrape_one_page(self, date: datetime.date, stock_code: str) -> bool:
         if self.check_if_CCASS_scraped(date, stock_code):
             # print("Already scraped, skipping")
             return False
         
-        self.input_stock_code(stock_code)
-        
-        self.click_search_btn()
+        with self.profiler.page():
+            return self.scrape_one_page_timed(date, stock_code)
+    
+    def scrape_one_page_timed(self, date: datetime.date, stock_code: str) -> bool:
+        start_time = time.perf_counter()
+        try:
+            with self.profiler.stage('navigation'):
+                self.search_stock(date, stock_code)
+            with self.profiler.stage('wait_for_table'):
+                self.wait_for_search_result()
+            with self.profiler.stage('page_source'):
+                page_source = self.get_page_source()
+            with self.profiler.stage('parse'):
+                parsed_df = self.parse_shareholding_table(page_source, date, stock_code)
+        except Exception as e:
+            print(f"{self.threadIdx}: Failed to scrape {date.strftime('%Y-%m-%d')}, {stock_code}: {e}")
+            self.record_progress(date, stock_code, 'FAILED', 0, time.perf_counter() - start_time)
+            # Start over from the search page for the next stock
+            self.open_search_page(date)
+            return False
         
-        parsed_df = self.parse_shareholding_table(date, stock_code)
+        # No table or all holdings under SHAREHOLDING_THRESHOLD_TO_SCRAPE
         if parsed_df.empty:
+            self.record_progress(date, stock_code, 'EMPTY', 0, time.perf_counter() - start_time)
             return False
         
-        if self.scraped_df.empty:
-            self.scraped_df = parsed_df
-        else:
-            self.scraped_df = pd.concat([
-                self.scraped_df, parsed_df
-            ])
+        with self.profiler.stage('write'):
+            self.buffer.append(parsed_df)
+        self.record_progress(date, stock_code, 'DONE', len(parsed_df), time.perf_counter() - start_time)
         return True
     
-    def scrape_for_one_day(self, date: datetime.date):
+    def flush_buffer(self):
+        # Progress is recorded after the rows, so a crash in between only causes a re-scrape
+        if len(self.buffer):
+            print(f"{self.threadIdx}: Loading {len(self.buffer)} rows into db")
+            self.store_df_to_db(self.buffer.take(), CCASS_TABLE_NAME)
+        if self.progress_records:
+            self.store_df_to_db(
+                pd.DataFrame(self.progress_records, columns=SCRAPE_PROGRESS_COLUMNS),
+                SCRAPE_PROGRESS_TABLE_NAME
+            )
+            self.progress_records = []
+    
+    def scrape_for_one_day(self, date: datetime.date, stock_codes: list = None):
+        # stock_codes: the missing stock days of the scrape plan (None = the whole stock list)
         df_stock_list = self.get_stock_code_list(date)
+        stock_codes = filter_stock_codes(df_stock_list, stock_codes)
         
-        self.driver.get(MAIN_URL)
-        self.select_date_in_browser(date)
+        self.profiler = ScrapeProfiler(self.threadIdx)
+        self.scrape_stock_codes(date, stock_codes, len(stock_codes))
         
-        self.scraped_df = pd.DataFrame()
+        print(f"Finished scraping for {date.strftime('%Y-%m-%d')}")
+        report_scrape_run(date, [self.profiler])
+    
+    def scrape_from_queue(self, date: datetime.date, stock_code_queue: queue.Queue, total: int) -> dict:
+        # Pull stock codes from the shared queue until it is drained, so slow shards do not straggle
+        def iter_queue():
+            while True:
+                try:
+                    yield stock_code_queue.get_nowait()
+                except queue.Empty:
+                    return
+        
+        start_time = time.perf_counter()
+        run_count, has_data_count = self.scrape_stock_codes(date, iter_queue(), total)
+        elapsed = time.perf_counter() - start_time
+        return {
+            'shard': self.threadIdx,
+            'pages': run_count,
+            'pages_with_data': has_data_count,
+            'seconds': round(elapsed, 1),
+            'pages_per_minute': round(run_count / elapsed * 60, 1) if elapsed else 0,
+            'profiler': self.profiler,
+        }
+    
+    def scrape_stock_codes(self, date: datetime.date, stock_codes, total: int) -> tuple:
+        self.profiler.start()
+        self.open_search_page(date)
+        
+        self.buffer = ColumnarBuffer(CCASS_TABLE_COLUMNS)
         run_count = 0
         has_data_count = 0 # Not every stock has table to be scraped
-        buffer_size = 100
-        for stock_code in df_stock_list['StockCode'].values.tolist():
+        for stock_code in stock_codes:
             has_data = self.scrape_one_page(date, stock_code)
             if run_count % 100 == 0:
-                print(f"{self.threadIdx}: Scraped for {date.strftime('%Y-%m-%d')}, {stock_code}, ({has_data_count}, {run_count}) out of {len(df_stock_list)}")
+                print(f"{self.threadIdx}: Scraped for {date.strftime('%Y-%m-%d')}, {stock_code}, ({has_data_count}, {run_count}) out of {total}")
             run_count += 1
             has_data_count += has_data * 1
-            if has_data_count % buffer_size == (buffer_size-1):
-                print(f"{self.threadIdx}: Loading {len(self.scraped_df)} rows into db")
-                self.store_df_to_db(self.scraped_df, CCASS_TABLE_NAME)
-                self.scraped_df = pd.DataFrame()
+            if self.buffer.is_full():
+                with self.profiler.stage('write'):
+                    self.flush_buffer()
                 
-        if not self.scraped_df.empty:
-            print(f"{self.threadIdx}: Loading {len(self.scraped_df)} rows into db")
-            self.store_df_to_db(self.scraped_df, CCASS_TABLE_NAME)
+        with self.profiler.stage('write'):
+            self.flush_buffer()
+        self.profiler.stop()
+        print(f"{self.threadIdx}: Wrote {self.buffer.rows_flushed} rows in {self.buffer.flush_count} flushes")
         
-        print(f"Finished scraping for {date.strftime('%Y-%m-%d')}")
+        return run_count, has_data_count
         
 
+def filter_stock_codes(df_stock_list: pd.DataFrame, stock_codes: list = None) -> list:
+    # In stock list order
+    if stock_codes is None:
+        return df_stock_list['StockCode'].values.tolist()
+    return df_stock_list.loc[df_stock_list['StockCode'].isin(stock_codes), 'StockCode'].values.tolist()
+
+def get_scraper_class():
+    if SCRAPER_ENGINE == 'HTTP':
+        # Imported here as http_scraper builds on CCASSScraper
+        from http_scraper import CCASSHttpScraper
+        return CCASSHttpScraper
+    return CCASSScraper
+
 # Func to be executed by thread
-def scrape_task(threadId: int, date: datetime.date,):
+def scrape_task(threadId: int, date: datetime.date, writer: DBWriter, stock_codes: list = None):
     print(threadId, date)
     
-    with CCASSScraper(threadId) as scraper:
-        scraper.scrape_for_one_day(date)
+    with get_scraper_class()(threadId, writer) as scraper:
+        scraper.scrape_for_one_day(date, stock_codes)
+    update_stock_metadata_for_day(date, writer)
 
+def update_stock_metadata_for_day(date: datetime.date, writer: DBWriter):
+    # Runs after the rows of the day queued before it are written
+    date_str = date.strftime('%Y-%m-%d')
+    writer.call(lambda conn: update_stock_metadata(date_str, conn))
 
-def main():
-    # scrape_task(0, DATE_RANGE_LIST[::-1][0])
+# Func to be executed by each shard of scrape_task_sharded
+def scrape_shard_task(threadId: int, date: datetime.date, writer: DBWriter,
+                      stock_code_queue: queue.Queue, total: int) -> dict:
+    with get_scraper_class()(threadId, writer) as scraper:
+        return scraper.scrape_from_queue(date, stock_code_queue, total)
+
+def scrape_task_sharded(date: datetime.date, writer: DBWriter, stock_codes: list = None,
+                        number_of_shards: int = NUMBER_OF_SHARDS_PER_DATE):
+    # Split the stock list of one date across multiple sessions / drivers
+    print(f"Scraping {date.strftime('%Y-%m-%d')} with {number_of_shards} shards")
+    with get_scraper_class()(0, writer) as scraper:
+        stock_codes = filter_stock_codes(scraper.get_stock_code_list(date), stock_codes)
+    
+    stock_code_queue = queue.Queue()
+    for stock_code in stock_codes:
+        stock_code_queue.put(stock_code)
     
-    executor = ThreadPoolExecutor(max_workers=1)
-    jobs = [executor.submit(scrape_task, i, DATE_RANGE_LIST[::-1][i]) for i in range(0, len(DATE_RANGE_LIST))]
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=number_of_shards) as executor:
+        jobs = [
+            executor.submit(scrape_shard_task, i, date, writer, stock_code_queue, len(stock_codes))
+            for i in range(number_of_shards)
+        ]
+        shard_stats = [job.result() for job in jobs]
+    elapsed = time.perf_counter() - start_time
+    update_stock_metadata_for_day(date, writer)
+    
+    for stats in shard_stats:
+        print(
+            f"Shard {stats['shard']}: {stats['pages']} pages ({stats['pages_with_data']} with data) "
+            f"in {stats['seconds']}s, {stats['pages_per_minute']} pages/min"
+        )
+    total_pages = sum(stats['pages'] for stats in shard_stats)
+    print(
+        f"Finished scraping for {date.strftime('%Y-%m-%d')}: {total_pages} pages in {elapsed:.1f}s, "
+        f"{total_pages / elapsed * 60 if elapsed else 0:.1f} pages/min"
+    )
+    report_scrape_run(date, [stats['profiler'] for stats in shard_stats], elapsed)
+    return shard_stats
+
+
+def main():
+    with DBWriter() as writer:
+        # Dates out of the retention window first, then the missing stock days of the window
+        writer.call(prune_expired_data)
+        # Latest date first as the daily T+1 update is latency critical
+        plan = writer.call(plan_scrape)
+        print_plan(plan)
+        if NUMBER_OF_SHARDS_PER_DATE > 1:
+            for date, stock_codes in plan:
+                scrape_task_sharded(date, writer, stock_codes)
+            return
+        
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            jobs = [
+                executor.submit(scrape_task, i, date, writer, stock_codes)
+                for i, (date, stock_codes) in enumerate(plan)
+            ]
     
         
 if __name__ == '__main__':
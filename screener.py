@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Market-wide screener of shareholding changes between two dates
+
+Rather than one transaction finder query per stock, the holdings of all stocks on the two
+snapshot dates are read in SCREENER_PARTITIONS partitions of the stock list, in parallel
+(one pooled connection each, so the DB scans them on several cores), and the changes of each
+partition are computed with one vectorized pivot. The largest moves market-wide are ranked.
+
+Run:
+    python screener.py 2022-06-01 2022-06-30 [--threshold 1]
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from config import SCREENER_PARTITIONS, SCREENER_MAX_ROWS, SCREENER_DATA_COLUMNS
+from metrics import instrument
+from parsers import get_participant_keys
+from util import ConnectionPool, get_snapshot_data_date, load_stock_map_by_date, load_shareholding_snapshots
+
+
+def split_stock_partitions(stock_codes: list, number_of_partitions: int) -> list:
+    return [list(codes) for codes in np.array_split(np.array(stock_codes), number_of_partitions) if len(codes)]
+
+def compute_shareholding_changes(df: pd.DataFrame, start_date_str: str, end_date_str: str,
+    threshold: float) -> pd.DataFrame:
+    # df: holdings on the two dates; a participant missing on one date holds 0 on it
+    df = get_participant_keys(df)
+    key_columns = ['StockCode', 'ParticipantID', 'ParticipantKey']
+    df_frac = df.pivot_table(
+        index=key_columns, columns='DataDate', values='FracOfShares', aggfunc='last'
+    )
+    start_frac = df_frac[start_date_str].fillna(0) if start_date_str in df_frac else 0
+    end_frac = df_frac[end_date_str].fillna(0) if end_date_str in df_frac else 0
+    df_changes = pd.DataFrame({
+        'startFracOfShare': start_frac,
+        'endFracOfShare': end_frac,
+    }, index=df_frac.index)
+    df_changes['ChangeInPercentShares'] = (df_changes['endFracOfShare'] - df_changes['startFracOfShare']).round(2)
+    df_changes = df_changes[df_changes['ChangeInPercentShares'].abs() >= threshold]
+    # Latest name of each participant
+    participant_names = (
+        df.sort_values('DataDate')
+        .drop_duplicates(key_columns, keep='last')
+        .set_index(key_columns)['ParticipantName']
+    )
+    df_changes['ParticipantName'] = participant_names.reindex(df_changes.index).values
+    return df_changes.reset_index().drop(columns='ParticipantKey')
+
+@instrument('query', 'start_date_str', 'end_date_str')
+def screen_market(start_date_str: str, end_date_str: str, threshold: float, pool: ConnectionPool,
+    number_of_partitions: int = SCREENER_PARTITIONS, max_rows: int = SCREENER_MAX_ROWS) -> pd.DataFrame:
+    start_time = time.perf_counter()
+    with pool.connection() as conn:
+        # Same snapshot dates as the transaction finder
+        start_snapshot_date_str = get_snapshot_data_date(start_date_str, conn)
+        end_snapshot_date_str = get_snapshot_data_date(end_date_str, conn)
+        snapshot_date_strs = sorted({d for d in (start_snapshot_date_str, end_snapshot_date_str) if d})
+        # Stocks listed on either date, so delisted ones are screened too
+        df_stocks = pd.concat(
+            [load_stock_map_by_date(date_str, conn) for date_str in snapshot_date_strs]
+            or [pd.DataFrame(columns=['StockCode', 'StockName'])]
+        ).drop_duplicates('StockCode', keep='last')
+    if df_stocks.empty:
+        return pd.DataFrame(columns=SCREENER_DATA_COLUMNS)
+
+    def screen_partition(stock_codes: list) -> pd.DataFrame:
+        with pool.connection() as conn:
+            df = load_shareholding_snapshots(snapshot_date_strs, stock_codes, conn)
+        return compute_shareholding_changes(df, start_snapshot_date_str, end_snapshot_date_str, threshold)
+
+    partitions = split_stock_partitions(sorted(df_stocks['StockCode'].values.tolist()), number_of_partitions)
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        df_changes = pd.concat(list(executor.map(screen_partition, partitions)), ignore_index=True)
+
+    df_changes = (
+        df_changes.iloc[np.argsort(-df_changes['ChangeInPercentShares'].abs().values, kind='stable')]
+        .head(max_rows)
+        .merge(df_stocks, on='StockCode', how='left')
+    )
+    df_changes['Rank'] = np.arange(1, len(df_changes) + 1)
+    print(
+        f"Screened {len(df_stocks)} stocks between {start_snapshot_date_str} and {end_snapshot_date_str} "
+        f"in {len(partitions)} partitions in {time.perf_counter() - start_time:.2f}s"
+    )
+    return df_changes[SCREENER_DATA_COLUMNS]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('start_date')
+    parser.add_argument('end_date')
+    parser.add_argument('--threshold', type=float, default=1)
+    args = parser.parse_args()
+
+    pool = ConnectionPool()
+    try:
+        df = screen_market(args.start_date, args.end_date, args.threshold, pool)
+    finally:
+        pool.close()
+    print(df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Normalized, compact schema for the SQLite backend (SQLITE_SCHEMA=NORMALIZED)
+
+    Stock(StockKey, StockCode)
+    Participant(ParticipantKey, ParticipantID, ParticipantName, ParticipantAddress)
+    CCASSFact(StockKey, DataDate as yyyymmdd integer, ParticipantKey, Shareholding, FracOfShares)
+        WITHOUT ROWID, clustered on (StockKey, DataDate, ParticipantKey)
+
+A view named CCASS decodes the fact table into the original layout, with an INSTEAD OF INSERT trigger,
+so the scraper and any query on CCASS keep working unchanged.
+
+A participant whose name or address changes gets a new ParticipantKey, so the queries on the fact
+table match participants on ParticipantID, like the queries on the legacy table.
+
+Migrate an existing database (the old table is kept as CCASS_legacy unless --drop-legacy):
+    python sqlite_normalized.py [--db ccass.db] [--drop-legacy]
+"""
+
+import argparse
+import sqlite3
+import time
+
+from config import (
+    SQLITE_DB_NAME, CCASS_TABLE_NAME, CCASS_FACT_TABLE_NAME,
+    STOCK_TABLE_NAME, PARTICIPANT_TABLE_NAME
+)
+
+LEGACY_CCASS_TABLE_NAME = f'{CCASS_TABLE_NAME}_legacy'
+
+# yyyymmdd integer <-> 'yyyy-mm-dd' text
+DATE_TO_TEXT_SQL = "printf('%04d-%02d-%02d', {col} / 10000, {col} / 100 % 100, {col} % 100)"
+DATE_TO_INT_SQL = "cast(replace({col}, '-', '') as integer)"
+
+
+def date_str_to_int(date_str: str) -> int:
+    return int(date_str.replace('-', ''))
+
+def create_normalized_tables(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS
+        {STOCK_TABLE_NAME}(
+          StockKey integer PRIMARY KEY,
+          StockCode text UNIQUE
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS
+        {PARTICIPANT_TABLE_NAME}(
+          ParticipantKey integer PRIMARY KEY,
+          ParticipantID text,
+          ParticipantName text,
+          ParticipantAddress text,
+          UNIQUE (ParticipantID, ParticipantName, ParticipantAddress)
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS
+        {CCASS_FACT_TABLE_NAME}(
+          StockKey integer,
+          DataDate integer,
+          ParticipantKey integer,
+          Shareholding integer,
+          FracOfShares real,
+          PRIMARY KEY (StockKey, DataDate, ParticipantKey)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute(f"""
+        CREATE VIEW IF NOT EXISTS
+        {CCASS_TABLE_NAME} AS
+        select
+          {DATE_TO_TEXT_SQL.format(col='f.DataDate')} as DataDate,
+          s.StockCode,
+          p.ParticipantID,
+          p.ParticipantName,
+          p.ParticipantAddress,
+          f.Shareholding,
+          f.FracOfShares
+        from {CCASS_FACT_TABLE_NAME} f
+        inner join {STOCK_TABLE_NAME} s on f.StockKey = s.StockKey
+        inner join {PARTICIPANT_TABLE_NAME} p on f.ParticipantKey = p.ParticipantKey
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS
+        {CCASS_TABLE_NAME}_insert INSTEAD OF INSERT ON {CCASS_TABLE_NAME}
+        BEGIN
+          INSERT OR IGNORE INTO {STOCK_TABLE_NAME}(StockCode) VALUES (NEW.StockCode);
+          INSERT OR IGNORE INTO {PARTICIPANT_TABLE_NAME}(ParticipantID, ParticipantName, ParticipantAddress)
+            VALUES (NEW.ParticipantID, NEW.ParticipantName, NEW.ParticipantAddress);
+          INSERT OR REPLACE INTO {CCASS_FACT_TABLE_NAME} VALUES (
+            (SELECT StockKey FROM {STOCK_TABLE_NAME} WHERE StockCode = NEW.StockCode),
+            {DATE_TO_INT_SQL.format(col='NEW.DataDate')},
+            (SELECT ParticipantKey FROM {PARTICIPANT_TABLE_NAME}
+             WHERE ParticipantID = NEW.ParticipantID
+             AND ParticipantName = NEW.ParticipantName
+             AND ParticipantAddress = NEW.ParticipantAddress),
+            NEW.Shareholding,
+            NEW.FracOfShares
+          );
+        END
+    """)
+    connection.commit()
+    cursor.close()
+
+def migrate(connection: sqlite3.Connection, drop_legacy: bool = False):
+    start_time = time.perf_counter()
+    object_type = connection.execute(
+        "select type from sqlite_master where name = ?", (CCASS_TABLE_NAME,)
+    ).fetchone()
+    if object_type is None or object_type[0] != 'table':
+        print(f"{CCASS_TABLE_NAME} is not a table, nothing to migrate")
+        return
+
+    with connection:
+        connection.execute(f"ALTER TABLE {CCASS_TABLE_NAME} RENAME TO {LEGACY_CCASS_TABLE_NAME}")
+    create_normalized_tables(connection)
+
+    with connection:
+        print("Loading stocks")
+        connection.execute(f"""
+            INSERT OR IGNORE INTO {STOCK_TABLE_NAME}(StockCode)
+            SELECT DISTINCT StockCode FROM {LEGACY_CCASS_TABLE_NAME} ORDER BY StockCode
+        """)
+        print("Loading participants")
+        connection.execute(f"""
+            INSERT OR IGNORE INTO {PARTICIPANT_TABLE_NAME}(ParticipantID, ParticipantName, ParticipantAddress)
+            SELECT DISTINCT ParticipantID, ParticipantName, ParticipantAddress FROM {LEGACY_CCASS_TABLE_NAME}
+        """)
+        print("Loading shareholding")
+        # Sorted by the clustered key so pages are filled sequentially
+        connection.execute(f"""
+            INSERT OR IGNORE INTO {CCASS_FACT_TABLE_NAME}
+            SELECT
+              s.StockKey,
+              {DATE_TO_INT_SQL.format(col='c.DataDate')},
+              p.ParticipantKey,
+              c.Shareholding,
+              c.FracOfShares
+            FROM {LEGACY_CCASS_TABLE_NAME} c
+            INNER JOIN {STOCK_TABLE_NAME} s ON c.StockCode = s.StockCode
+            INNER JOIN {PARTICIPANT_TABLE_NAME} p
+              ON c.ParticipantID = p.ParticipantID
+              AND c.ParticipantName = p.ParticipantName
+              AND c.ParticipantAddress = p.ParticipantAddress
+            ORDER BY 1, 2, 3
+        """)
+
+    legacy_count = connection.execute(f"select count(*) from {LEGACY_CCASS_TABLE_NAME}").fetchone()[0]
+    fact_count = connection.execute(f"select count(*) from {CCASS_FACT_TABLE_NAME}").fetchone()[0]
+    print(f"Migrated {legacy_count} rows into {fact_count} rows (duplicates removed)")
+
+    if drop_legacy:
+        with connection:
+            connection.execute(f"DROP TABLE {LEGACY_CCASS_TABLE_NAME}")
+        print("Reclaiming space")
+        connection.execute("VACUUM")
+    print(f"Finished in {time.perf_counter() - start_time:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=SQLITE_DB_NAME)
+    parser.add_argument('--drop-legacy', action='store_true')
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.db)
+    try:
+        migrate(connection, args.drop_legacy)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Server side paging, sorting and filtering for DataTables with page_action / sort_action /
+filter_action = 'custom'
+
+The table sends filter_query, sort_by and the page it shows; they are applied to the
+(cached) query result and only that page is sent back.
+"""
+
+import math
+import re
+
+import pandas as pd
+
+from metrics import instrument
+
+FILTER_OPERATORS = {
+    '>=': 'ge', '<=': 'le', '<': 'lt', '>': 'gt', '!=': 'ne', '=': 'eq',
+    'ge': 'ge', 'le': 'le', 'lt': 'lt', 'gt': 'gt', 'ne': 'ne', 'eq': 'eq',
+    'contains': 'contains', 'datestartswith': 'datestartswith',
+}
+# {column}, then a symbol or keyword operator, then the value (the rest, which may contain anything)
+FILTER_PART_PATTERN = re.compile(r'^\s*\{(?P<name>[^}]*)\}\s*(?P<operator>[<>!=]=?|[a-z]+)(?P<value>.*)$', re.DOTALL)
+
+
+def split_filter_part(filter_part: str) -> tuple:
+    # '{FracOfShares} >= 5' -> ('FracOfShares', 'ge', 5.0)
+    match = FILTER_PART_PATTERN.match(filter_part)
+    if match is None:
+        return None, None, None
+    operator = FILTER_OPERATORS.get(match['operator'])
+    value_part = match['value']
+    # A keyword operator must be followed by a space, e.g. '{Name} containsx' is not a filter
+    if operator is None or (match['operator'].isalpha() and value_part[:1] not in ('', ' ')):
+        return None, None, None
+    value_part = value_part.strip()
+    if len(value_part) >= 2 and value_part[0] == value_part[-1] and value_part[0] in ("'", '"', '`'):
+        value = value_part[1:-1].replace('\\' + value_part[0], value_part[0])
+    else:
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+    return match['name'], operator, value
+
+def apply_filter_query(df: pd.DataFrame, filter_query: str) -> pd.DataFrame:
+    if not filter_query:
+        return df
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in df.columns:
+            continue
+        s = df[col_name]
+        if operator in ('ge', 'le', 'lt', 'gt', 'ne', 'eq'):
+            if pd.api.types.is_numeric_dtype(s) and isinstance(filter_value, str):
+                continue
+            if not pd.api.types.is_numeric_dtype(s):
+                filter_value = str(filter_value)
+            mask = getattr(s, operator)(filter_value)
+        elif operator == 'contains':
+            mask = s.astype(str).str.contains(str(filter_value), case=False, regex=False)
+        elif operator == 'datestartswith':
+            mask = s.astype(str).str.startswith(str(filter_value))
+        else:
+            continue
+        df = df.loc[mask]
+    return df
+
+def apply_sort_by(df: pd.DataFrame, sort_by: list) -> pd.DataFrame:
+    sort_by = [col for col in (sort_by or []) if col['column_id'] in df.columns]
+    if not sort_by:
+        return df
+    return df.sort_values(
+        [col['column_id'] for col in sort_by],
+        ascending=[col['direction'] == 'asc' for col in sort_by],
+        kind='mergesort'
+    )
+
+@instrument('transform')
+def get_page(df: pd.DataFrame, filter_query: str, sort_by: list, page_current: int, page_size: int) -> tuple:
+    # Returns (records of the page, number of pages)
+    df = apply_sort_by(apply_filter_query(df, filter_query), sort_by)
+    page_count = max(1, math.ceil(len(df) / page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    df_page = df.iloc[page_current * page_size: (page_current + 1) * page_size]
+    return df_page.to_dict('records'), page_count
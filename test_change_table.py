@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the holdings change checkpoints (change_table.py)
+
+Run:
+    python -m pytest test_change_table.py
+"""
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import change_table
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, CCASS_CHANGE_TABLE_NAME
+from util import create_table, store_df_to_db
+
+DATE_STRS = ['2022-03-01', '2022-03-02', '2022-03-03']
+# (ParticipantID, ParticipantName) -> FracOfShares on each date (None = not in CCASS)
+HOLDINGS = {
+    ('C00001', 'BANK A'): [10.0, 11.0, 12.0],
+    ('C00002', 'BANK B'): [3.0, 3.0, None],
+    ('C00003', 'BANK C'): [None, 2.0, 2.5],
+    # Without a CCASS ID
+    ('None', 'INVESTOR A'): [5.0, 3.0, 1.0],
+    ('None', 'INVESTOR B'): [1.0, 3.0, 5.0],
+}
+
+
+def make_ccass_rows() -> pd.DataFrame:
+    return pd.DataFrame([
+        (date_str, '00001', participant_id, participant_name, 'HONG KONG', int(frac * 1000), frac)
+        for (participant_id, participant_name), fracs in HOLDINGS.items()
+        for date_str, frac in zip(DATE_STRS, fracs)
+        if frac is not None
+    ], columns=[
+        'DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'
+    ])
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'ccass.db')
+    create_table(conn)
+    store_df_to_db(make_ccass_rows(), conn, CCASS_TABLE_NAME)
+    store_df_to_db(pd.DataFrame(
+        [(date_str, '00001', 'STOCK 1') for date_str in DATE_STRS], columns=['DataDate', 'StockCode', 'StockName']
+    ), conn, STOCK_MAP_TABLE_NAME)
+    yield conn
+    conn.close()
+
+def get_delta(conn, start_date_str: str, end_date_str: str) -> list:
+    df = change_table.get_shareholding_delta_for_transaction_finder('00001', start_date_str, end_date_str, conn)
+    return sorted(df[['ParticipantID', 'ParticipantName', 'startFracOfShare', 'endFracOfShare']].values.tolist())
+
+def read_checkpoints(conn) -> pd.DataFrame:
+    return pd.read_sql_query(
+        f"select * from {CCASS_CHANGE_TABLE_NAME} order by StockCode, ParticipantID, ParticipantKey, DataDate", conn
+    )
+
+
+def test_delta(conn):
+    change_table.rebuild_change_table(conn)
+    assert get_delta(conn, '2022-03-01', '2022-03-03') == [
+        ['C00001', 'BANK A', 10.0, 12.0],
+        ['C00002', 'BANK B', 3.0, 0.0],
+        ['C00003', 'BANK C', 0.0, 2.5],
+        ['None', 'INVESTOR A', 5.0, 1.0],
+        ['None', 'INVESTOR B', 1.0, 5.0],
+    ]
+    assert get_delta(conn, '2022-03-02', '2022-03-02') == [
+        ['C00001', 'BANK A', 11.0, 11.0],
+        ['C00002', 'BANK B', 3.0, 3.0],
+        ['C00003', 'BANK C', 2.0, 2.0],
+        ['None', 'INVESTOR A', 3.0, 3.0],
+        ['None', 'INVESTOR B', 3.0, 3.0],
+    ]
+
+def test_update_in_any_order(conn):
+    change_table.rebuild_change_table(conn)
+    df_rebuilt = read_checkpoints(conn)
+
+    conn.execute(f"DELETE FROM {CCASS_CHANGE_TABLE_NAME}")
+    conn.commit()
+    for date_str in ('2022-03-02', '2022-03-03', '2022-03-01'):
+        change_table.update_change_table(conn, pd.DataFrame({
+            'DataDate': [date_str], 'StockCode': ['00001'], 'Status': ['DONE']
+        }))
+    pd.testing.assert_frame_equal(read_checkpoints(conn), df_rebuilt)
+
+def test_table_without_participant_key_is_rebuilt(conn):
+    conn.execute(f"DROP TABLE IF EXISTS {CCASS_CHANGE_TABLE_NAME}")
+    conn.execute(f"""
+        CREATE TABLE {CCASS_CHANGE_TABLE_NAME}(
+          StockCode text, ParticipantID text, DataDate text, ParticipantName text,
+          FracOfShares real, ChangeInFracOfShares real,
+          PRIMARY KEY (StockCode, ParticipantID, DataDate)
+        ) WITHOUT ROWID
+    """)
+    change_table.create_change_table(conn)
+    assert get_delta(conn, '2022-03-01', '2022-03-03')[3:] == [
+        ['None', 'INVESTOR A', 5.0, 1.0],
+        ['None', 'INVESTOR B', 1.0, 5.0],
+    ]
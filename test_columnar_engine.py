@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that the columnar engine (columnar_engine.py) returns the same results as the SQL queries,
+on data with gaps
+
+Run:
+    python -m pytest test_columnar_engine.py
+"""
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import queries
+from columnar_engine import ColumnarEngine, export_columnar
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME
+from queries import read_query
+from sqlite_normalized import date_str_to_int
+from util import create_table, store_df_to_db
+
+DATE_STRS = ['2022-03-01', '2022-03-02', '2022-03-03', '2022-03-04', '2022-03-07', '2022-03-08']
+# 00005 has no data on 03-04 (e.g. a failed page), there is no stock list on 03-07
+MISSING_STOCK_DAYS = {('2022-03-04', '00005')}
+DATES_WITHOUT_STOCK_LIST = {'2022-03-07'}
+
+
+def make_ccass_rows() -> pd.DataFrame:
+    rows = []
+    for day, date_str in enumerate(DATE_STRS):
+        for stock_code in ('00001', '00005'):
+            if (date_str, stock_code) in MISSING_STOCK_DAYS:
+                continue
+            for i in range(12):
+                shareholding = 1000 * (i + 1) + 100 * day * (-1) ** i
+                rows.append((
+                    date_str, stock_code, f'C{i:05d}', f'PARTICIPANT {i}', 'HONG KONG',
+                    shareholding, round(shareholding / 1000, 2)
+                ))
+    return pd.DataFrame(rows, columns=[
+        'DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'
+    ])
+
+@pytest.fixture
+def conn_and_engine(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'ccass.db')
+    create_table(conn)
+    store_df_to_db(make_ccass_rows(), conn, CCASS_TABLE_NAME)
+    store_df_to_db(pd.DataFrame(
+        [(date_str, stock_code, f'STOCK {stock_code}') for date_str in DATE_STRS if date_str not in DATES_WITHOUT_STOCK_LIST
+         for stock_code in ('00001', '00005')],
+        columns=['DataDate', 'StockCode', 'StockName']
+    ), conn, STOCK_MAP_TABLE_NAME)
+    data_dir = tmp_path / 'columnar'
+    data_dir.mkdir()
+    export_columnar(conn, str(data_dir))
+    yield conn, ColumnarEngine(str(data_dir))
+    conn.close()
+
+def read_sql(query, conn, stock_code: str, start_date_str: str, end_date_str: str) -> pd.DataFrame:
+    return read_query(
+        query, conn, stock_code=stock_code, start_date=start_date_str, end_date=end_date_str,
+        start_date_int=date_str_to_int(start_date_str), end_date_int=date_str_to_int(end_date_str)
+    )
+
+def assert_same_rows(df_sql: pd.DataFrame, df_columnar: pd.DataFrame):
+    columns = list(df_sql.columns)
+    pd.testing.assert_frame_equal(
+        df_columnar[columns].sort_values(columns).reset_index(drop=True),
+        df_sql.sort_values(columns).reset_index(drop=True),
+        check_dtype=False
+    )
+
+DATE_RANGES = [
+    ('00005', '2022-03-01', '2022-03-04'),
+    ('00005', '2022-03-04', '2022-03-08'),
+    ('00001', '2022-03-02', '2022-03-07'),
+    ('00005', '2022-02-01', '2022-03-07'),
+]
+
+
+@pytest.mark.parametrize('stock_code, start_date_str, end_date_str', DATE_RANGES)
+def test_shareholding_delta(conn_and_engine, stock_code, start_date_str, end_date_str):
+    conn, engine = conn_and_engine
+    assert_same_rows(
+        read_sql(queries.SHAREHOLDING_DELTA, conn, stock_code, start_date_str, end_date_str),
+        engine.get_shareholding_delta_for_transaction_finder(stock_code, start_date_str, end_date_str)
+    )
+
+@pytest.mark.parametrize('stock_code, start_date_str, end_date_str', DATE_RANGES)
+def test_shareholding_time_series(conn_and_engine, stock_code, start_date_str, end_date_str):
+    conn, engine = conn_and_engine
+    assert_same_rows(
+        read_sql(queries.SHAREHOLDING_TIME_SERIES_FOR_TOP_PARTICIPANTS, conn, stock_code, start_date_str, end_date_str),
+        engine.get_shareholding_time_series_for_top_participants(stock_code, start_date_str, end_date_str)
+    )
+
+def test_snapshot_without_data_on_stock_list_date(conn_and_engine):
+    # The snapshot of 03-04 is 03-04 for every stock: 00005 holds nothing then, not its 03-03 holdings
+    _, engine = conn_and_engine
+    df = engine.get_shareholding_delta_for_transaction_finder('00005', '2022-03-01', '2022-03-04')
+    assert (df['endFracOfShare'] == 0).all()
+    assert (df['endDataDate'] == '2022-03-04').all()
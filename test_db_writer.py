@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the writer thread (db_writer.py) on SQLite
+
+Run:
+    python -m pytest test_db_writer.py
+"""
+
+import datetime
+
+import pandas as pd
+import pytest
+
+import util
+from config import STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME, SCRAPE_PROGRESS_COLUMNS
+from db_writer import DBWriter
+
+
+@pytest.fixture(autouse=True)
+def sqlite_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'DB_TYPE', 'SQLITE')
+    monkeypatch.setattr(util, 'SQLITE_DB_NAME', str(tmp_path / 'ccass.db'))
+
+def make_stock_map() -> pd.DataFrame:
+    return pd.DataFrame({'DataDate': ['2022-07-04'], 'StockCode': ['00001'], 'StockName': ['STOCK 1']})
+
+def make_progress() -> pd.DataFrame:
+    return pd.DataFrame(
+        [('2022-07-04', '00001', 'DONE', 3, 1, 10.0, datetime.datetime(2022, 7, 4, 18))], columns=SCRAPE_PROGRESS_COLUMNS
+    )
+
+def count_rows(conn, table_name: str) -> int:
+    return conn.execute(f"select count(*) from {table_name}").fetchone()[0]
+
+
+def test_write_and_call():
+    with DBWriter(defer_index_creation=False) as writer:
+        writer.submit(make_stock_map(), STOCK_MAP_TABLE_NAME)
+        # Pending writes go first
+        assert writer.call(lambda conn: count_rows(conn, STOCK_MAP_TABLE_NAME)) == 1
+
+def test_failed_progress_write_keeps_writer(monkeypatch):
+    def fail(df):
+        raise ValueError('bad progress')
+    with DBWriter(defer_index_creation=False) as writer:
+        monkeypatch.setattr(writer, 'mark_failed_stock_days', fail)
+        writer.submit(make_progress(), SCRAPE_PROGRESS_TABLE_NAME)
+        assert writer.call(lambda conn: count_rows(conn, SCRAPE_PROGRESS_TABLE_NAME)) == 0
+        assert writer.write_errors == 1
+        assert writer.error is None
+
+def test_error_stops_writer(monkeypatch):
+    def fail(batches):
+        raise RuntimeError('writer bug')
+    with DBWriter(defer_index_creation=False) as writer:
+        monkeypatch.setattr(writer, 'write_batches', fail)
+        # The call waiting on the writer fails rather than hanging
+        with pytest.raises(RuntimeError):
+            writer.call(lambda conn: None)
+        with pytest.raises(RuntimeError):
+            writer.submit(make_stock_map(), STOCK_MAP_TABLE_NAME)
+        with pytest.raises(RuntimeError):
+            writer.call(lambda conn: None)
+    assert not writer.is_alive()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the HTTP engine (http_scraper.py) against a local stub of the HKEX pages
+
+The stub serves a search form with hidden ASP.NET fields, checks that they are posted back
+and answers with a result page in the layout of searchsdw.aspx.
+
+Run:
+    python -m pytest test_http_scraper.py
+"""
+
+import datetime
+import http.server
+import threading
+import urllib.parse
+
+import pandas as pd
+import pytest
+import requests
+
+from http_scraper import CCASSHttpScraper, parse_form_fields
+
+VIEWSTATE = 'dDwtMTIzNDU2Nzg5Ozs+'
+EVENT_VALIDATION = '/wEWAgKp8Z0B'
+SEARCH_PAGE = f"""
+    <html><body><form method="post" action="./searchsdw.aspx" id="form1">
+        <input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{VIEWSTATE}" />
+        <input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{EVENT_VALIDATION}" />
+        <input type="hidden" name="today" value="20220401" />
+        <input type="text" name="txtShareholdingDate" value="2022/03/31" />
+        <input type="text" name="txtStockCode" />
+        <input type="submit" name="btnSearch" value="Search" />
+    </form></body></html>
+"""
+STOCK_LIST_PAGE = """
+    <html><body><table>
+        <tr><th>Stock Code</th><th>Name</th></tr>
+        <tr><td>00001</td><td>CKH HOLDINGS</td></tr>
+        <tr><td>00005</td><td>HSBC HOLDINGS</td></tr>
+    </table></body></html>
+"""
+EMPTY_STOCK_CODE = '00007'
+ERROR_STOCK_CODE = '00009'
+
+
+def make_result_page(stock_code: str, number_of_participants: int = 20) -> str:
+    # The participants' holdings differ by stock, so the pages of two stocks tell apart
+    seed = int(stock_code)
+    rows = ''.join(f"""
+        <tr>
+            <td class="col-participant-id"><div class="mobile-list-heading">Participant ID:</div><div class="mobile-list-body">{'C%05d' % i if i else ''}</div></td>
+            <td class="col-participant-name"><div class="mobile-list-heading">Name of CCASS Participant:</div><div class="mobile-list-body">PARTICIPANT {i} SECURITIES LIMITED</div></td>
+            <td class="col-address"><div class="mobile-list-heading">Address:</div><div class="mobile-list-body">{i} QUEEN'S ROAD CENTRAL, HONG KONG</div></td>
+            <td class="col-shareholding text-right"><div class="mobile-list-heading">Shareholding:</div><div class="mobile-list-body">{(i + 1) * seed * 1000:,}</div></td>
+            <td class="col-shareholding-percent text-right"><div class="mobile-list-heading">% of the total number of Issued Shares:</div><div class="mobile-list-body">{i + 1}.{seed:02d}%</div></td>
+        </tr>""" for i in range(number_of_participants))
+    return f"""
+        <html><body>
+        <div class="search-details-table-container table-mobile-list-container">
+            <table class="table table-scroll table-sort table-mobile-list">
+                <thead><tr><th>Participant ID</th><th>Name of CCASS Participant</th><th>Address</th><th>Shareholding</th><th>%</th></tr></thead>
+                <tbody>{rows}</tbody>
+            </table>
+        </div>
+        </body></html>
+    """
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_page(self, page: str, status: int = 200):
+        body = page.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/ccass_stock_list.htm'):
+            self.server.stock_list_urls.append(self.path)
+            self.send_page(STOCK_LIST_PAGE)
+        else:
+            self.send_page(SEARCH_PAGE)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        form = {k: v[0] for k, v in urllib.parse.parse_qs(self.rfile.read(length).decode(), keep_blank_values=True).items()}
+        self.server.posts.append(form)
+        if form.get('__VIEWSTATE') != VIEWSTATE or form.get('__EVENTVALIDATION') != EVENT_VALIDATION:
+            # What ASP.NET does when the view state is not posted back
+            self.send_page('<html>Validation of viewstate MAC failed</html>', 500)
+        elif form['txtStockCode'] == ERROR_STOCK_CODE:
+            self.send_page('<html>Not Found</html>', 404)
+        elif form['txtStockCode'] == EMPTY_STOCK_CODE:
+            self.send_page('<html><body>No match record found.</body></html>')
+        else:
+            self.send_page(make_result_page(form['txtStockCode']))
+
+
+class StubWriter:
+    # Nothing scraped yet, the scraper only reads the progress journal through the writer
+
+    def call(self, func):
+        return pd.DataFrame(columns=['StockCode', 'Status', 'AttemptCount'])
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.posts = []
+    server.stock_list_urls = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def scraper(server):
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    with CCASSHttpScraper(
+        0, StubWriter(),
+        main_url=f'{base_url}/searchsdw.aspx',
+        stock_code_list_url=f'{base_url}/ccass_stock_list.htm?sortby=stockcode&shareholdingdate='
+    ) as scraper:
+        yield scraper
+
+
+def test_parse_form_fields():
+    fields = parse_form_fields(SEARCH_PAGE)
+    assert fields == {
+        '__VIEWSTATE': VIEWSTATE,
+        '__EVENTVALIDATION': EVENT_VALIDATION,
+        'today': '20220401',
+        'txtShareholdingDate': '2022/03/31',
+        'txtStockCode': '',
+    }
+
+def test_search_posts_back_form_fields(server, scraper):
+    date = datetime.date(2022, 3, 1)
+    scraper.open_search_page(date)
+    scraper.search_stock(date, '00001')
+    scraper.search_stock(date, '00005')
+
+    # The hidden fields of the search page are reused for every search of the date
+    assert len(server.posts) == 2
+    for form, stock_code in zip(server.posts, ['00001', '00005']):
+        assert form['__VIEWSTATE'] == VIEWSTATE
+        assert form['__EVENTVALIDATION'] == EVENT_VALIDATION
+        assert form['today'] == '20220401'
+        assert form['__EVENTTARGET'] == 'btnSearch'
+        assert form['__EVENTARGUMENT'] == ''
+        assert form['txtShareholdingDate'] == '2022/03/01'
+        assert form['txtStockCode'] == stock_code
+        assert 'btnSearch' not in form
+    assert scraper.get_page_source() == make_result_page('00005')
+
+def test_search_without_search_page_fails(server, scraper):
+    # Posting without the view state is rejected by the server (retried as a 500 first)
+    scraper.initialize_client()
+    with pytest.raises(requests.RequestException):
+        scraper.search_stock(datetime.date(2022, 3, 1), '00001')
+
+def test_scrape_one_page(server, scraper):
+    date = datetime.date(2022, 3, 1)
+    scraper.open_search_page(date)
+
+    assert scraper.scrape_one_page(date, '00001')
+    df = scraper.buffer.take()
+    assert len(df) > 0
+    assert (df['StockCode'] == '00001').all()
+    assert (df['DataDate'] == '2022-03-01').all()
+
+    assert not scraper.scrape_one_page(date, EMPTY_STOCK_CODE)
+    assert not scraper.scrape_one_page(date, ERROR_STOCK_CODE)
+    # The scraper starts over from the search page after a failure and carries on
+    assert scraper.scrape_one_page(date, '00005')
+
+    statuses = {record[1]: record[2] for record in scraper.progress_records}
+    assert statuses == {'00001': 'DONE', EMPTY_STOCK_CODE: 'EMPTY', ERROR_STOCK_CODE: 'FAILED', '00005': 'DONE'}
+
+def test_scrape_stock_code_list(server, scraper):
+    df = scraper.scrape_stock_code_list(datetime.date(2022, 3, 1))
+    assert server.stock_list_urls == ['/ccass_stock_list.htm?sortby=stockcode&shareholdingdate=20220301']
+    assert df.values.tolist() == [
+        ['2022-03-01', '00001', 'CKH HOLDINGS'],
+        ['2022-03-01', '00005', 'HSBC HOLDINGS'],
+    ]
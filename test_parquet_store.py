@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the compaction of the Parquet backend (parquet_store.py)
+
+Run:
+    python -m pytest test_parquet_store.py
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import parquet_store
+from config import CCASS_TABLE_NAME
+from parquet_store import ParquetStore
+
+DATE_STR = '2022-07-04'
+
+
+def make_ccass_rows(stock_codes: list) -> pd.DataFrame:
+    return pd.DataFrame({
+        'DataDate': DATE_STR,
+        'StockCode': stock_codes,
+        'ParticipantID': 'C00019',
+        'ParticipantName': 'BANK',
+        'ParticipantAddress': 'HONG KONG',
+        'Shareholding': 1000,
+        'FracOfShares': 1.0,
+    })
+
+@pytest.fixture
+def store(tmp_path):
+    store = ParquetStore(str(tmp_path))
+    store.create_tables()
+    # One file per write
+    for stock_code in ('00001', '00005', '00700'):
+        store.append(make_ccass_rows([stock_code]), CCASS_TABLE_NAME)
+    return store
+
+def read_stock_codes(store: ParquetStore) -> list:
+    return sorted(store.read_partition(CCASS_TABLE_NAME, DATE_STR, ['StockCode'])['StockCode'].tolist())
+
+
+def test_compact(store):
+    assert len(store.get_partition_files(CCASS_TABLE_NAME, DATE_STR)) == 3
+    store.close()
+    assert len(store.get_partition_files(CCASS_TABLE_NAME, DATE_STR)) == 1
+    assert read_stock_codes(store) == ['00001', '00005', '00700']
+    # No hidden directory left behind
+    assert sorted(os.listdir(os.path.join(store.data_dir, CCASS_TABLE_NAME))) == [
+        f'DataDate={DATE_STR}', parquet_store.GENERATION_FILE_NAME
+    ]
+
+def test_read_during_compaction(store, monkeypatch):
+    # The compaction runs after the reader has listed the files, before it reads them
+    dataset = parquet_store.ds.dataset
+    calls = []
+
+    def dataset_then_compact(*args, **kwargs):
+        d = dataset(*args, **kwargs)
+        if not calls:
+            calls.append(d)
+            store.close()
+        return d
+
+    monkeypatch.setattr(parquet_store.ds, 'dataset', dataset_then_compact)
+    assert read_stock_codes(store) == ['00001', '00005', '00700']
+    assert len(calls) == 1
+
+def test_interrupted_swap_is_rolled_back(store):
+    # Crash after the partition was moved aside, before the compacted one was moved in
+    table_dir = os.path.join(store.data_dir, CCASS_TABLE_NAME)
+    os.replace(os.path.join(table_dir, f'DataDate={DATE_STR}'), os.path.join(table_dir, f'.DataDate={DATE_STR}.old'))
+    store.set_compaction_generation(CCASS_TABLE_NAME, 1)
+
+    ParquetStore(store.data_dir).create_tables()
+    assert store.get_compaction_generation(CCASS_TABLE_NAME) == 2
+    assert read_stock_codes(store) == ['00001', '00005', '00700']
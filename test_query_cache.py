@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the query result cache (query_cache.py)
+
+Run:
+    python -m pytest test_query_cache.py
+"""
+
+import pandas as pd
+
+from query_cache import QueryCache
+
+
+def make_cache(state: dict) -> QueryCache:
+    return QueryCache(version_func=lambda: state['version'], spill_dir=None, version_check_seconds=0)
+
+
+def test_cached_until_version_changes():
+    state = {'version': 1, 'computed': 0}
+    cache = make_cache(state)
+
+    def compute():
+        state['computed'] += 1
+        return pd.DataFrame({'a': [state['version']]})
+
+    assert cache.get_or_compute(('q',), compute)['a'].tolist() == [1]
+    assert cache.get_or_compute(('q',), compute)['a'].tolist() == [1]
+    assert state['computed'] == 1
+    state['version'] = 2
+    assert cache.get_or_compute(('q',), compute)['a'].tolist() == [2]
+    assert state['computed'] == 2
+
+def test_result_computed_across_version_change_not_cached():
+    state = {'version': 1}
+    cache = make_cache(state)
+
+    def compute_stale():
+        # New data is loaded, and another lookup sees the new version, while this one computes
+        state['version'] = 2
+        cache.check_version()
+        return pd.DataFrame({'a': [1]})
+
+    assert cache.get_or_compute(('q',), compute_stale)['a'].tolist() == [1]
+    assert ('q',) not in cache.entries
+    assert cache.get_or_compute(('q',), lambda: pd.DataFrame({'a': [2]}))['a'].tolist() == [2]
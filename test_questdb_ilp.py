@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ILP encoding and sender (questdb_ilp.py), the sender against a local TCP stub
+of the QuestDB ILP port
+
+Run:
+    python -m pytest test_questdb_ilp.py
+"""
+
+import datetime
+import socket
+import threading
+
+import pandas as pd
+import pytest
+
+from config import CCASS_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME
+from questdb_ilp import ILPSender, dataframe_to_ilp_lines, escape_string, escape_symbol
+
+# 2022-03-01 00:00:00 UTC
+DATE_MICROS = 1646092800000000
+
+
+class StubILPServer:
+    # Accepts connections and keeps the bytes received on each of them
+
+    def __init__(self):
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = []
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                chunks = []
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                self.received.append(b''.join(chunks).decode('utf-8'))
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    server = StubILPServer()
+    yield server
+    server.close()
+
+
+def test_escape_symbol():
+    s = pd.Series(['HSBC BROKING', 'A,B=C', 'back\\slash', 'two\nlines'])
+    assert escape_symbol(s).tolist() == ['HSBC\\ BROKING', 'A\\,B\\=C', 'back\\\\slash', 'two\\ lines']
+
+def test_escape_string():
+    s = pd.Series(['say "hi"', 'back\\slash', 'two\nlines', 'a, b=c'])
+    assert escape_string(s).tolist() == ['say \\"hi\\"', 'back\\\\slash', 'two lines', 'a, b=c']
+
+def test_ccass_lines():
+    df = pd.DataFrame({
+        'DataDate': ['2022-03-01', '2022-03-01'],
+        'StockCode': ['00001', '00001'],
+        'ParticipantID': ['C00019', 'None'],
+        'ParticipantName': ['THE HONGKONG AND SHANGHAI BANKING', 'INVESTOR "A"'],
+        'ParticipantAddress': ['1 QUEEN\'S ROAD, CENTRAL', 'FLAT A\n2/F'],
+        'Shareholding': [123456789, 1000],
+        'FracOfShares': [3.21, 0.5],
+    })
+    assert dataframe_to_ilp_lines(df, CCASS_TABLE_NAME).tolist() == [
+        'CCASS,StockCode=00001,ParticipantID=C00019 '
+        'ParticipantName="THE HONGKONG AND SHANGHAI BANKING",ParticipantAddress="1 QUEEN\'S ROAD, CENTRAL",'
+        f'Shareholding=123456789i,FracOfShares=3.21 {DATE_MICROS}000\n',
+        'CCASS,StockCode=00001,ParticipantID=None '
+        'ParticipantName="INVESTOR \\"A\\"",ParticipantAddress="FLAT A 2/F",'
+        f'Shareholding=1000i,FracOfShares=0.5 {DATE_MICROS}000\n',
+    ]
+
+def test_progress_lines():
+    # DataDate is a timestamp field here, RecordedAt the designated timestamp
+    df = pd.DataFrame({
+        'DataDate': ['2022-03-01'],
+        'StockCode': ['00005'],
+        'Status': ['DONE'],
+        'RowCount': [42],
+        'AttemptCount': [1],
+        'ElapsedMs': [812.5],
+        'RecordedAt': [datetime.datetime(2022, 3, 2, 8, 30, 0, 123456)],
+    })
+    recorded_at_micros = DATE_MICROS + (32 * 3600 + 30 * 60) * 1_000_000 + 123456
+    assert dataframe_to_ilp_lines(df, SCRAPE_PROGRESS_TABLE_NAME).tolist() == [
+        'ScrapeProgress,StockCode=00005,Status=DONE '
+        f'DataDate={DATE_MICROS}t,RowCount=42i,AttemptCount=1i,ElapsedMs=812.5 {recorded_at_micros}000\n'
+    ]
+
+def test_sender_batches(server):
+    df = pd.DataFrame({
+        'DataDate': ['2022-03-01'] * 100,
+        'StockCode': [f'{i:05d}' for i in range(100)],
+        'ParticipantID': ['C00019'] * 100,
+        'ParticipantName': ['BANK'] * 100,
+        'ParticipantAddress': ['HONG KONG'] * 100,
+        'Shareholding': list(range(100)),
+        'FracOfShares': [1.0] * 100,
+    })
+    # Small batches, so the rows are sent in several writes
+    with ILPSender('127.0.0.1', server.port, batch_bytes=1000) as sender:
+        sender.send_dataframe(df, CCASS_TABLE_NAME)
+        sender.send_dataframe(df.iloc[:0], CCASS_TABLE_NAME)
+    # close() returns once the server has read everything
+    assert server.received == [''.join(dataframe_to_ilp_lines(df, CCASS_TABLE_NAME))]
+
+def test_sender_resends_after_reconnect(server):
+    df = pd.DataFrame({
+        'DataDate': ['2022-03-01', '2022-03-01'],
+        'StockCode': ['00001', '00005'],
+        'ParticipantID': ['C00019', 'C00019'],
+        'ParticipantName': ['BANK', 'BANK'],
+        'ParticipantAddress': ['HONG KONG', 'HONG KONG'],
+        'Shareholding': [1, 2],
+        'FracOfShares': [1.0, 2.0],
+    })
+    with ILPSender('127.0.0.1', server.port) as sender:
+        sender.send_dataframe(df.iloc[:1], CCASS_TABLE_NAME)
+        # The connection drops after the first batch, it may not have reached the server
+        sender.sock.close()
+        sender.send_dataframe(df.iloc[1:], CCASS_TABLE_NAME)
+    # Both batches are resent on the new connection
+    assert server.received[-1] == ''.join(dataframe_to_ilp_lines(df, CCASS_TABLE_NAME))
+
+def test_sender_close_times_out():
+    # A server that never closes its side
+    stub = socket.create_server(('127.0.0.1', 0))
+    try:
+        sender = ILPSender('127.0.0.1', stub.getsockname()[1], close_timeout=0.2)
+        sender.connect()
+        conn, _ = stub.accept()
+        sender.send_batch(b'x\n')
+        with pytest.raises(TimeoutError):
+            sender.close()
+        assert sender.sock is None
+        conn.close()
+    finally:
+        stub.close()
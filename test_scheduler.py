@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the holidays learned by the scheduler (scheduler.py)
+
+Run:
+    python -m pytest test_scheduler.py
+"""
+
+import datetime
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import scheduler
+from config import STOCK_MAP_TABLE_NAME, MARKET_HOLIDAY_TABLE_NAME, SCRAPE_PROGRESS_COLUMNS
+from scheduler import plan_scrape, learn_holidays
+from util import create_table, store_df_to_db, store_scrape_progress, load_scrape_status
+from util import load_market_holidays, store_market_holiday
+
+TODAY = datetime.date(2022, 7, 5)
+DATE = datetime.date(2022, 7, 4)
+DATE_STR = '2022-07-04'
+STOCK_CODES = ['00001', '00005', '00700']
+
+
+def make_progress(status: str, recorded_at: datetime.datetime) -> pd.DataFrame:
+    return pd.DataFrame([
+        (DATE_STR, stock_code, status, 0, 1, 10.0, recorded_at) for stock_code in STOCK_CODES
+    ], columns=SCRAPE_PROGRESS_COLUMNS)
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'ccass.db')
+    create_table(conn)
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def conn_with_stock_list(conn, monkeypatch):
+    monkeypatch.setattr(scheduler, 'HOLIDAY_MIN_EMPTY_PAGES', len(STOCK_CODES))
+    store_df_to_db(pd.DataFrame({
+        'DataDate': DATE_STR, 'StockCode': STOCK_CODES, 'StockName': 'STOCK'
+    }), conn, STOCK_MAP_TABLE_NAME)
+    return conn
+
+
+def test_empty_stock_list_seen_once(conn):
+    store_market_holiday(DATE_STR, conn, datetime.datetime(2022, 7, 5, 9))
+    assert load_market_holidays(conn) == set()
+    # Its stock list is fetched again
+    assert dict(plan_scrape(conn, today=TODAY))[DATE] is None
+
+def test_empty_stock_list_seen_again(conn):
+    store_market_holiday(DATE_STR, conn, datetime.datetime(2022, 7, 5, 9))
+    # Another shard of the same run, too soon to tell a holiday from a page that failed to load
+    store_market_holiday(DATE_STR, conn, datetime.datetime(2022, 7, 5, 9, 1))
+    assert load_market_holidays(conn) == set()
+    store_market_holiday(DATE_STR, conn, datetime.datetime(2022, 7, 6, 9))
+    assert load_market_holidays(conn) == {DATE_STR}
+    assert DATE not in dict(plan_scrape(conn, today=TODAY))
+
+def test_empty_pages_scraped_again(conn_with_stock_list):
+    conn = conn_with_stock_list
+    store_scrape_progress(make_progress('EMPTY', datetime.datetime(2022, 7, 5, 9)), conn)
+    # Not yet due
+    holidays, recheck_dates = learn_holidays(
+        load_scrape_status(DATE_STR, conn), conn, now=datetime.datetime(2022, 7, 5, 9, 30)
+    )
+    assert holidays == set() and recheck_dates == set()
+    # Due, the empty pages are planned again
+    assert dict(plan_scrape(conn, today=TODAY))[DATE] == STOCK_CODES
+
+    # Empty again on the later attempt
+    store_scrape_progress(make_progress('EMPTY', datetime.datetime(2022, 7, 6, 9)), conn)
+    assert DATE not in dict(plan_scrape(conn, today=TODAY))
+    assert load_market_holidays(conn) == {DATE_STR}
+
+def test_empty_pages_then_data(conn_with_stock_list):
+    conn = conn_with_stock_list
+    store_scrape_progress(make_progress('EMPTY', datetime.datetime(2022, 7, 5, 9)), conn)
+    assert dict(plan_scrape(conn, today=TODAY))[DATE] == STOCK_CODES
+    # The later attempt found data, the date is not a holiday
+    store_scrape_progress(make_progress('DONE', datetime.datetime(2022, 7, 6, 9)), conn)
+    assert DATE not in dict(plan_scrape(conn, today=TODAY))
+    assert load_market_holidays(conn) == set()
+
+def test_table_with_one_row_per_date_is_rebuilt(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'ccass.db')
+    conn.execute(f"CREATE TABLE {MARKET_HOLIDAY_TABLE_NAME}(DataDate text PRIMARY KEY, RecordedAt text)")
+    conn.execute(f"INSERT INTO {MARKET_HOLIDAY_TABLE_NAME} VALUES (?, ?)", (DATE_STR, '2022-07-05 09:00:00'))
+    conn.commit()
+    create_table(conn)
+    # The date learned from one observation needs a second one
+    assert load_market_holidays(conn) == set()
+    store_market_holiday(DATE_STR, conn, datetime.datetime(2022, 7, 6, 9))
+    assert load_market_holidays(conn) == {DATE_STR}
+    conn.close()
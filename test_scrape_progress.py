@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the progress journal reads (util.py) and the scrape plan (scheduler.py) on a DB with
+data scraped before the journal existed
+
+Run:
+    python -m pytest test_scrape_progress.py
+"""
+
+import datetime
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_COLUMNS
+from scheduler import plan_scrape
+from util import create_table, store_df_to_db, store_scrape_progress, load_scrape_progress, load_scrape_status
+
+
+def make_ccass_rows(stock_days: list) -> pd.DataFrame:
+    return pd.DataFrame([
+        (date_str, stock_code, f'C{i:05d}', f'PARTICIPANT {i}', 'HONG KONG', 1000 * (i + 1), 1.5 * (i + 1))
+        for date_str, stock_code in stock_days
+        for i in range(3)
+    ], columns=[
+        'DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'
+    ])
+
+def make_progress(records: list) -> pd.DataFrame:
+    return pd.DataFrame([
+        (date_str, stock_code, status, 0, 1, 10.0, datetime.datetime(2022, 7, 1, 18))
+        for date_str, stock_code, status in records
+    ], columns=SCRAPE_PROGRESS_COLUMNS)
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'ccass.db')
+    create_table(conn)
+    # 06-29 and 06-30 scraped before the journal existed, then one journaled run on 07-04
+    stock_days = [
+        ('2022-06-29', '00001'), ('2022-06-29', '00005'),
+        ('2022-06-30', '00001'), ('2022-06-30', '00005'),
+        ('2022-07-04', '00001'),
+    ]
+    store_df_to_db(make_ccass_rows(stock_days), conn, CCASS_TABLE_NAME)
+    store_df_to_db(pd.DataFrame(
+        [(date_str, stock_code, f'STOCK {stock_code}') for date_str, stock_code in stock_days] +
+        [('2022-07-04', '00005', 'STOCK 00005')],
+        columns=['DataDate', 'StockCode', 'StockName']
+    ), conn, STOCK_MAP_TABLE_NAME)
+    store_scrape_progress(make_progress([('2022-07-04', '00001', 'DONE'), ('2022-07-04', '00005', 'FAILED')]), conn)
+    yield conn
+    conn.close()
+
+
+def test_scrape_progress_before_journal(conn):
+    df = load_scrape_progress('2022-06-30', conn)
+    assert sorted(df[['StockCode', 'Status', 'AttemptCount']].values.tolist()) == [
+        ['00001', 'DONE', 1], ['00005', 'DONE', 1]
+    ]
+
+def test_scrape_progress_journaled(conn):
+    df = load_scrape_progress('2022-07-04', conn)
+    assert sorted(df[['StockCode', 'Status']].values.tolist()) == [['00001', 'DONE'], ['00005', 'FAILED']]
+
+def test_journal_wins_over_data(conn):
+    # Rows written but the stock day journaled as FAILED (e.g. the write of its progress failed after)
+    store_scrape_progress(make_progress([('2022-06-30', '00005', 'FAILED')]), conn)
+    df = load_scrape_progress('2022-06-30', conn)
+    assert sorted(df[['StockCode', 'Status']].values.tolist()) == [['00001', 'DONE'], ['00005', 'FAILED']]
+
+def test_scrape_status(conn):
+    df = load_scrape_status('2022-06-01', conn)
+    assert sorted(df[['DataDate', 'StockCode', 'Status']].values.tolist()) == [
+        ['2022-06-29', '00001', 'DONE'], ['2022-06-29', '00005', 'DONE'],
+        ['2022-06-30', '00001', 'DONE'], ['2022-06-30', '00005', 'DONE'],
+        ['2022-07-04', '00001', 'DONE'], ['2022-07-04', '00005', 'FAILED'],
+    ]
+    assert sorted(load_scrape_status('2022-06-30', conn)['DataDate'].unique()) == ['2022-06-30', '2022-07-04']
+
+def test_plan_scrape_skips_days_before_journal(conn):
+    plan = dict(plan_scrape(conn, today=datetime.date(2022, 7, 5)))
+    assert plan[datetime.date(2022, 7, 4)] == ['00005']
+    assert datetime.date(2022, 6, 29) not in plan
+    assert datetime.date(2022, 6, 30) not in plan
+    # Business days without a stock list are scraped whole
+    assert plan[datetime.date(2022, 7, 1)] is None
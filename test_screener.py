@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the screener changes (screener.py)
+
+Run:
+    python -m pytest test_screener.py
+"""
+
+import pandas as pd
+
+from screener import compute_shareholding_changes
+
+START_DATE_STR = '2022-06-01'
+END_DATE_STR = '2022-06-30'
+
+
+def make_holdings(rows: list) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=['DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'FracOfShares'])
+
+def get_changes(df: pd.DataFrame) -> list:
+    df_changes = compute_shareholding_changes(df, START_DATE_STR, END_DATE_STR, threshold=0.5)
+    return sorted(df_changes[[
+        'StockCode', 'ParticipantID', 'ParticipantName', 'startFracOfShare', 'endFracOfShare', 'ChangeInPercentShares'
+    ]].values.tolist())
+
+
+def test_changes():
+    df = make_holdings([
+        (START_DATE_STR, '00001', 'C00001', 'BANK A', 10.0),
+        (END_DATE_STR, '00001', 'C00001', 'BANK A', 12.5),
+        # Left CCASS / new in CCASS
+        (START_DATE_STR, '00001', 'C00002', 'BANK B', 3.0),
+        (END_DATE_STR, '00005', 'C00002', 'BANK B', 1.0),
+        # Under the threshold
+        (START_DATE_STR, '00005', 'C00001', 'BANK A', 2.0),
+        (END_DATE_STR, '00005', 'C00001', 'BANK A', 2.2),
+    ])
+    assert get_changes(df) == [
+        ['00001', 'C00001', 'BANK A', 10.0, 12.5, 2.5],
+        ['00001', 'C00002', 'BANK B', 3.0, 0.0, -3.0],
+        ['00005', 'C00002', 'BANK B', 0.0, 1.0, 1.0],
+    ]
+
+def test_participants_without_id():
+    # Both have ParticipantID 'None', each keeps its own change
+    df = make_holdings([
+        (START_DATE_STR, '00001', 'None', 'INVESTOR A', 5.0),
+        (END_DATE_STR, '00001', 'None', 'INVESTOR A', 1.0),
+        (START_DATE_STR, '00001', 'None', 'INVESTOR B', 1.0),
+        (END_DATE_STR, '00001', 'None', 'INVESTOR B', 5.0),
+    ])
+    assert get_changes(df) == [
+        ['00001', 'None', 'INVESTOR A', 5.0, 1.0, -4.0],
+        ['00001', 'None', 'INVESTOR B', 1.0, 5.0, 4.0],
+    ]
+
+def test_renamed_participant():
+    # Same CCASS ID under a new name: one change, with the latest name
+    df = make_holdings([
+        (START_DATE_STR, '00001', 'C00003', 'BANK C', 4.0),
+        (END_DATE_STR, '00001', 'C00003', 'BANK C (HK)', 3.0),
+    ])
+    assert get_changes(df) == [['00001', 'C00003', 'BANK C (HK)', 4.0, 3.0, -1.0]]
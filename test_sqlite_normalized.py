@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that the queries on the normalized schema (sqlite_normalized.py) return the same results
+as on the legacy CCASS table, with participants renamed and without a CCASS ID
+
+Run:
+    python -m pytest test_sqlite_normalized.py
+"""
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import queries
+from config import CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME
+from queries import read_query
+from sqlite_normalized import migrate, date_str_to_int
+from util import create_table, store_df_to_db
+
+DATE_STRS = ['2022-03-01', '2022-03-02', '2022-03-03', '2022-03-04', '2022-03-07', '2022-03-08']
+
+
+def make_ccass_rows() -> pd.DataFrame:
+    rows = []
+    for day, date_str in enumerate(DATE_STRS):
+        for stock_code in ('00001', '00005'):
+            for i in range(12):
+                participant_id, participant_name = f'C{i:05d}', f'PARTICIPANT {i}'
+                if i == 3 and date_str >= '2022-03-04':
+                    participant_name = 'PARTICIPANT 3 RENAMED'
+                if i >= 10:
+                    # Participants without a CCASS ID
+                    participant_id = 'None'
+                shareholding = 1000 * (i + 1) + 100 * day * (-1) ** i
+                rows.append((
+                    date_str, stock_code, participant_id, participant_name, f'{i} QUEEN\'S ROAD',
+                    shareholding, round(shareholding / 1000, 2)
+                ))
+    return pd.DataFrame(rows, columns=[
+        'DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'ParticipantAddress', 'Shareholding', 'FracOfShares'
+    ])
+
+def create_db(path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    create_table(conn)
+    store_df_to_db(make_ccass_rows(), conn, CCASS_TABLE_NAME)
+    # No stock list on 03-03, the snapshot on that date is 03-02
+    store_df_to_db(pd.DataFrame(
+        [(date_str, stock_code, f'STOCK {stock_code}') for date_str in DATE_STRS if date_str != '2022-03-03'
+         for stock_code in ('00001', '00005')],
+        columns=['DataDate', 'StockCode', 'StockName']
+    ), conn, STOCK_MAP_TABLE_NAME)
+    return conn
+
+@pytest.fixture
+def conns(tmp_path):
+    legacy_conn = create_db(tmp_path / 'legacy.db')
+    normalized_conn = create_db(tmp_path / 'normalized.db')
+    migrate(normalized_conn, drop_legacy=True)
+    yield legacy_conn, normalized_conn
+    legacy_conn.close()
+    normalized_conn.close()
+
+def read_both(conns, monkeypatch, query, **params) -> tuple:
+    legacy_conn, normalized_conn = conns
+    df_legacy = read_query(query, legacy_conn, **params)
+    monkeypatch.setattr(queries, 'SQLITE_SCHEMA', 'NORMALIZED')
+    df_normalized = read_query(query, normalized_conn, **params)
+    monkeypatch.setattr(queries, 'SQLITE_SCHEMA', 'LEGACY')
+    return df_legacy, df_normalized
+
+def assert_same_rows(df_legacy: pd.DataFrame, df_normalized: pd.DataFrame):
+    # Ties of the ORDER BY may come in any order
+    columns = list(df_legacy.columns)
+    assert list(df_normalized.columns) == columns
+    pd.testing.assert_frame_equal(
+        df_normalized.sort_values(columns).reset_index(drop=True),
+        df_legacy.sort_values(columns).reset_index(drop=True),
+        check_dtype=False
+    )
+
+
+@pytest.mark.parametrize('start_date_str, end_date_str', [
+    ('2022-03-01', '2022-03-08'),
+    ('2022-03-02', '2022-03-04'),
+    ('2022-03-03', '2022-03-07'),
+    ('2022-02-01', '2022-03-02'),
+])
+def test_shareholding_delta(conns, monkeypatch, start_date_str, end_date_str):
+    df_legacy, df_normalized = read_both(
+        conns, monkeypatch, queries.SHAREHOLDING_DELTA,
+        stock_code='00001', start_date=start_date_str, end_date=end_date_str,
+        start_date_int=date_str_to_int(start_date_str), end_date_int=date_str_to_int(end_date_str)
+    )
+    assert len(df_legacy) > 0
+    assert_same_rows(df_legacy, df_normalized)
+
+def test_shareholding_delta_of_renamed_participant(conns, monkeypatch):
+    _, df_normalized = read_both(
+        conns, monkeypatch, queries.SHAREHOLDING_DELTA,
+        stock_code='00001', start_date='2022-03-01', end_date='2022-03-08',
+        start_date_int=20220301, end_date_int=20220308
+    )
+    # One change across the rename, not a seller of 4.0 and a new buyer of 3.5
+    df = df_normalized[df_normalized['ParticipantID'] == 'C00003']
+    assert len(df) > 0
+    assert (df['startFracOfShare'] == 4.0).all() and (df['endFracOfShare'] == 3.5).all()
+    assert (df['ChangeInPercentShares'] == -0.5).all()
+
+@pytest.mark.parametrize('start_date_str, end_date_str', [
+    ('2022-03-01', '2022-03-08'),
+    ('2022-03-01', '2022-03-03'),
+])
+def test_shareholding_time_series(conns, monkeypatch, start_date_str, end_date_str):
+    df_legacy, df_normalized = read_both(
+        conns, monkeypatch, queries.SHAREHOLDING_TIME_SERIES_FOR_TOP_PARTICIPANTS,
+        stock_code='00005', start_date=start_date_str, end_date=end_date_str,
+        start_date_int=date_str_to_int(start_date_str), end_date_int=date_str_to_int(end_date_str)
+    )
+    assert len(df_legacy) > 0
+    assert_same_rows(df_legacy, df_normalized)
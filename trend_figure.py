@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Figure data of the trend tab
+
+The time series are pivoted once into a dense (date x participant) matrix.
+Ranges with more dates than TREND_FIGURE_MAX_POINTS are downsampled with
+Largest-Triangle-Three-Buckets, which keeps the peaks and troughs of each trace.
+"""
+
+import numpy as np
+import pandas as pd
+
+from config import TREND_FIGURE_MAX_POINTS
+from metrics import instrument
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    # x: (n,), y: (n, traces) -> (n_out, traces) row indices, all traces in one pass
+    n, n_traces = y.shape
+    if n_out >= n or n_out < 3:
+        return np.repeat(np.arange(n)[:, None], n_traces, axis=1)
+    trace_idx = np.arange(n_traces)
+    selected = np.empty((n_out, n_traces), dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    bucket_size = (n - 2) / (n_out - 2)
+    a = np.zeros(n_traces, dtype=np.int64)
+    for i in range(n_out - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        # Average point of the next bucket (the last point for the last bucket)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean(axis=0)
+        ax, ay = x[a], y[a, trace_idx]
+        area = np.abs(
+            (ax - avg_x) * (y[start:end] - ay) -
+            (ax - x[start:end, None]) * (avg_y - ay)
+        )
+        a = start + area.argmax(axis=0)
+        selected[i + 1] = a
+    return selected
+
+@instrument('transform')
+def build_trend_figure_data(df_trend_top: pd.DataFrame, max_points: int = TREND_FIGURE_MAX_POINTS) -> list:
+    # df_trend_top: DataDate, ParticipantID, ParticipantName, FracOfShares sorted by DataDate, FracOfShares desc
+    if df_trend_top.empty:
+        return []
+    # Participants in order of shareholding on the last date
+    df_last = df_trend_top[df_trend_top['DataDate'] == df_trend_top['DataDate'].max()]
+    participant_ids = df_last['ParticipantID'].values
+    participant_names = df_last['ParticipantName'].values
+
+    # Missing = not in CCASS (or under the scraping threshold) on that date
+    df_frac = df_trend_top.pivot_table(
+        index='DataDate', columns='ParticipantID', values='FracOfShares', aggfunc='last'
+    )
+    frac = df_frac.reindex(columns=participant_ids).fillna(0).values
+    dates = pd.to_datetime(df_frac.index).strftime('%Y-%m-%d').values
+
+    if max_points and len(dates) > max_points:
+        rows = lttb_indices(np.arange(len(dates), dtype=np.float64), frac, max_points)
+    else:
+        rows = np.repeat(np.arange(len(dates))[:, None], len(participant_ids), axis=1)
+
+    return [
+        {
+            'name': participant_name,
+            'mode': 'lines+markers',
+            'x': dates[rows[:, i]].tolist(),
+            'y': frac[rows[:, i], i].tolist(),
+        }
+        for i, participant_name in enumerate(participant_names)
+    ]
@@ -8,7 +8,8 @@ Created on Thu Jun 30 18:43:24 2022
 from dash import dcc, html, dash_table
 import datetime
 
-from config import TREND_TAB_DATA_COLUMNS, CHANGES_DATA_COLUMNS
+from config import TREND_TAB_DATA_COLUMNS, TREND_TAB_PAGE_SIZE, TREND_TOP_PARTICIPANTS, CHANGES_DATA_COLUMNS, PAIRING_DATA_COLUMNS
+from config import SCREENER_DATA_COLUMNS, SCREENER_MAX_ROWS
 
     
 def get_trend_analysis_tab(stock_map_list: list, min_date: datetime.date, max_date: datetime.date):
@@ -16,8 +17,8 @@ def get_trend_analysis_tab(stock_map_list: list, min_date: datetime.date, max_da
     return html.Div([
         html.H3(children="CCASS Shareholding Trend"),
         html.P(
-            children="""
-            Analyze how shareholding of the top 10 participant (as of end date) changes
+            children=f"""
+            Analyze how shareholding of the top {TREND_TOP_PARTICIPANTS} participant (as of end date) changes
             """,
         ),
         html.Div([
@@ -55,9 +56,15 @@ def get_trend_analysis_tab(stock_map_list: list, min_date: datetime.date, max_da
                 title="Raw Shareholding Data for Top Participants",
                 dt_id="dt-trend-analysis",
                 columns=TREND_TAB_DATA_COLUMNS,
-                sort_action='native',
-                filter_action='native',
-                page_size=30,
+                # Paged, sorted and filtered on the server (table_query.py)
+                page_action='custom',
+                sort_action='custom',
+                filter_action='custom',
+                sort_mode='multi',
+                sort_by=[],
+                filter_query='',
+                page_current=0,
+                page_size=TREND_TAB_PAGE_SIZE,
             )
         , style=dict(maxWidth='80%', marginLeft='30px')),
     ])
@@ -137,6 +144,52 @@ def get_transaction_finder_tab(stock_map_list: list, min_date: datetime.date, ma
                 )
             , style=dict(maxWidth='80%', marginLeft='30px')),
         ]),
+        html.Div([
+            html.Div(
+                get_data_table_as_children(
+                    title="Possible counterparties of all participants with changes >= threshold",
+                    dt_id="dt-counterparty-pairs",
+                    columns=PAIRING_DATA_COLUMNS,
+                    sort_action='native',
+                    filter_action='native',
+                    page_size=30,
+                )
+            , style=dict(maxWidth='80%', marginLeft='30px')),
+        ]),
+    ])
+
+def get_market_screener_tab(min_date: datetime.date, max_date: datetime.date):
+    return html.Div([
+        html.H3(children="CCASS Market Screener"),
+        html.P([
+            f"Top {SCREENER_MAX_ROWS} shareholding changes >= threshold (%) across all stocks between start date and end date.",
+        ]),
+        html.Div([
+            html.Div([
+                html.H4("Select Date Range"),
+                dcc.DatePickerRange(
+                    id="market-screener-select-date-range",
+                    min_date_allowed=min_date,
+                    max_date_allowed=max_date + datetime.timedelta(days=1),
+                    start_date=max(min_date, max_date - datetime.timedelta(days=30)),
+                    end_date=max_date,
+                ),
+            ], style=dict(maxWidth='33%')),
+            html.Div([
+                html.H4("Input Threshold (%)"),
+                dcc.Input(id='market-screener-input-threshold', type='number', debounce=True, value=5, min=0.1, max=100, step=0.1),
+            ], style=dict(width='33%', marginLeft='20px')),
+        ], style=dict(display='flex')),
+        html.Div(
+            get_data_table_as_children(
+                title="Top Shareholding Changes",
+                dt_id="dt-market-screener",
+                columns=SCREENER_DATA_COLUMNS,
+                sort_action='native',
+                filter_action='native',
+                page_size=30,
+            )
+        , style=dict(maxWidth='90%', marginLeft='30px')),
     ])
 
 def get_data_table_as_children(title: str, dt_id: str, columns: list, **kwargs):
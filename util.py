@@ -8,59 +8,287 @@ Created on Wed Jun 29 00:27:30 2022
 import pandas as pd
 import datetime
 import os
+import queue
+import threading
+import time
 import sqlite3
 import psycopg2
+from contextlib import contextmanager
 
 
 from config import (
-    BASE_ENV, DB_TYPE, SQLITE_DB_NAME, QUEST_DB_CONN_STR,
-    CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, TREND_TAB_DATA_COLUMNS
+    BASE_ENV, DB_TYPE, SQLITE_DB_NAME, QUEST_DB_CONN_STR, SQLITE_CACHE_SIZE_MB, SQLITE_MMAP_SIZE_MB, SQLITE_STATEMENT_CACHE_SIZE,
+    CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME, TREND_TAB_DATA_COLUMNS,
+    STOCK_METADATA_TABLE_NAME, STOCK_METADATA_COLUMNS, MARKET_HOLIDAY_TABLE_NAME, HOLIDAY_RECHECK_HOURS,
+    QUEST_INGEST_MODE, SQLITE_SCHEMA, QUERY_ENGINE, DELTA_SOURCE, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_SECONDS, CCASS_FACT_TABLE_NAME, STOCK_TABLE_NAME
 )
+from questdb_ilp import store_df_to_quest_db_ilp, store_df_to_quest_db_batch
+from columnar_engine import columnar_engine
+from parquet_store import ParquetStore
+import parquet_store
+import change_table
+from sqlite_normalized import create_normalized_tables, date_str_to_int, DATE_TO_TEXT_SQL
+import queries
+from queries import read_query, execute_query
+from metrics import instrument
+
+# (index name, table, columns) of the SQLite backend
+SQLITE_INDEXES = [
+    ('index_stock_code', CCASS_TABLE_NAME, 'StockCode'),
+    ('index_date', CCASS_TABLE_NAME, 'DataDate'),
+    ('index_stock_code_date', CCASS_TABLE_NAME, 'StockCode, DataDate'),
+    ('index_stock_map_date', STOCK_MAP_TABLE_NAME, 'DataDate'),
+    ('index_stock_map_code', STOCK_MAP_TABLE_NAME, 'StockCode'),
+    ('index_stock_map_code_date', STOCK_MAP_TABLE_NAME, 'DataDate, StockCode'),
+]
+# The fact table is clustered on (StockKey, DataDate, ParticipantKey) already
+SQLITE_NORMALIZED_INDEXES = [
+    ('index_fact_date', CCASS_FACT_TABLE_NAME, 'DataDate'),
+    *SQLITE_INDEXES[3:],
+]
+
+def get_sqlite_indexes():
+    return SQLITE_NORMALIZED_INDEXES if SQLITE_SCHEMA == 'NORMALIZED' else SQLITE_INDEXES
 
 def get_db_connection():
     if DB_TYPE == 'SQLITE':
-        return sqlite3.connect(DB_NAME, check_same_thread=False)
+        # Compiled statements of the queries (queries.py) are reused from this per connection cache
+        conn = sqlite3.connect(SQLITE_DB_NAME, check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE_SIZE)
+        configure_sqlite_connection(conn)
+        return conn
+    elif DB_TYPE == 'PARQUET':
+        return ParquetStore()
     else:
         return psycopg2.connect(QUEST_DB_CONN_STR, connect_timeout=0)
 
+class ConnectionPool:
+    """
+    Connections are checked out by one thread at a time and returned afterwards.
+    Idle connections are health checked before reuse and replaced when broken (e.g. QuestDB restarted).
+    """
+    
+    def __init__(self, size: int = DB_POOL_SIZE, connect_func=None,
+                 timeout: float = DB_POOL_TIMEOUT, health_check_seconds: float = DB_POOL_HEALTH_CHECK_SECONDS):
+        self.size = size
+        self.connect_func = connect_func or get_db_connection
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        # (connection, last used time), most recently used first
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+    
+    @contextmanager
+    def connection(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No DB connection available within {self.timeout}s")
+        conn = None
+        try:
+            conn = self.checkout()
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Broken connection, do not return it to the pool
+            self.discard(conn)
+            conn = None
+            raise
+        except Exception:
+            if isinstance(conn, psycopg2.extensions.connection):
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self.idle.put((conn, time.monotonic()))
+            self.slots.release()
+    
+    def checkout(self):
+        while True:
+            try:
+                conn, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect_func()
+            if time.monotonic() - last_used < self.health_check_seconds or self.is_healthy(conn):
+                return conn
+            self.discard(conn)
+    
+    def is_healthy(self, conn) -> bool:
+        if isinstance(conn, ParquetStore):
+            return os.path.isdir(conn.data_dir)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("select 1")
+            cursor.fetchall()
+            cursor.close()
+            if isinstance(conn, psycopg2.extensions.connection):
+                conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def discard(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(conn)
+
+def configure_sqlite_connection(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    # WAL lets the app read while the scraper writes, NORMAL only syncs at checkpoints
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Negative cache_size is in KiB
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_MB * 1024}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 def create_table(connection):
+    if isinstance(connection, ParquetStore):
+        connection.create_tables()
+        return
     cursor = connection.cursor()
     if isinstance(connection, sqlite3.Connection):
+        if SQLITE_SCHEMA == 'NORMALIZED':
+            # Creates CCASS as a view, so the CREATE TABLE below has no effect
+            create_normalized_tables(connection)
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS 
-            {CCASS_TABLE_NAME}
-            (DataDate, StockCode, ParticipantID, ParticipantName, ParticipantAddress, Shareholding, FracOfShares)
+            {CCASS_TABLE_NAME}(
+              DataDate text,
+              StockCode text,
+              ParticipantID text,
+              ParticipantName text,
+              ParticipantAddress text,
+              Shareholding integer,
+              FracOfShares real
+            )
         """)
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS 
-            {STOCK_MAP_TABLE_NAME}
-            (DataDate, StockCode, StockName)
+            {STOCK_MAP_TABLE_NAME}(
+              DataDate text,
+              StockCode text,
+              StockName text
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS 
+            {SCRAPE_PROGRESS_TABLE_NAME}(
+              DataDate text,
+              StockCode text,
+              Status text,
+              RowCount integer,
+              AttemptCount integer,
+              ElapsedMs real,
+              RecordedAt text,
+              PRIMARY KEY (DataDate, StockCode)
+            )
         """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS 
+            {STOCK_METADATA_TABLE_NAME}(
+              StockCode text PRIMARY KEY,
+              StockName text,
+              NameDataDate text,
+              MinDataDate text,
+              MaxDataDate text,
+              RecordedAt text
+            )
+        """)
+        holiday_key = [row[1] for row in cursor.execute(f"PRAGMA table_info({MARKET_HOLIDAY_TABLE_NAME})") if row[5]]
+        if holiday_key == ['DataDate']:
+            # Created with one row per date, before a holiday had to be seen twice
+            print(f"Rebuilding {MARKET_HOLIDAY_TABLE_NAME} with one row per observation")
+            cursor.execute(f"ALTER TABLE {MARKET_HOLIDAY_TABLE_NAME} RENAME TO {MARKET_HOLIDAY_TABLE_NAME}_old")
+        # One row per empty stock list (or day of empty pages) seen
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS 
+            {MARKET_HOLIDAY_TABLE_NAME}(
+              DataDate text,
+              RecordedAt text,
+              PRIMARY KEY (DataDate, RecordedAt)
+            )
+        """)
+        if holiday_key == ['DataDate']:
+            cursor.execute(f"INSERT INTO {MARKET_HOLIDAY_TABLE_NAME} SELECT DataDate, RecordedAt FROM {MARKET_HOLIDAY_TABLE_NAME}_old")
+            cursor.execute(f"DROP TABLE {MARKET_HOLIDAY_TABLE_NAME}_old")
+        if DELTA_SOURCE == 'CHANGE_TABLE':
+            change_table.create_change_table(connection)
     elif isinstance(connection, psycopg2.extensions.connection):
+        # Partitioned by day so that dates out of the retention window are dropped as partitions
+        # (tables created before that can be converted with maintenance.py --partition-quest)
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS 
             {CCASS_TABLE_NAME}(
-              DataDate date,
+              DataDate timestamp,
               StockCode symbol CAPACITY 4096 index,
               ParticipantID symbol CAPACITY 2048,
               ParticipantName string,
               ParticipantAddress string,
               Shareholding long,
               FracOfShares double
-            )
+            ) timestamp(DataDate) PARTITION BY DAY
         """)
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS 
             {STOCK_MAP_TABLE_NAME}(
-              DataDate date,
+              DataDate timestamp,
               StockCode symbol CAPACITY 4096,
               StockName string
-            )
+            ) timestamp(DataDate) PARTITION BY DAY
+        """)
+        # Append only, the latest record of each stock is the current status
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS 
+            {SCRAPE_PROGRESS_TABLE_NAME}(
+              DataDate date,
+              StockCode symbol CAPACITY 4096 index,
+              Status symbol,
+              RowCount int,
+              AttemptCount int,
+              ElapsedMs double,
+              RecordedAt timestamp
+            ) timestamp(RecordedAt) PARTITION BY MONTH
+        """)
+        # Append only as well, the latest record of each stock is current
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS 
+            {STOCK_METADATA_TABLE_NAME}(
+              StockCode symbol CAPACITY 4096 index,
+              StockName string,
+              NameDataDate date,
+              MinDataDate date,
+              MaxDataDate date,
+              RecordedAt timestamp
+            ) timestamp(RecordedAt) PARTITION BY YEAR
+        """)
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS 
+            {MARKET_HOLIDAY_TABLE_NAME}(
+              DataDate date,
+              RecordedAt timestamp
+            ) timestamp(RecordedAt) PARTITION BY YEAR
         """)
     connection.commit()
     cursor.close()
 
 def store_df_to_quest_db(df, connection, table_name):
+    if QUEST_INGEST_MODE == 'ILP':
+        store_df_to_quest_db_ilp(df, table_name)
+    elif QUEST_INGEST_MODE == 'BATCH':
+        store_df_to_quest_db_batch(df, connection, table_name)
+    else:
+        store_df_to_quest_db_by_row(df, connection, table_name)
+
+def store_df_to_quest_db_by_row(df, connection, table_name):
     cursor = connection.cursor()
     df = df.apply(
         lambda s:
@@ -81,41 +309,329 @@ def store_df_to_quest_db(df, connection, table_name):
     cursor.close()    
     
 def store_df_to_sqlite(df: pd.DataFrame, connection: sqlite3.Connection, table_name: str):
-    df_new_data.to_sql(table_name, connection, if_exists='append', index=False)
+    # One explicit transaction per batch
+    with connection:
+        connection.executemany(f"""
+            INSERT INTO {table_name} ({','.join(df.columns)})
+            VALUES ({','.join(['?']*len(df.columns))})
+        """, zip(*(df[col].tolist() for col in df.columns)))
     
 def store_df_to_db(df: pd.DataFrame, connection: sqlite3.Connection, table_name: str):
     if isinstance(connection, sqlite3.Connection):
         store_df_to_sqlite(df, connection, table_name)
     elif isinstance(connection, psycopg2.extensions.connection):
         store_df_to_quest_db(df, connection, table_name)
+    elif isinstance(connection, ParquetStore):
+        connection.append(df, table_name)
+
+def load_stock_map_by_date(date_str: str, connection) -> pd.DataFrame:
+    if isinstance(connection, ParquetStore):
+        return connection.read_partition(STOCK_MAP_TABLE_NAME, date_str, ['StockCode', 'StockName'])
+    return read_query(queries.STOCK_MAP_BY_DATE, connection, date=date_str)
+
+def load_scrape_progress(date_str: str, connection) -> pd.DataFrame:
+    if isinstance(connection, ParquetStore):
+        df = connection.read_partition(SCRAPE_PROGRESS_TABLE_NAME, date_str, ['StockCode', 'Status', 'AttemptCount', 'RecordedAt'])
+        # Latest record of each stock
+        df = df.sort_values('RecordedAt').drop_duplicates('StockCode', keep='last')
+        return df[['StockCode', 'Status', 'AttemptCount']].reset_index(drop=True)
+    df = read_query(queries.SCRAPE_PROGRESS_BY_DATE, connection, date=date_str)
+    # Stock days with data but no journal record were scraped before the journal existed
+    stock_codes = read_query(queries.STOCK_CODES_WITH_DATA_BY_DATE, connection, date=date_str)['StockCode']
+    df_unjournaled = stock_codes[~stock_codes.isin(df['StockCode'])].to_frame().assign(Status='DONE', AttemptCount=1)
+    # Empty frames left out, they would turn the columns into objects
+    return pd.concat([d for d in (df, df_unjournaled) if not d.empty] or [df], ignore_index=True)
+
+def store_scrape_progress(df: pd.DataFrame, connection):
+    if isinstance(connection, sqlite3.Connection):
+        df = df.assign(RecordedAt=df['RecordedAt'].astype(str))
+        connection.executemany(f"""
+            INSERT OR REPLACE INTO {SCRAPE_PROGRESS_TABLE_NAME}
+            VALUES ({','.join(['?']*len(df.columns))})
+        """, zip(*(df[col].tolist() for col in df.columns)))
+        connection.commit()
+    elif isinstance(connection, psycopg2.extensions.connection):
+        store_df_to_quest_db(df, connection, SCRAPE_PROGRESS_TABLE_NAME)
+    elif isinstance(connection, ParquetStore):
+        connection.append(df, SCRAPE_PROGRESS_TABLE_NAME)
+
+def load_stock_metadata(connection) -> pd.DataFrame:
+    if isinstance(connection, ParquetStore):
+        df = connection.read_file(STOCK_METADATA_TABLE_NAME).reindex(columns=STOCK_METADATA_COLUMNS)
+    elif isinstance(connection, sqlite3.Connection):
+        df = pd.read_sql_query(f"select * from {STOCK_METADATA_TABLE_NAME}", connection)
+    elif isinstance(connection, psycopg2.extensions.connection):
+        df = pd.read_sql_query(f"""
+            select * from {STOCK_METADATA_TABLE_NAME}
+            latest on RecordedAt partition by StockCode
+        """, connection)
+    for col in ['NameDataDate', 'MinDataDate', 'MaxDataDate']:
+        df[col] = pd.to_datetime(df[col]).dt.strftime('%Y-%m-%d')
+    return df[STOCK_METADATA_COLUMNS]
+
+def store_stock_metadata(df: pd.DataFrame, connection, replace: bool = False):
+    # replace: df is the whole table rather than the rows of the updated stocks
+    if isinstance(connection, ParquetStore):
+        if not replace:
+            df_existing = load_stock_metadata(connection)
+            df = pd.concat([df_existing[~df_existing['StockCode'].isin(df['StockCode'])], df])
+        connection.replace_file(df.sort_values('StockCode'), STOCK_METADATA_TABLE_NAME)
+    elif isinstance(connection, sqlite3.Connection):
+        df = df.assign(RecordedAt=df['RecordedAt'].astype(str))
+        with connection:
+            if replace:
+                connection.execute(f"DELETE FROM {STOCK_METADATA_TABLE_NAME}")
+            connection.executemany(f"""
+                INSERT OR REPLACE INTO {STOCK_METADATA_TABLE_NAME} ({','.join(STOCK_METADATA_COLUMNS)})
+                VALUES ({','.join(['?']*len(STOCK_METADATA_COLUMNS))})
+            """, zip(*(df[col].tolist() for col in STOCK_METADATA_COLUMNS)))
+    elif isinstance(connection, psycopg2.extensions.connection):
+        if replace:
+            cursor = connection.cursor()
+            cursor.execute(f"TRUNCATE TABLE {STOCK_METADATA_TABLE_NAME}")
+            cursor.close()
+        store_df_to_quest_db(df[STOCK_METADATA_COLUMNS], connection, STOCK_METADATA_TABLE_NAME)
+
+def load_stocks_with_data_by_date(date_str: str, connection) -> pd.DataFrame:
+    # Stocks with shareholding data on the date, with their name on the date
+    if isinstance(connection, ParquetStore):
+        stock_codes = connection.read_partition(CCASS_TABLE_NAME, date_str, ['StockCode'])['StockCode'].unique()
+    else:
+        stock_codes = read_query(queries.STOCK_CODES_WITH_DATA_BY_DATE, connection, date=date_str)['StockCode']
+    df_stock_map = load_stock_map_by_date(date_str, connection).drop_duplicates('StockCode')
+    return df_stock_map[df_stock_map['StockCode'].isin(stock_codes)].assign(DataDate=date_str)
+
+def merge_stock_metadata(df_metadata: pd.DataFrame, df_days: pd.DataFrame) -> pd.DataFrame:
+    # df_days: (DataDate, StockCode, StockName) from load_stocks_with_data_by_date
+    # Returns the metadata of the stocks in df_days
+    df_days = df_days.sort_values('DataDate')
+    df_new = (
+        df_days.groupby('StockCode')
+        .agg(MinDataDate=('DataDate', 'min'), MaxDataDate=('DataDate', 'max'))
+        .reset_index()
+        .merge(
+            df_days.drop_duplicates('StockCode', keep='last')[['StockCode', 'StockName', 'DataDate']]
+            .rename(columns={'DataDate': 'NameDataDate'}),
+            on='StockCode'
+        )
+    )
+    df = pd.concat([df_metadata[df_metadata['StockCode'].isin(df_new['StockCode'])], df_new])
+    df_dates = df.groupby('StockCode').agg(MinDataDate=('MinDataDate', 'min'), MaxDataDate=('MaxDataDate', 'max'))
+    # Latest name
+    df_names = df.sort_values('NameDataDate').drop_duplicates('StockCode', keep='last')
+    df_names = df_names.set_index('StockCode')[['StockName', 'NameDataDate']]
+    return (
+        df_names.join(df_dates)
+        .reset_index()
+        .assign(RecordedAt=datetime.datetime.now())
+        [STOCK_METADATA_COLUMNS]
+    )
+
+def update_stock_metadata(date_str: str, connection):
+    # Called by the scraper once a day is loaded
+    df_days = load_stocks_with_data_by_date(date_str, connection)
+    if df_days.empty:
+        return
+    store_stock_metadata(merge_stock_metadata(load_stock_metadata(connection), df_days), connection)
+
+def load_stock_days(start_date_str: str, connection) -> pd.DataFrame:
+    # (DataDate, StockCode) of the stock lists scraped from start_date_str on
+    if isinstance(connection, ParquetStore):
+        df = parquet_store.read_since(connection, STOCK_MAP_TABLE_NAME, start_date_str, ['DataDate', 'StockCode'])
+    else:
+        df = read_query(queries.STOCK_DAYS_SINCE, connection, start_date=start_date_str)
+    df['DataDate'] = pd.to_datetime(df['DataDate']).dt.strftime('%Y-%m-%d')
+    return df.drop_duplicates()
+
+def load_scrape_status(start_date_str: str, connection) -> pd.DataFrame:
+    # Latest (DataDate, StockCode, Status, RecordedAt) of the stock days in the progress journal from start_date_str on
+    if isinstance(connection, ParquetStore):
+        df = parquet_store.read_since(
+            connection, SCRAPE_PROGRESS_TABLE_NAME, start_date_str, ['DataDate', 'StockCode', 'Status', 'RecordedAt']
+        )
+        df = df.sort_values('RecordedAt').drop_duplicates(['DataDate', 'StockCode'], keep='last')
+    else:
+        df = read_query(queries.SCRAPE_STATUS_SINCE, connection, start_date=start_date_str)
+        # Stock days with data but no journal record were scraped before the journal existed
+        df_with_data = read_query(queries.STOCK_DAYS_WITH_DATA_SINCE, connection, start_date=start_date_str)
+        df = pd.concat(
+            [d for d in (df, df_with_data.assign(Status='DONE')) if not d.empty] or [df], ignore_index=True
+        )
+    df['DataDate'] = pd.to_datetime(df['DataDate']).dt.strftime('%Y-%m-%d')
+    # The journal record first, so it wins over the data
+    df = df.drop_duplicates(['DataDate', 'StockCode'], keep='first')
+    # No time for the stock days with data but no journal record
+    df['RecordedAt'] = pd.to_datetime(df['RecordedAt'], format='ISO8601') if 'RecordedAt' in df else pd.NaT
+    return df[['DataDate', 'StockCode', 'Status', 'RecordedAt']].reset_index(drop=True)
+
+def load_market_holiday_observations(connection) -> pd.DataFrame:
+    # (DataDate, RecordedAt) of each time a date was seen without stocks
+    if isinstance(connection, ParquetStore):
+        df = connection.read_file(MARKET_HOLIDAY_TABLE_NAME).reindex(columns=['DataDate', 'RecordedAt'])
+    else:
+        df = pd.read_sql_query(f"select DataDate, RecordedAt from {MARKET_HOLIDAY_TABLE_NAME}", connection)
+    return df.assign(
+        DataDate=pd.to_datetime(df['DataDate']).dt.strftime('%Y-%m-%d'),
+        RecordedAt=pd.to_datetime(df['RecordedAt'], format='ISO8601')
+    )
+
+def load_market_holidays(connection) -> set:
+    # A date seen without stocks once may be a page that failed to load, it is a holiday
+    # once seen again HOLIDAY_RECHECK_HOURS later
+    df = load_market_holiday_observations(connection)
+    recorded_at = df.groupby('DataDate')['RecordedAt'].agg(['min', 'max'])
+    return set(recorded_at.index[recorded_at['max'] - recorded_at['min'] >= pd.Timedelta(hours=HOLIDAY_RECHECK_HOURS)])
+
+def store_market_holiday(date_str: str, connection, recorded_at: datetime.datetime = None):
+    # One observation, see load_market_holidays
+    df = pd.DataFrame({'DataDate': [date_str], 'RecordedAt': [recorded_at or datetime.datetime.now()]})
+    if isinstance(connection, ParquetStore):
+        df_existing = connection.read_file(MARKET_HOLIDAY_TABLE_NAME).reindex(columns=df.columns)
+        df = pd.concat([d for d in (df_existing, df) if not d.empty]).drop_duplicates()
+        connection.replace_file(df.sort_values(['DataDate', 'RecordedAt']), MARKET_HOLIDAY_TABLE_NAME)
+    elif isinstance(connection, sqlite3.Connection):
+        with connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO {MARKET_HOLIDAY_TABLE_NAME} VALUES (?, ?)", (date_str, str(df['RecordedAt'][0]))
+            )
+    elif isinstance(connection, psycopg2.extensions.connection):
+        store_df_to_quest_db(df, connection, MARKET_HOLIDAY_TABLE_NAME)
+
+def get_first_data_date(connection) -> str:
+    if isinstance(connection, ParquetStore):
+        return min(connection.get_partition_dates(STOCK_MAP_TABLE_NAME), default=None)
+    first_date = pd.read_sql_query(f"select min(DataDate) as DataDate from {STOCK_MAP_TABLE_NAME}", connection).iloc[0, 0]
+    return None if first_date is None else pd.to_datetime(first_date).strftime('%Y-%m-%d')
+
+def prune_stock_metadata(connection):
+    # After a prune: stocks without data left are removed, the others start at the first date left at the earliest
+    first_date_str = get_first_data_date(connection)
+    df = load_stock_metadata(connection)
+    if first_date_str is not None:
+        df = df[df['MaxDataDate'] >= first_date_str]
+        df = df.assign(MinDataDate=df['MinDataDate'].where(df['MinDataDate'] >= first_date_str, first_date_str))
+    else:
+        df = df.iloc[:0]
+    # Always restamped: a new RecordedAt changes the data version, so the web app drops results of the pruned dates
+    store_stock_metadata(df.assign(RecordedAt=datetime.datetime.now()), connection, replace=True)
+
+def prune_data_before(cutoff_date_str: str, connection):
+    # Drops the data of the dates before cutoff_date_str (rolling retention window)
+    start_time = time.perf_counter()
+    if isinstance(connection, ParquetStore):
+        for table_name in (CCASS_TABLE_NAME, STOCK_MAP_TABLE_NAME, SCRAPE_PROGRESS_TABLE_NAME):
+            connection.drop_partitions_before(table_name, cutoff_date_str)
+    elif isinstance(connection, sqlite3.Connection):
+        # The freed pages are reused by the next loads, so the file stops growing without a VACUUM
+        with connection:
+            for query in queries.DELETE_BEFORE.values():
+                execute_query(
+                    query, connection, cutoff_date=cutoff_date_str, cutoff_date_int=date_str_to_int(cutoff_date_str)
+                )
+        if DELTA_SOURCE == 'CHANGE_TABLE':
+            change_table.prune_change_table(connection, cutoff_date_str)
+    elif isinstance(connection, psycopg2.extensions.connection):
+        for table_name, query in queries.DROP_PARTITIONS_BEFORE.items():
+            try:
+                execute_query(query, connection, cutoff_date=cutoff_date_str).close()
+                connection.commit()
+            except psycopg2.Error as e:
+                # Nothing to drop, or a table not partitioned by date (see maintenance.py --partition-quest)
+                connection.rollback()
+                print(f"Could not drop partitions of {table_name}: {e}")
+    prune_stock_metadata(connection)
+    print(f"Pruned data before {cutoff_date_str} in {time.perf_counter() - start_time:.1f}s")
+
+def get_snapshot_data_date(date_str: str, connection) -> str:
+    # Latest date with a stock list on or before date_str (None if there is none)
+    if isinstance(connection, ParquetStore):
+        return parquet_store.get_snapshot_date(connection, date_str)
+    snapshot_date = read_query(queries.SNAPSHOT_DATE, connection, date=date_str).iloc[0, 0]
+    if snapshot_date is None or pd.isna(snapshot_date):
+        return None
+    return pd.to_datetime(snapshot_date).strftime('%Y-%m-%d')
+
+def load_shareholding_snapshots(date_strs: list, stock_codes: list, connection) -> pd.DataFrame:
+    # Holdings of the stocks on each of the dates, with DataDate as yyyy-mm-dd
+    columns = ['DataDate', 'StockCode', 'ParticipantID', 'ParticipantName', 'FracOfShares']
+    if isinstance(connection, ParquetStore):
+        return parquet_store.read_shareholding_snapshots(connection, date_strs, stock_codes, columns)
+    df = read_query(queries.SHAREHOLDING_SNAPSHOTS, connection, dates=date_strs, stock_codes=stock_codes)
+    df['DataDate'] = pd.to_datetime(df['DataDate']).dt.strftime('%Y-%m-%d')
+    return df
 
 def create_index_if_not_exist(conn):
-    if DB_TYPE != 'SQLITE':
+    if not isinstance(conn, sqlite3.Connection):
         return
     # SQLITE only
-    cursor = conn.cursor()
-    cursor.execute(f"""
-      CREATE INDEX if not exists index_stock_code on {CCASS_TABLE_NAME}(StockCode)
-    """)
-    cursor.execute(f"""
-      CREATE INDEX if not exists index_date on {CCASS_TABLE_NAME}(DataDate)
-    """)
-    cursor.execute(f"""
-      CREATE INDEX if not exists index_stock_code_date on {CCASS_TABLE_NAME}(StockCode, DataDate)
-    """)
-    cursor.execute(f"""
-      CREATE INDEX if not exists index_stock_map_date on {STOCK_MAP_TABLE_NAME}(DataDate)
-    """)
-    cursor.execute(f"""
-      CREATE INDEX if not exists index_stock_map_code on {STOCK_MAP_TABLE_NAME}(StockCode)
-    """)
-    cursor.execute(f"""
-      CREATE INDEX if not exists index_stock_map_code_date on {STOCK_MAP_TABLE_NAME}(DataDate, StockCode)
-    """)
-    cursor.close()
+    # Building all indexes in one transaction after a bulk load is much cheaper
+    # than maintaining them row by row during the load
+    with conn:
+        for index_name, table_name, columns in get_sqlite_indexes():
+            conn.execute(f"""
+              CREATE INDEX if not exists {index_name} on {table_name}({columns})
+            """)
+    conn.execute("ANALYZE")
+
+def drop_index_for_bulk_load(conn):
+    if not isinstance(conn, sqlite3.Connection):
+        return
+    with conn:
+        for index_name, _, _ in get_sqlite_indexes():
+            conn.execute(f"DROP INDEX if exists {index_name}")
 
+@instrument('query')
 def get_init_params(conn):
-    if isinstance(conn, sqlite3.Connection):
+    # O(stocks) from the metadata table maintained by the scraper
+    df_metadata = load_stock_metadata(conn)
+    if df_metadata.empty:
+        print(f"{STOCK_METADATA_TABLE_NAME} is empty, scanning the data instead (run python maintenance.py)")
+        return get_init_params_from_data(conn)
+    df_stock_map = (
+        df_metadata[['StockCode', 'StockName']]
+        .rename(columns={'StockCode': 'stockCode', 'StockName': 'stockName'})
+        .sort_values('stockCode')
+    )
+    df_stock_map['stockName'] = df_stock_map['stockName'].str.replace("'", '')
+    stock_map_list = df_stock_map.to_dict('records')
+    min_date = datetime.datetime.strptime(df_metadata['MinDataDate'].min(), '%Y-%m-%d').date()
+    max_date = datetime.datetime.strptime(df_metadata['MaxDataDate'].max(), '%Y-%m-%d').date()
+    return stock_map_list, min_date, max_date
+
+def get_init_params_from_data(conn):
+    if isinstance(conn, ParquetStore):
+        # Only the StockCode column of CCASS is read
+        stock_codes = conn.read(CCASS_TABLE_NAME, columns=['StockCode'])['StockCode'].unique()
+        df_stock_map = (
+            conn.read(STOCK_MAP_TABLE_NAME, columns=['StockCode', 'StockName'])
+            .rename(columns={'StockCode': 'stockCode', 'StockName': 'stockName'})
+        )
+        df_stock_map = df_stock_map[df_stock_map['stockCode'].isin(stock_codes)].sort_values('stockCode')
+        df_stock_map['stockName'] = df_stock_map['stockName'].str.replace("'", '')
+        df_stock_map = df_stock_map.drop_duplicates(subset=['stockCode', 'stockName'])
+        stock_map_list = df_stock_map.to_dict('records')
+        # From the partition names
+        data_dates = conn.get_partition_dates(CCASS_TABLE_NAME)
+        min_date_str, max_date_str = data_dates[0], data_dates[-1]
+    elif isinstance(conn, sqlite3.Connection) and SQLITE_SCHEMA == 'NORMALIZED':
+        df_stock_map = pd.read_sql_query(f"""
+            select distinct StockCode as stockCode, StockName as stockName from {STOCK_MAP_TABLE_NAME}
+            where StockCode in (select StockCode from {STOCK_TABLE_NAME})
+            order by StockCode
+        """, conn)
+        df_stock_map['stockName'] = df_stock_map['stockName'].str.replace("'", '')
+        df_stock_map = df_stock_map.drop_duplicates(subset=['stockCode', 'stockName'])
+        stock_map_list = df_stock_map.to_dict('records')
+        min_date_str, max_date_str = tuple(
+            pd.read_sql_query(f"""
+                Select
+                    {DATE_TO_TEXT_SQL.format(col='min(DataDate)')},
+                    {DATE_TO_TEXT_SQL.format(col='max(DataDate)')}
+                from {CCASS_FACT_TABLE_NAME}
+            """, conn)
+            .iloc[0].values.tolist()
+        )
+    elif isinstance(conn, sqlite3.Connection):
         df_stock_map = pd.read_sql_query(f"""
             select * from (
             	select distinct stockCode, stockName from {STOCK_MAP_TABLE_NAME}
@@ -159,151 +675,60 @@ def get_init_params(conn):
     
     return stock_map_list, min_date, max_date
 
+@instrument('query')
+def get_latest_data_date(conn) -> str:
+    # Changes whenever the scraper loads a new day
+    if isinstance(conn, ParquetStore):
+        return max(conn.get_partition_dates(STOCK_MAP_TABLE_NAME), default=None)
+    return pd.read_sql_query(f"select max(DataDate) as DataDate from {STOCK_MAP_TABLE_NAME}", conn).iloc[0, 0]
+
+@instrument('query')
+def get_data_version(conn) -> str:
+    # Written by update_stock_metadata once a day is fully loaded (or pruned), so it does not
+    # change while the rows of a day are still coming in, and backfilled days change it too
+    if isinstance(conn, ParquetStore):
+        recorded_at = conn.read_file(STOCK_METADATA_TABLE_NAME).reindex(columns=['RecordedAt'])['RecordedAt'].max()
+    else:
+        recorded_at = read_query(queries.DATA_VERSION, conn).iloc[0, 0]
+    if recorded_at is None or pd.isna(recorded_at):
+        # No metadata yet (DB scraped before it existed)
+        return get_latest_data_date(conn)
+    return str(recorded_at)
+
+@instrument('query', 'start_date_str', 'end_date_str')
 def get_shareholding_delta_for_transaction_finder(stock_code: str, start_date_str: str,
     end_date_str: str, conn):
-    if isinstance(conn, sqlite3.Connection):
-        query = f"""
-            with 
-        	end_date_shareholding as (
-        		select datadate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
-        		WHERE StockCode = "{stock_code}"
-        		and DataDate = (select max(DataDate) from {STOCK_MAP_TABLE_NAME} where DataDate <= "{end_date_str}")
-        	), 
-        	start_date_shareholding as (
-        		select datadate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
-        		WHERE StockCode = "{stock_code}"
-        		and DataDate = (select max(DataDate) from {STOCK_MAP_TABLE_NAME} where DataDate <= "{start_date_str}")
-        	),
-        	joint_shareholding as (
-        		select 
-        			a.ParticipantID,
-                    a.ParticipantName,
-        			ifnull(b.DataDate, "{start_date_str}")  as startDataDate,
-        			ifnull(b.FracOfShares, 0) as startFracOfShare,
-        			a.DataDate as endDataDate,
-        			a.FracOfShares as endFracOfShare
-        		from end_date_shareholding a 
-        		left outer join start_date_shareholding b
-        		on a.ParticipantID = b.ParticipantID
-        		UNION
-        		select 
-        			a.ParticipantID,
-                    a.ParticipantName,
-        			a.DataDate as startDataDate,
-        			a.FracOfShares as startFracOfShare,
-        			ifnull(b.DataDate, "{end_date_str}") as endDataDate,
-        			ifnull(b.FracOfShares,0) as endFracOfShare
-        		from start_date_shareholding a 
-        		left outer join end_date_shareholding b
-        		on a.ParticipantID = b.ParticipantID
-        	),
-        	final_table as (
-        		select
-        			joint_shareholding.*,
-        			round((endFracOfShare - startFracOfShare), 2) as ChangeInPercentShares
-        		from joint_shareholding
-        	)
-    
-            select * from final_table
-            order by ChangeInPercentShares desc
-        """
-    elif isinstance(conn, psycopg2.extensions.connection):
-        query = f"""
-            with dataDateRange as (
-              select min(datadate) as MinDataDate, max(datadate) as MaxDataDate from {STOCK_MAP_TABLE_NAME}
-              where stockCode = '{stock_code}'
-              and datadate between '{start_date_str}' and '{end_date_str}'
-            ), dataInDateRange as (
-              select datadate, ParticipantID, ParticipantName, FracOfShares from {CCASS_TABLE_NAME}
-              WHERE StockCode = '{stock_code}'
-              and datadate between '{start_date_str}' and '{end_date_str}'
-            ),
-            end_date_shareholding as (
-              select dataInDateRange.* from
-              dataInDateRange inner join dataDateRange
-              on dataInDateRange.DataDate = dataDateRange.MaxDataDate
-            ),
-            start_date_shareholding as (
-              select dataInDateRange.* from
-              dataInDateRange inner join dataDateRange
-              on dataInDateRange.DataDate = dataDateRange.MinDataDate
-            ),
-        	joint_shareholding as (
-        		select 
-        			a.ParticipantID,
-                    a.ParticipantName,
-        			coalesce(b.FracOfShares, 0) as startFracOfShare,
-        			a.FracOfShares as endFracOfShare
-        		from end_date_shareholding a 
-        		left outer join start_date_shareholding b
-        		on a.ParticipantID = b.ParticipantID
-        		UNION
-        		select 
-        			a.ParticipantID,
-                    a.ParticipantName,
-        			a.FracOfShares as startFracOfShare,
-        			coalesce(b.FracOfShares, 0) as endFracOfShare
-        		from start_date_shareholding a 
-        		left outer join end_date_shareholding b
-        		on a.ParticipantID = b.ParticipantID
-        	),
-        	final_table as (
-        		select
-        			joint_shareholding.*,
-        			round((endFracOfShare - startFracOfShare), 2) as ChangeInPercentShares
-        		from joint_shareholding
-        	)
-    
-            select * from final_table
-            order by ChangeInPercentShares desc
-        """
-    return pd.read_sql_query(query, conn)
+    if QUERY_ENGINE == 'COLUMNAR':
+        return columnar_engine.get_shareholding_delta_for_transaction_finder(
+            stock_code, start_date_str, end_date_str
+        )
+    if isinstance(conn, ParquetStore):
+        return parquet_store.get_shareholding_delta_for_transaction_finder(
+            conn, stock_code, start_date_str, end_date_str
+        )
+    if isinstance(conn, sqlite3.Connection) and DELTA_SOURCE == 'CHANGE_TABLE':
+        return change_table.get_shareholding_delta_for_transaction_finder(
+            stock_code, start_date_str, end_date_str, conn
+        )
+    return read_query(
+        queries.SHAREHOLDING_DELTA, conn,
+        stock_code=stock_code, start_date=start_date_str, end_date=end_date_str,
+        start_date_int=date_str_to_int(start_date_str), end_date_int=date_str_to_int(end_date_str)
+    )
 
+@instrument('query', 'start_date_str', 'end_date_str')
 def get_shareholding_time_series_for_top_participants(stock_code: str, start_date_str: str,
     end_date_str: str, conn):
-    if isinstance(conn, sqlite3.Connection):
-        query = f"""
-            with top10Participant as (
-            	select ParticipantID from (
-            		select ParticipantID, rank() over (order by Shareholding DESC) as rk from (
-            			select ParticipantID, Shareholding from {CCASS_TABLE_NAME}
-            			where
-            				stockcode = "{stock_code}" and 
-            				datadate = (select max(DataDate) from {STOCK_MAP_TABLE_NAME} where DataDate <= "{end_date_str}")
-            		)
-            	) WHERE rk <= 10
-            )
-            Select {','.join(TREND_TAB_DATA_COLUMNS)} from {CCASS_TABLE_NAME}
-            where 
-                StockCode = "{stock_code}" and
-                DataDate between "{start_date_str}" and "{end_date_str}" and
-                ParticipantID in top10Participant
-            order by 
-                DataDate, FracOfShares desc
-        """
-    elif isinstance(conn, psycopg2.extensions.connection):
-        query = f"""
-            with maxDataDate as (
-              select max(datadate) as DataDate from {CCASS_TABLE_NAME} 
-              where stockCode = '{stock_code}'
-              and datadate <= '{end_date_str}'
-            ),
-            top10Participant as (
-              select {CCASS_TABLE_NAME}.* from {CCASS_TABLE_NAME}
-              inner join maxDataDate
-              on {CCASS_TABLE_NAME}.DataDate = maxDataDate.DataDate
-              where
-                stockcode = '{stock_code}' 
-              order by Shareholding desc
-              limit 10
-            )
-            select a.* from (
-              select {','.join(TREND_TAB_DATA_COLUMNS)} from {CCASS_TABLE_NAME} 
-              where
-              stockCode = '{stock_code}' AND
-              datadate BETWEEN '{start_date_str}' and '{end_date_str}'
-            ) a inner JOIN top10Participant
-            on a.ParticipantID = top10Participant.ParticipantID
-            order by DataDate, FracOfShares Desc
-        """
-    return pd.read_sql_query(query, conn)
\ No newline at end of file
+    if QUERY_ENGINE == 'COLUMNAR':
+        return columnar_engine.get_shareholding_time_series_for_top_participants(
+            stock_code, start_date_str, end_date_str
+        )
+    if isinstance(conn, ParquetStore):
+        return parquet_store.get_shareholding_time_series_for_top_participants(
+            conn, stock_code, start_date_str, end_date_str, TREND_TAB_DATA_COLUMNS
+        )
+    return read_query(
+        queries.SHAREHOLDING_TIME_SERIES_FOR_TOP_PARTICIPANTS, conn,
+        stock_code=stock_code, start_date=start_date_str, end_date=end_date_str,
+        start_date_int=date_str_to_int(start_date_str), end_date_int=date_str_to_int(end_date_str)
+    )
\ No newline at end of file